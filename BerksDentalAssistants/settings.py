@@ -5,6 +5,7 @@
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -48,6 +49,7 @@ else:
     ]
 
 MIDDLEWARE = [
+    'main.middleware.collect_metrics',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,6 +58,9 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'main.middleware.server_timing',
+    'main.middleware.detect_repeated_queries',
+    'main.middleware.profile_requests',
 ]
 
 ROOT_URLCONF = 'BerksDentalAssistants.urls'
@@ -79,6 +84,44 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'BerksDentalAssistants.wsgi.application'
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'berks-dental',
+    }
+}
+
+# How long (in seconds) a public page can stay in the cache before it's rendered again
+PAGE_CACHE_TIMEOUT = 60 * 10
+
+# Send a Server-Timing header (time spent in the database, templates, and cache) to everyone, not just staff users
+# Templates are only timed when this is on, as that wraps private parts of Django's template engine
+SERVER_TIMING = False
+
+# Each process saves its metrics in this folder, so /metrics can report the totals across every process
+METRICS_DIR = os.path.join(tempfile.gettempdir(), "berks-dental-metrics")
+# How often (in seconds) each process saves its metrics
+METRICS_FLUSH_INTERVAL = 5
+# Prometheus can see /metrics without logging in by sending this as a bearer token (Authorization: Bearer <token>)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Requests from these addresses can also see /metrics without logging in, this is checked against REMOTE_ADDR
+# Behind a reverse proxy (like nginx in front of gunicorn) every request comes from the proxy's address, so listing
+# 127.0.0.1 there would make /metrics public, use METRICS_TOKEN instead
+METRICS_ALLOWED_ADDRESSES = ()
+
+# The fraction (0 to 1) of requests to profile with cProfile, profiles can be viewed by staff users in the admin site
+PROFILE_SAMPLE_RATE = 0
+# Profile requests that take at least this many seconds, this profiles every request to find the slow ones (which
+# makes every request slower), so only set it while looking into a problem, None turns it off
+PROFILE_SLOW_THRESHOLD = None
+# Profiles are saved in this folder
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), "berks-dental-profiles")
+# How many profiles to keep for each route, the oldest are removed first
+PROFILE_KEEP = 20
+
+# In DEBUG, a request that runs the same shape of query this many times is reported as an N+1 query
+REPEATED_QUERY_THRESHOLD = 5
+
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 if STAGE == "PRODUCTION":
@@ -176,3 +219,13 @@ STATICFILES_DIRS = [
 MEDIA_URL = "/media/"
 
 ICAL_FILE_NAME = "berks-dental-calendar"
+# How many seconds to wait after an event changes before rebuilding the calendar file, so a burst of edits only
+# rebuilds it once, set to None to rebuild it right away on the request thread
+CALENDAR_REBUILD_DELAY = 2
+
+# Uploaded photos are shrunk so their longest edge is at most this many pixels
+PHOTO_MAX_EDGE = 2560
+# The quality (1-100) to use when re-compressing uploaded photos as JPEG or WebP
+PHOTO_UPLOAD_QUALITY = 85
+# Set to "JPEG" or "WEBP" to save every upload in that format, None keeps JPEG, PNG, and WebP uploads as they are
+PHOTO_UPLOAD_FORMAT = None
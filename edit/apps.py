@@ -0,0 +1,14 @@
+"""
+    This file configures the edit app
+    When the app is ready, we connect the signals that keep the model version registry up to date
+"""
+
+from django.apps import AppConfig
+
+
+class EditConfig(AppConfig):
+    name = 'edit'
+
+    def ready(self):
+        from edit import signals
+        signals.connect_signals()
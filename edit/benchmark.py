@@ -0,0 +1,580 @@
+"""
+    This file has the shared pieces of the benchmarking commands (bench, loadtest, and memprofile)
+    Each command runs against a throwaway database and media folder, which are filled with generated data
+    That way we can measure the site with realistic amounts of data without touching the real database
+"""
+
+import gc
+import json
+import math
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date, time, timedelta
+from io import BytesIO
+from time import perf_counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.middleware.csrf import get_token
+from django.http import HttpRequest
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, \
+    teardown_test_environment
+from django.urls import reverse
+from django.utils.http import urlencode
+from PIL import Image
+
+from edit import models
+from edit.images import generate_derivatives
+from edit.views import REGISTERED_VIEWSETS, UserViewSet
+
+# How many of each object to create when a count isn't given
+DEFAULT_COUNTS = {
+    "events": 200,
+    "photos": 60,
+    "officers": 12,
+    "links": 20,
+    "socials": 6,
+    "users": 20,
+}
+
+BENCH_ADMIN_USERNAME = "bench-admin"
+BENCH_PASSWORD = "Bench-Password-123"
+
+
+@contextmanager
+def throwaway_environment(calendar_delay=None):
+    """
+    Creates a test database and a temporary MEDIA_ROOT, and removes them both afterwards
+    This also sets up the test environment, so the test client's requests are allowed
+
+    @param calendar_delay: What to set CALENDAR_REBUILD_DELAY to, by default the calendar is rebuilt right away
+    @type calendar_delay: float
+    """
+
+    setup_test_environment()
+    media_root = tempfile.mkdtemp(prefix="bench-media-")
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with override_settings(MEDIA_ROOT=media_root + "/", CALENDAR_REBUILD_DELAY=calendar_delay):
+            cache.clear()
+            yield media_root
+    finally:
+        cache.clear()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+def generate_image(width, height, seed):
+    """
+    Generates a JPEG with a gradient, so it compresses like a photo instead of a solid color
+
+    @param width: The width of the image
+    @type width: int
+    @param height: The height of the image
+    @type height: int
+    @param seed: A number used to vary the colors between images
+    @type seed: int
+    @return: The JPEG file
+    @rtype: ContentFile
+    """
+
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (gradient, gradient.rotate(90 + seed % 180), Image.new("L", (width, height),
+                                                                                       seed * 37 % 256)))
+    output = BytesIO()
+    image.save(output, "JPEG", quality=90)
+    return ContentFile(output.getvalue(), name=f"bench-{seed}.jpg")
+
+
+def add_picture(photo_object, folder, seed, image_size):
+    """
+    Gives a photo object a generated picture and its derivatives, or just a size if image_size is None
+
+    @param photo_object: The unsaved object to add the picture to
+    @type photo_object: Model
+    @param folder: The folder the picture is stored in
+    @type folder: str
+    @param seed: A number used to vary the image
+    @type seed: int
+    @param image_size: The width and height of the picture, None to skip making pictures
+    @type image_size: tuple
+    """
+
+    if image_size is None:
+        photo_object.width, photo_object.height = 1200, 800
+        photo_object.save()
+    else:
+        photo_object.picture = generate_image(image_size[0], image_size[1], seed)
+        photo_object.save()
+        photo_object.derivatives = generate_derivatives(photo_object, folder)
+        photo_object.save(update_fields=["derivatives"])
+
+
+def seed_data(counts, image_size=(1600, 1067)):
+    """
+    Fills the database with generated objects
+
+    @param counts: How many of each object to create (see DEFAULT_COUNTS for the keys)
+    @type counts: dict
+    @param image_size: The size of generated pictures, None to skip making picture files
+    @type image_size: tuple
+    @return: The admin user, who can access every ViewSet
+    @rtype: User
+    """
+
+    today = date.today()
+    for counter in range(counts.get("events", 0)):
+        start = today + timedelta(days=counter * 3 - counts["events"] * 3 // 2)
+        virtual = counter % 3 == 0
+        models.Event.objects.create(name=f"Bench Event {counter}", description="A generated event " * 10,
+                                    startDate=start, endDate=start + timedelta(days=counter % 3),
+                                    startTime=time(9, 0), endTime=time(17, 0), virtual=virtual,
+                                    location="" if virtual else "123 Example Street",
+                                    link="https://example.org/meeting" if virtual else "")
+    for counter in range(counts.get("photos", 0)):
+        photo = models.GalleryPhoto(caption=f"Bench Photo {counter}", featured=counter < 6)
+        add_picture(photo, "galleryphoto-pictures", counter, image_size)
+    for counter in range(counts.get("officers", 0)):
+        officer = models.Officer(first_name=f"Bench{counter}", last_name="Officer", title="Member",
+                                 biography="A generated officer " * 20, email=f"officer{counter}@example.org",
+                                 phone="555-555-5555", sort_order=counter)
+        add_picture(officer, "officer-pictures", counter, None if image_size is None else (600, 800))
+    for counter in range(counts.get("links", 0)):
+        models.ExternalLink.objects.create(display_name=f"Bench Link {counter}",
+                                           url=f"https://example.org/{counter}", sort_order=counter)
+    services = models.Social.Services.values
+    for counter in range(counts.get("socials", 0)):
+        models.Social.objects.create(service=services[counter % len(services)],
+                                     link=f"https://example.org/social/{counter}", sort_order=counter)
+    for counter in range(counts.get("users", 0)):
+        models.User.objects.create_user(username=f"bench-user-{counter}", first_name="Bench", last_name=str(counter),
+                                        email=f"user{counter}@example.org", password=BENCH_PASSWORD)
+    return models.User.objects.create_superuser(username=BENCH_ADMIN_USERNAME, email="admin@example.org",
+                                                first_name="Bench", last_name="Admin", password=BENCH_PASSWORD)
+
+
+def get_public_routes():
+    """
+    Gets every public route to measure
+
+    @return: A list of (label, method, url, data) tuples
+    @rtype: list[tuple]
+    """
+
+    routes = [
+        ("main:home", "get", reverse("main:home"), None),
+        ("main:gallery", "get", reverse("main:gallery"), None),
+        ("main:gallery_page", "post", reverse("main:gallery_page"), {"cursor": ""}),
+        ("main:officers", "get", reverse("main:officers"), None),
+        ("main:events (calendar)", "get", reverse("main:events"), None),
+        ("main:events (list)", "get", f"{reverse('main:events')}?view=list", None),
+        ("main:calendar_feed", "get", reverse("main:calendar_feed"), None),
+        ("main:about", "get", reverse("main:about"), None),
+        ("main:sitemap_index", "get", reverse("main:sitemap_index"), None),
+        ("main:sitemap_section (gallery)", "get", reverse("main:sitemap_section", kwargs={"section": "gallery"}),
+         None),
+    ]
+    photo = models.GalleryPhoto.objects.first()
+    if photo is not None:
+        routes.append(("main:view_photo", "get", f"{reverse('main:view_photo')}?id={photo.id}", None))
+    return routes
+
+
+def get_admin_routes():
+    """
+    Gets the overview, edit, and order views of every ViewSet
+
+    @return: A list of (label, method, url, data) tuples
+    @rtype: list[tuple]
+    """
+
+    routes = [("edit:admin_home", "get", reverse("edit:admin_home"), None)]
+    for view_set_class in REGISTERED_VIEWSETS + [UserViewSet]:
+        view_set = view_set_class()
+        name = view_set.get_safe_name()
+        routes.append((f"edit:{name}_view", "get", view_set.overview_link(), None))
+        first_object = view_set.model.objects.first()
+        if first_object is not None:
+            routes.append((f"edit:{name}_edit", "get", f"{view_set.edit_link()}?id={first_object.id}", None))
+        if view_set.ordered:
+            routes.append((f"edit:{name}_order", "get", view_set.order_link(), None))
+    return routes
+
+
+def get_client(user=None):
+    """
+    Gets a test client, logged in as the given user
+
+    @param user: The user to log in as, None to stay anonymous
+    @type user: User
+    @return: The client
+    @rtype: Client
+    """
+
+    client = Client()
+    if user is not None:
+        client.force_login(user)
+    return client
+
+
+def run_request(client, method, url, data=None):
+    """
+    Sends a request, and measures how long it took, how many queries it ran, and how big the response was
+
+    @return: The status code, the time it took in seconds, the number of queries, and the size in bytes
+    @rtype: int, float, int, int
+    """
+
+    with CaptureQueriesContext(connection) as queries:
+        start = perf_counter()
+        response = getattr(client, method)(url, data) if data is not None else getattr(client, method)(url)
+        body = b"".join(response.streaming_content) if response.streaming else response.content
+        duration = perf_counter() - start
+    return response.status_code, duration, len(queries), len(body)
+
+
+def get_allocation_sites(snapshot, before, top):
+    """
+    Gets the lines that allocated the most memory between two snapshots
+
+    @param snapshot: The later snapshot
+    @type snapshot: Snapshot
+    @param before: The earlier snapshot
+    @type before: Snapshot
+    @param top: How many lines to get
+    @type top: int
+    @return: A list of dicts with the line ("file:line"), the bytes it allocated, and how many blocks
+    @rtype: list[dict]
+    """
+
+    # Leave out tracemalloc's own allocations, so taking the snapshots doesn't show up in the results
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    differences = snapshot.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")
+    return [{"site": f"{difference.traceback[0].filename}:{difference.traceback[0].lineno}",
+             "bytes": difference.size_diff, "blocks": difference.count_diff}
+            for difference in differences[:top] if difference.size_diff > 0]
+
+
+def run_request_traced(client, method, url, data=None, top=10):
+    """
+    Sends a request while tracemalloc is tracing, and measures how much memory it allocated
+    The peak is the most memory the request was using at once, retained is what's still allocated after the response
+    has been thrown away (like things put in a cache), and the sites are the lines that allocated the most
+
+    @param client: The client to send the request with
+    @type client: Client
+    @param data: The data to send, or a function that makes it (for files, which can only be read once)
+    @param top: How many allocation sites to get
+    @type top: int
+    @return: The status code, the peak bytes, the retained bytes, and the top allocation sites
+    @rtype: int, int, int, list[dict]
+    """
+
+    if callable(data):
+        data = data()
+    gc.collect()
+    # Restarting tracing resets the peak (tracemalloc.reset_peak is only in Python 3.9+), and only the request's own
+    # allocations are traced from here, so memory freed from before the request can't make retained look smaller
+    frames = tracemalloc.get_traceback_limit()
+    tracemalloc.stop()
+    tracemalloc.start(frames)
+    before = tracemalloc.take_snapshot()
+    start_size = tracemalloc.get_traced_memory()[0]
+    response = getattr(client, method)(url, data) if data is not None else getattr(client, method)(url)
+    body = b"".join(response.streaming_content) if response.streaming else response.content
+    peak_size = tracemalloc.get_traced_memory()[1]
+    # The snapshot is taken while the response is still around, so the lines that built it are counted
+    snapshot = tracemalloc.take_snapshot()
+    status_code = response.status_code
+    del response, body
+    gc.collect()
+    retained_size = tracemalloc.get_traced_memory()[0] - start_size
+    return status_code, peak_size - start_size, retained_size, get_allocation_sites(snapshot, before, top)
+
+
+def measure_memory(client, routes, warmup=1, top=10, frames=1, cold=True):
+    """
+    Measures how much memory each route allocates
+    The warmup requests make sure one time costs (like imports and compiling templates) aren't counted
+
+    @param client: The client to send the requests with
+    @type client: Client
+    @param routes: The routes to measure (see get_public_routes)
+    @type routes: list[tuple]
+    @param warmup: How many requests to send before measuring
+    @type warmup: int
+    @param top: How many allocation sites to report for each route
+    @type top: int
+    @param frames: How many frames tracemalloc keeps for each allocation
+    @type frames: int
+    @param cold: Whether to clear the page cache before every request, so the view itself is measured
+    @type cold: bool
+    @return: A dict that maps each route's label to its status, peak_bytes, retained_bytes, and sites
+    @rtype: dict
+    """
+
+    results = {}
+    tracemalloc.start(frames)
+    try:
+        for label, method, url, data in routes:
+            for _ in range(warmup):
+                if cold:
+                    cache.clear()
+                run_request(client, method, url, data() if callable(data) else data)
+            if cold:
+                cache.clear()
+            status, peak, retained, sites = run_request_traced(client, method, url, data, top)
+            results[label] = {"status": status, "peak_bytes": peak, "retained_bytes": retained, "sites": sites}
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def find_over_budget(results, budgets, default_budget=None):
+    """
+    Finds routes whose peak memory is over their budget
+
+    @param results: The routes measured by measure_memory
+    @type results: dict
+    @param budgets: A dict that maps route labels to their budget in bytes
+    @type budgets: dict
+    @param default_budget: The budget for routes that aren't in budgets, None to only check routes in budgets
+    @type default_budget: int
+    @return: A description of each route that's over budget
+    @rtype: list[str]
+    """
+
+    problems = []
+    for label, summary in results.items():
+        budget = budgets.get(label, default_budget)
+        if budget is not None and summary["peak_bytes"] > budget:
+            problems.append(f"{label}: peak of {summary['peak_bytes']} bytes is over its budget of {budget} bytes")
+    return problems
+
+
+def percentile(values, fraction):
+    """
+    Gets a percentile of some values, using the nearest rank method
+
+    @param values: The values
+    @type values: list[float]
+    @param fraction: The percentile to get, from 0 to 1 (ex: 0.95)
+    @type fraction: float
+    @return: The percentile, or 0 if there are no values
+    @rtype: float
+    """
+
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize(durations, query_counts, sizes, statuses):
+    """
+    Summarizes the measurements of one route, times are converted to milliseconds
+
+    @return: The summary
+    @rtype: dict
+    """
+
+    return {
+        "requests": len(durations),
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 3),
+        "queries": max(query_counts, default=0),
+        "bytes": max(sizes, default=0),
+        "statuses": sorted(set(statuses)),
+    }
+
+
+def measure_routes(client, routes, repeat, warmup=2, cold=False):
+    """
+    Sends each route repeat times (after some warmup requests that aren't measured)
+
+    @param client: The client to send the requests with
+    @type client: Client
+    @param routes: The routes to measure (see get_public_routes)
+    @type routes: list[tuple]
+    @param repeat: How many times to measure each route
+    @type repeat: int
+    @param warmup: How many requests to send before measuring
+    @type warmup: int
+    @param cold: Whether to clear the page cache before every request
+    @type cold: bool
+    @return: A dict that maps each route's label to its summary
+    @rtype: dict
+    """
+
+    results = {}
+    for label, method, url, data in routes:
+        durations, query_counts, sizes, statuses = [], [], [], []
+        for counter in range(warmup + repeat):
+            if cold:
+                cache.clear()
+            status, duration, query_count, size = run_request(client, method, url, data)
+            if counter >= warmup:
+                durations.append(duration)
+                query_counts.append(query_count)
+                sizes.append(size)
+                statuses.append(status)
+        results[label] = summarize(durations, query_counts, sizes, statuses)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance, minimum_ms=1.0):
+    """
+    Finds routes that got slower, or run more queries, than they did in the baseline
+
+    @param results: The routes measured now
+    @type results: dict
+    @param baseline: The routes measured before
+    @type baseline: dict
+    @param tolerance: How much slower a route can be before it counts (ex: 1.25 allows 25% slower)
+    @type tolerance: float
+    @param minimum_ms: A route has to be at least this many milliseconds slower to count, to ignore noise
+    @type minimum_ms: float
+    @return: A description of each regression
+    @rtype: list[str]
+    """
+
+    regressions = []
+    for label, summary in results.items():
+        before = baseline.get(label)
+        if before is None:
+            continue
+        slower_by = summary["p95_ms"] - before["p95_ms"]
+        if summary["p95_ms"] > before["p95_ms"] * tolerance and slower_by >= minimum_ms:
+            regressions.append(f"{label}: p95 went from {before['p95_ms']}ms to {summary['p95_ms']}ms")
+        if summary["queries"] > before["queries"]:
+            regressions.append(f"{label}: queries went from {before['queries']} to {summary['queries']}")
+    return regressions
+
+
+def write_json(path, data):
+    """
+    Saves results as JSON
+
+    @param path: Where to save them
+    @type path: str
+    @param data: The results
+    @type data: dict
+    """
+
+    with open(path, 'w') as output_file:
+        json.dump(data, output_file, indent=2, sort_keys=True)
+
+
+def read_json(path):
+    """
+    Reads results that were saved by write_json
+
+    @param path: The file to read
+    @type path: str
+    @return: The results
+    @rtype: dict
+    """
+
+    with open(path) as input_file:
+        return json.load(input_file)
+
+
+def get_session_cookies(user):
+    """
+    Logs a user in, and gets the cookies a browser would send with their requests (including a CSRF token)
+
+    @param user: The user to log in as
+    @type user: User
+    @return: The cookie header, and the CSRF token to send with POST requests
+    @rtype: str, str
+    """
+
+    client = get_client(user)
+    csrf_request = HttpRequest()
+    csrf_token = get_token(csrf_request)
+    session_cookie = client.cookies[settings.SESSION_COOKIE_NAME].value
+    cookies = f"{settings.SESSION_COOKIE_NAME}={session_cookie}; " \
+              f"{settings.CSRF_COOKIE_NAME}={csrf_request.META['CSRF_COOKIE']}"
+    return cookies, csrf_token
+
+
+def make_environ(method, path, query="", data=None, cookies="", csrf_token=None):
+    """
+    Builds a WSGI environ, like a WSGI server would for a request
+
+    @param method: The HTTP method
+    @type method: str
+    @param path: The path to request
+    @type path: str
+    @param query: The query string
+    @type query: str
+    @param data: The form data to POST
+    @type data: dict
+    @param cookies: The cookie header to send
+    @type cookies: str
+    @param csrf_token: The CSRF token to send in the X-CSRFToken header
+    @type csrf_token: str
+    @return: The environ
+    @rtype: dict
+    """
+
+    body = urlencode(data or {}, doseq=True).encode("utf-8")
+    environ = {
+        "REQUEST_METHOD": method.upper(),
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": "testserver",
+        "HTTP_USER_AGENT": "berks-dental-loadtest",
+        "HTTP_COOKIE": cookies,
+        "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if csrf_token is not None:
+        environ["HTTP_X_CSRFTOKEN"] = csrf_token
+    return environ
+
+
+def call_wsgi(application, environ):
+    """
+    Sends a request straight to a WSGI application, and reads the whole response
+
+    @param application: The WSGI application
+    @type application: function
+    @param environ: The request (see make_environ)
+    @type environ: dict
+    @return: The status code, and the size of the body in bytes
+    @rtype: int, int
+    """
+
+    status_holder = []
+
+    def start_response(status, headers, exc_info=None):
+        status_holder.append(status)
+
+    body = application(environ, start_response)
+    try:
+        size = sum(len(chunk) for chunk in body)
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+    return int(status_holder[0].split(" ", 1)[0]), size
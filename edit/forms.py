@@ -9,6 +9,7 @@ from uuid import UUID
 from django.conf import settings
 from django.contrib.auth.password_validation import validate_password, ValidationError, \
     get_password_validators, password_validators_help_texts
+from django.core.files.uploadedfile import UploadedFile
 from django.forms import Form, ModelForm, fields, PasswordInput
 from django.forms.widgets import DateInput, TimeInput, ClearableFileInput, TextInput
 
@@ -34,18 +35,45 @@ def get_size_of_folder(folder_path):
     return total_size
 
 
+def get_usage_by_folder(folder_path):
+    """
+    Given the path of a folder, get the size and number of files directly inside it and each folder below it
+
+    @param folder_path: The path to a folder
+    @type folder_path: str
+    @return: A dict that maps each folder (relative to folder_path) to its size in bytes and number of files
+    @rtype: dict
+    """
+
+    usage = {}
+    for dir_path, dir_names, filenames in os.walk(folder_path):
+        folder = os.path.relpath(dir_path, folder_path).replace(os.sep, "/")
+        folder_bytes, folder_files = 0, 0
+        for f in filenames:
+            fp = os.path.join(dir_path, f)
+            if not os.path.islink(fp):
+                folder_bytes += os.path.getsize(fp)
+                folder_files += 1
+        if folder_files > 0:
+            usage["" if folder == "." else folder] = (folder_bytes, folder_files)
+    return usage
+
+
 MAX_BYTES = 900000000
 
 
-def check_media_quota():
+def check_media_quota(new_bytes=0):
     """
     Checks to ensure we won't go over the max amount of bytes we can store
+    This reads from the media usage ledger, instead of walking through MEDIA_ROOT
 
+    @param new_bytes: How many bytes we're about to add
+    @type new_bytes: int
     @return: whether we're close to going over the limit
     @rtype: bool
     """
 
-    return get_size_of_folder(settings.MEDIA_ROOT) <= MAX_BYTES
+    return models.MediaUsage.total_bytes() + new_bytes <= MAX_BYTES
 
 
 class TimeSelectorField(TimeInput):
@@ -282,7 +310,8 @@ class PhotoForm(ModelForm):
         cleaned_data = super().clean()
         featured = cleaned_data.get("featured")
 
-        if not check_media_quota():
+        picture = cleaned_data.get("picture")
+        if not check_media_quota(picture.size if isinstance(picture, UploadedFile) else 0):
             self.add_error("picture", "There is not enough space to upload this picture,"
                                       " please delete some older pictures to free up space")
 
@@ -0,0 +1,223 @@
+"""
+    This file handles processing uploaded photos
+    When a photo is uploaded, we rotate it the right way, strip its metadata, shrink it, and re-compress it
+    We also make smaller copies (derivatives) of each photo
+    Visitors get sent the smallest copy that fits on their screen instead of the full upload
+    Each size is saved as both WebP (for browsers that support it) and JPEG (for browsers that don't)
+"""
+
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, features
+
+# What format to save uploads in, based off the format they were uploaded in, anything else is saved as JPEG
+UPLOAD_FORMATS = {
+    "JPEG": ("JPEG", "jpg"),
+    "PNG": ("PNG", "png"),
+    "WEBP": ("WEBP", "webp"),
+}
+
+# Keys Pillow puts in an image's info that only describe how it's encoded, anything else (like xmp, photoshop,
+# comment, icc_profile, or a PNG text chunk) is metadata that has to be stripped
+ENCODING_INFO_KEYS = frozenset({
+    "jfif", "jfif_version", "jfif_unit", "jfif_density", "dpi", "adobe", "adobe_transform", "progressive",
+    "progression", "gamma", "transparency", "srgb", "aspect", "interlace", "compression", "lossless",
+})
+
+# The name of each size, and the width (in pixels) of that size
+DERIVATIVE_SIZES = {
+    "grid": 400,
+    "medium": 800,
+    "large": 1600,
+}
+
+# The formats we save each size in, as: name -> (Pillow format, file extension, save options)
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "jpg", {"quality": 82, "progressive": True, "optimize": True}),
+}
+
+# Pillow can be built without WebP support, in that case we only make JPEG copies
+if not features.check("webp"):
+    del DERIVATIVE_FORMATS["webp"]
+
+
+def get_upload_save_options(pillow_format):
+    """
+    Gets the options to pass to Pillow when re-saving an upload in a given format
+
+    @param pillow_format: The format we're saving in (JPEG, PNG, or WEBP)
+    @type pillow_format: str
+    @return: The options to pass to Image.save
+    @rtype: dict
+    """
+
+    if pillow_format == "JPEG":
+        return {"quality": settings.PHOTO_UPLOAD_QUALITY, "progressive": True, "optimize": True}
+    elif pillow_format == "WEBP":
+        return {"quality": settings.PHOTO_UPLOAD_QUALITY, "method": 4}
+    else:
+        return {"optimize": True}
+
+
+def has_metadata(image):
+    """
+    Checks whether a photo has metadata we'd have to strip (EXIF, XMP, IPTC, comments, ICC profiles, or text chunks)
+
+    @param image: The opened photo
+    @type image: Image
+    @return: Whether the photo has any metadata
+    @rtype: bool
+    """
+
+    if len(image.getexif()) > 0 or any(key not in ENCODING_INFO_KEYS for key in image.info.keys()):
+        return True
+    # Pillow doesn't put every JPEG segment in info, so we also check for any besides the JFIF and Adobe headers
+    return any(not (marker == "APP0" and content.startswith(b"JFIF\x00")) and
+               not (marker == "APP14" and content.startswith(b"Adobe"))
+               for marker, content in getattr(image, "applist", []))
+
+
+def optimize_upload(uploaded_file):
+    """
+    Processes a newly uploaded photo before it's saved:
+        1. Rotates it based off its EXIF orientation
+        2. Shrinks it so its longest edge is at most PHOTO_MAX_EDGE
+        3. Re-saves it (JPEGs are saved as progressive JPEGs) without any metadata
+    We read the size from the header before decoding, and large JPEGs are decoded at a reduced scale
+    If re-saving didn't change anything but the encoding (no metadata, size, mode, or format change), and the new file
+    isn't smaller, we keep the original
+
+    @param uploaded_file: The uploaded file
+    @type uploaded_file: File
+    @return: The processed file and how many bytes we saved, or None, 0 if the original should be kept
+    @rtype: ContentFile, int
+    """
+
+    uploaded_file.seek(0)
+    original_bytes = uploaded_file.size
+    max_edge = settings.PHOTO_MAX_EDGE
+    with Image.open(uploaded_file) as image:
+        if getattr(image, "is_animated", False):
+            return None, 0
+        pillow_format, extension = UPLOAD_FORMATS.get(image.format, ("JPEG", "jpg"))
+        if settings.PHOTO_UPLOAD_FORMAT is not None:
+            pillow_format, extension = UPLOAD_FORMATS[settings.PHOTO_UPLOAD_FORMAT]
+        if pillow_format == "WEBP" and not features.check("webp"):
+            pillow_format, extension = UPLOAD_FORMATS["JPEG"]
+        # Anything with metadata (like an orientation or a location) has to be re-saved, even if it gets bigger
+        only_encoding_changes = not has_metadata(image) and max(image.size) <= max_edge and \
+            pillow_format == image.format
+        original_mode = image.mode
+        if image.format == "JPEG" and max(image.size) > max_edge:
+            # Only decodes as much of the JPEG as we need to reach the target size
+            image.draft("RGB", (max_edge, max_edge))
+        processed = ImageOps.exif_transpose(image)
+        if max(processed.size) > max_edge:
+            processed.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        if pillow_format == "JPEG":
+            processed = flatten_for_jpeg(processed)
+        elif processed.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            processed = processed.convert("RGBA")
+        output = BytesIO()
+        processed.save(output, pillow_format, **get_upload_save_options(pillow_format))
+        only_encoding_changes = only_encoding_changes and processed.mode == original_mode
+    uploaded_file.seek(0)
+    if only_encoding_changes and output.tell() >= original_bytes:
+        return None, 0
+    base_name = os.path.splitext(os.path.basename(uploaded_file.name))[0]
+    new_file = ContentFile(output.getvalue(), name=f"{base_name}.{extension}")
+    return new_file, original_bytes - new_file.size
+
+
+def get_derivative_name(photo_object, folder, size_name, extension):
+    """
+    Gets the name (relative to MEDIA_ROOT) of a derivative file
+
+    @param photo_object: The object with the photo
+    @type photo_object: Model
+    @param folder: The folder the original photo is stored in
+    @type folder: str
+    @param size_name: The name of the size (grid, medium, etc.)
+    @type size_name: str
+    @param extension: The extension of the file
+    @type extension: str
+    @return: The name of the derivative file
+    @rtype: str
+    """
+
+    return f"{folder}/derivatives/{photo_object.id}-{size_name}.{extension}"
+
+
+def flatten_for_jpeg(image):
+    """
+    JPEG doesn't support transparency, so we put transparent images on a white background
+
+    @param image: The image to flatten
+    @type image: Image
+    @return: An RGB version of the image
+    @rtype: Image
+    """
+
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba_image = image.convert("RGBA")
+        background = Image.new("RGB", rgba_image.size, (255, 255, 255))
+        background.paste(rgba_image, mask=rgba_image.split()[-1])
+        return background
+    else:
+        return image.convert("RGB")
+
+
+def generate_derivatives(photo_object, folder):
+    """
+    Creates a copy of the photo for each size and format, we never make a copy bigger than the original
+    Once we reach the original's width, we stop, as every bigger size would be the same
+
+    @param photo_object: The object with the photo
+    @type photo_object: Model
+    @param folder: The folder the original photo is stored in
+    @type folder: str
+    @return: A dict that maps each size name to its width, height, and the file name of each format
+    @rtype: dict
+    """
+
+    derivatives = {}
+    os.makedirs(os.path.join(settings.MEDIA_ROOT, folder, "derivatives"), exist_ok=True)
+    with Image.open(photo_object.picture.path) as original:
+        original.load()
+        for size_name, target_width in DERIVATIVE_SIZES.items():
+            width = min(target_width, original.width)
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+            entry = {"width": width, "height": height}
+            for format_name, (pillow_format, extension, options) in DERIVATIVE_FORMATS.items():
+                name = get_derivative_name(photo_object, folder, size_name, extension)
+                if pillow_format == "JPEG":
+                    output = flatten_for_jpeg(resized)
+                elif resized.mode in ("RGB", "RGBA"):
+                    output = resized
+                else:
+                    output = resized.convert("RGBA")
+                output.save(os.path.join(settings.MEDIA_ROOT, name), pillow_format, **options)
+                entry[format_name] = name
+            derivatives[size_name] = entry
+            if width == original.width:
+                break
+    return derivatives
+
+
+def get_derivative_files(photo_object):
+    """
+    Gets the name (relative to MEDIA_ROOT) of every derivative file of a photo
+
+    @param photo_object: The object with the photo
+    @type photo_object: Model
+    @return: The names of the derivative files
+    @rtype: list[str]
+    """
+
+    return [entry[format_name] for entry in photo_object.derivatives.values()
+            for format_name in DERIVATIVE_FORMATS.keys() if entry.get(format_name)]
@@ -0,0 +1,55 @@
+"""
+    This command measures how fast every page is with a realistic amount of data
+    It fills a throwaway database with generated objects, then requests every public page and every ViewSet's pages
+    The results (p50/p95/p99 latency, queries, and response size per route) are saved as JSON
+    If a baseline (results from an earlier run) is given, any route that got slower or runs more queries is reported
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from edit import benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks every page against a throwaway database filled with generated data"
+
+    def add_arguments(self, parser):
+        for name, default in benchmark.DEFAULT_COUNTS.items():
+            parser.add_argument(f"--{name}", type=int, default=default, help=f"How many {name} to create")
+        parser.add_argument("--repeat", type=int, default=20, help="How many times to request each page")
+        parser.add_argument("--warmup", type=int, default=2, help="How many requests to send before measuring")
+        parser.add_argument("--cold", action="store_true", help="Clear the page cache before every request")
+        parser.add_argument("--no-images", action="store_true", help="Don't generate picture files")
+        parser.add_argument("--output", default="bench-results.json", help="Where to save the results")
+        parser.add_argument("--baseline", help="Results from an earlier run to compare against")
+        parser.add_argument("--tolerance", type=float, default=1.25,
+                            help="How much slower (ex: 1.25 is 25%%) a page can get before it's a regression")
+
+    def handle(self, *args, **options):
+        counts = {name: options[name] for name in benchmark.DEFAULT_COUNTS.keys()}
+        with benchmark.throwaway_environment():
+            self.stdout.write(f"Seeding: {', '.join(f'{count} {name}' for name, count in counts.items())}")
+            admin = benchmark.seed_data(counts, image_size=None if options["no_images"] else (1600, 1067))
+            routes = benchmark.measure_routes(benchmark.get_client(), benchmark.get_public_routes(),
+                                              options["repeat"], options["warmup"], options["cold"])
+            routes.update(benchmark.measure_routes(benchmark.get_client(admin), benchmark.get_admin_routes(),
+                                                   options["repeat"], options["warmup"], options["cold"]))
+        self.stdout.write(f"{'Route':<40}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'Queries':>9}{'Bytes':>10}")
+        for label, summary in routes.items():
+            self.stdout.write(f"{label:<40}{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['p99_ms']:>10}"
+                              f"{summary['queries']:>9}{summary['bytes']:>10}")
+            if any(status >= 400 for status in summary["statuses"]):
+                self.stdout.write(self.style.WARNING(f"    {label} responded with {summary['statuses']}"))
+        benchmark.write_json(options["output"], {"counts": counts, "cold": options["cold"], "routes": routes})
+        self.stdout.write(f"Saved the results to {options['output']}")
+        if options["baseline"]:
+            try:
+                baseline = benchmark.read_json(options["baseline"])
+            except (OSError, ValueError) as error:
+                raise CommandError(f"Couldn't read the baseline: {error}")
+            regressions = benchmark.compare_to_baseline(routes, baseline["routes"], options["tolerance"])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f"{len(regressions)} regression(s) compared to {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions compared to the baseline"))
@@ -0,0 +1,26 @@
+"""
+    This command makes the smaller copies of every photo that doesn't have them yet
+    Photos uploaded before we started making copies will only have the original, so run this once after updating
+"""
+
+from django.core.management.base import BaseCommand
+
+from edit import views
+
+
+class Command(BaseCommand):
+    help = "Generates smaller copies of photos that don't have them yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Regenerate the copies of every photo")
+
+    def handle(self, *args, **options):
+        for view_set in (views.GalleryPhotoViewSet(), views.OfficerViewSet()):
+            photos = view_set.model.objects.all()
+            if not options["all"]:
+                photos = photos.filter(derivatives={})
+            count = 0
+            for photo in photos.iterator():
+                view_set.update_derivatives(photo)
+                count += 1
+            self.stdout.write(f"Generated copies for {count} {view_set.displayName}(s)")
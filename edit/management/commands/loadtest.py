@@ -0,0 +1,215 @@
+"""
+    This command sends concurrent traffic straight to the WSGI application, to find problems that only show up under
+    load
+    A pool of threads sends a mix of public traffic (home, gallery pages, event months, and the calendar feed)
+    Gallery pages are requested by cursor, like gallery.js does, starting from every page of the gallery
+    and admin traffic (saving events, which rebuilds the calendar, and re-ordering links)
+    It reports throughput, latency percentiles, and errors for each kind of request
+    After the run, it also checks that the calendar file is still a complete, readable calendar
+    The throwaway database is SQLite's shared in-memory database when DATABASES uses SQLite, which only allows one
+    writer at a time, so "database table is locked" errors there are SQLite's limit rather than a bug in the site
+"""
+
+import random
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from threading import Lock
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from icalendar import Calendar
+
+from BerksDentalAssistants.wsgi import application
+from edit import benchmark, models, views, webcal
+from edit.pagination import get_keyset_page
+from main.views import GALLERY_ORDERING, MAX_IMAGES_PER_PAGE
+
+# The kinds of requests to send, and how often to send each one (relative to the others)
+OPERATION_WEIGHTS = {
+    "home": 30,
+    "gallery_page": 20,
+    "events_month": 25,
+    "calendar_feed": 10,
+    "event_save": 10,
+    "link_reorder": 5,
+}
+WRITE_OPERATIONS = ("event_save", "link_reorder")
+
+
+class LoadTest:
+    """
+    This class holds the data every thread shares, and builds the request for each kind of operation
+    """
+
+    def __init__(self, admin, include_writes):
+        self.cookies, self.csrf_token = benchmark.get_session_cookies(admin)
+        self.event_ids = [str(event_id) for event_id in models.Event.objects.values_list("id", flat=True)]
+        self.link_ids = [str(link_id) for link_id in models.ExternalLink.objects.values_list("id", flat=True)]
+        self.gallery_cursors = self.get_gallery_cursors()
+        self.event_edit_path = views.EventViewSet().edit_link()
+        self.link_order_path = views.LinkViewSet().order_link()
+        weights = {name: weight for name, weight in OPERATION_WEIGHTS.items()
+                   if include_writes or name not in WRITE_OPERATIONS}
+        self.operations = list(weights.keys())
+        self.weights = list(weights.values())
+        self.results = defaultdict(lambda: {"durations": [], "errors": defaultdict(int)})
+        self.results_lock = Lock()
+
+    @staticmethod
+    def get_gallery_cursors():
+        """
+        Walks through the gallery the way gallery.js does, and keeps the cursor for each page
+        An empty cursor gets the first page
+
+        @return: The cursor for every page of the gallery
+        @rtype: list[str]
+        """
+
+        cursors = [""]
+        while True:
+            rows, next_cursor = get_keyset_page(models.GalleryPhoto.objects.all(), GALLERY_ORDERING,
+                                                MAX_IMAGES_PER_PAGE, cursor=cursors[-1])
+            if next_cursor is None:
+                return cursors
+            cursors.append(next_cursor)
+
+    def build_environ(self, operation, rng):
+        """
+        Builds the request for an operation
+
+        @param operation: The kind of request to send
+        @type operation: str
+        @param rng: The random number generator to use
+        @type rng: Random
+        @return: The WSGI environ for the request
+        @rtype: dict
+        """
+
+        if operation == "home":
+            return benchmark.make_environ("GET", reverse("main:home"))
+        elif operation == "gallery_page":
+            return benchmark.make_environ("POST", reverse("main:gallery_page"),
+                                          data={"cursor": rng.choice(self.gallery_cursors)})
+        elif operation == "events_month":
+            today = date.today()
+            month = rng.randint(1, 12)
+            year = today.year + rng.randint(-1, 1)
+            return benchmark.make_environ("GET", reverse("main:events"), query=f"month={month}&year={year}")
+        elif operation == "calendar_feed":
+            return benchmark.make_environ("GET", reverse("main:calendar_feed"))
+        elif operation == "event_save":
+            start = date.today().isoformat()
+            data = {"name": f"Load Test Event {rng.randint(0, 1000)}", "description": "Saved by the load test",
+                    "virtual": "on", "link": "https://example.org/meeting", "location": "",
+                    "startDate": start, "endDate": start, "startTime": "09:00", "endTime": "17:00"}
+            return benchmark.make_environ("POST", self.event_edit_path, query=f"id={rng.choice(self.event_ids)}",
+                                          data=data, cookies=self.cookies, csrf_token=self.csrf_token)
+        else:
+            new_order = self.link_ids.copy()
+            rng.shuffle(new_order)
+            return benchmark.make_environ("POST", self.link_order_path, data={"new_order": ",".join(new_order)},
+                                          cookies=self.cookies, csrf_token=self.csrf_token)
+
+    def run_one(self, seed):
+        """
+        Sends one randomly chosen request, and records how it went
+
+        @param seed: The seed for this request's random choices
+        @type seed: int
+        """
+
+        rng = random.Random(seed)
+        operation = rng.choices(self.operations, weights=self.weights)[0]
+        if operation == "link_reorder" and not self.link_ids:
+            operation = "home"
+        start = perf_counter()
+        error = None
+        try:
+            status, size = benchmark.call_wsgi(application, self.build_environ(operation, rng))
+            if status >= 400:
+                error = f"HTTP {status}"
+        except Exception as exception:
+            error = type(exception).__name__
+        duration = perf_counter() - start
+        with self.results_lock:
+            self.results[operation]["durations"].append(duration)
+            if error is not None:
+                self.results[operation]["errors"][error] += 1
+
+
+class Command(BaseCommand):
+    help = "Sends concurrent public and admin traffic to the WSGI application, and reports latency and errors"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8, help="How many requests to send at once")
+        parser.add_argument("--requests", type=int, default=2000, help="How many requests to send in total")
+        parser.add_argument("--events", type=int, default=100, help="How many events to create")
+        parser.add_argument("--photos", type=int, default=40, help="How many photos to create")
+        parser.add_argument("--links", type=int, default=10, help="How many links to create")
+        parser.add_argument("--read-only", action="store_true", help="Don't send any admin (write) traffic")
+        parser.add_argument("--debounce", action="store_true",
+                            help="Rebuild the calendar in the background like production, instead of right away")
+        parser.add_argument("--seed", type=int, default=0, help="The seed for choosing requests")
+
+    def handle(self, *args, **options):
+        counts = {"events": options["events"], "photos": options["photos"], "links": options["links"],
+                  "officers": 6, "socials": 3, "users": 0}
+        calendar_delay = 0.5 if options["debounce"] else None
+        with benchmark.throwaway_environment(calendar_delay=calendar_delay):
+            admin = benchmark.seed_data(counts, image_size=None)
+            webcal.update_file()
+            load_test = LoadTest(admin, not options["read_only"])
+            self.stdout.write(f"Sending {options['requests']} requests from {options['threads']} threads")
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=options["threads"]) as executor:
+                list(executor.map(load_test.run_one, range(options["seed"], options["seed"] + options["requests"])))
+            elapsed = perf_counter() - start
+            if webcal.rebuild_timer is not None:
+                webcal.rebuild_timer.join()
+            calendar_problem = self.check_calendar()
+        self.report(load_test.results, elapsed)
+        total_errors = sum(sum(result["errors"].values()) for result in load_test.results.values())
+        if calendar_problem:
+            raise CommandError(f"The calendar file is broken after the run: {calendar_problem}")
+        if total_errors:
+            raise CommandError(f"{total_errors} request(s) failed")
+
+    @staticmethod
+    def check_calendar():
+        """
+        Checks that the calendar file can be read, and has every event in it
+
+        @return: A description of the problem, or None if the file is fine
+        @rtype: str
+        """
+
+        try:
+            with open(webcal.get_calendar_path(), 'rb') as calendar_file:
+                calendar = Calendar.from_ical(calendar_file.read())
+        except (OSError, ValueError) as error:
+            return str(error)
+        event_count = len(calendar.walk("VEVENT"))
+        if event_count != models.Event.objects.count():
+            return f"it has {event_count} events instead of {models.Event.objects.count()}"
+        return None
+
+    def report(self, results, elapsed):
+        """
+        Writes the throughput, latency, and errors of each kind of request
+        """
+
+        total = sum(len(result["durations"]) for result in results.values())
+        self.stdout.write(f"{total} requests in {elapsed:.2f}s ({total / elapsed:.1f} requests/s)")
+        self.stdout.write(f"{'Operation':<16}{'Count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+                          f"{'Max ms':>10}{'Errors':>8}")
+        for operation, result in sorted(results.items()):
+            durations = result["durations"]
+            self.stdout.write(f"{operation:<16}{len(durations):>7}"
+                              f"{benchmark.percentile(durations, 0.50) * 1000:>10.2f}"
+                              f"{benchmark.percentile(durations, 0.95) * 1000:>10.2f}"
+                              f"{benchmark.percentile(durations, 0.99) * 1000:>10.2f}"
+                              f"{max(durations, default=0) * 1000:>10.2f}{sum(result['errors'].values()):>8}")
+            for error, count in sorted(result["errors"].items()):
+                self.stdout.write(self.style.WARNING(f"    {error}: {count}"))
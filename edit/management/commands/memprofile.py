@@ -0,0 +1,91 @@
+"""
+    This command measures how much memory each page allocates, using tracemalloc
+    It fills a throwaway database with generated objects, then requests every public page, every ViewSet's pages,
+    and a couple of add forms (which count the existing objects and featured photos)
+    For each route it reports the peak and retained allocations, and the lines that allocated the most
+    A budget file (JSON that maps route labels to a number of kilobytes) or --budget can make the command fail when a
+    route's peak goes over its budget
+"""
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from edit import benchmark, views
+
+
+def get_add_routes():
+    """
+    Gets the routes that add a link and a gallery photo
+
+    @return: A list of (label, method, url, data) tuples, the photo's data is a function so each request gets a new file
+    @rtype: list[tuple]
+    """
+
+    link_view_set = views.LinkViewSet()
+    photo_view_set = views.GalleryPhotoViewSet()
+
+    def photo_data():
+        picture = benchmark.generate_image(1600, 1067, 0)
+        return {"picture": SimpleUploadedFile(picture.name, picture.read(), content_type="image/jpeg"),
+                "caption": "Memory Profile Photo"}
+
+    return [
+        (f"edit:{link_view_set.get_safe_name()}_add", "post", link_view_set.edit_link(),
+         {"display_name": "Memory Profile Link", "url": "https://example.org/memory"}),
+        (f"edit:{photo_view_set.get_safe_name()}_add", "post", photo_view_set.edit_link(), photo_data),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Measures the memory every page allocates against a throwaway database filled with generated data"
+
+    def add_arguments(self, parser):
+        for name, default in benchmark.DEFAULT_COUNTS.items():
+            parser.add_argument(f"--{name}", type=int, default=default, help=f"How many {name} to create")
+        parser.add_argument("--only", help="Only measure routes with this text in their label")
+        parser.add_argument("--top", type=int, default=5, help="How many allocation sites to show for each route")
+        parser.add_argument("--frames", type=int, default=1,
+                            help="How many frames of each allocation's traceback to keep (more is slower)")
+        parser.add_argument("--warm-cache", action="store_true",
+                            help="Keep the page cache between requests, so cached pages are measured as cache hits")
+        parser.add_argument("--no-images", action="store_true", help="Don't generate picture files")
+        parser.add_argument("--budget", type=float, help="The most kilobytes any route's peak can be")
+        parser.add_argument("--budgets", help="A JSON file that maps route labels to their budget in kilobytes")
+        parser.add_argument("--output", default="memprofile-results.json", help="Where to save the results")
+
+    def handle(self, *args, **options):
+        try:
+            budgets = {label: kilobytes * 1024 for label, kilobytes in
+                       (benchmark.read_json(options["budgets"]) if options["budgets"] else {}).items()}
+        except (OSError, ValueError) as error:
+            raise CommandError(f"Couldn't read the budgets: {error}")
+        default_budget = options["budget"] * 1024 if options["budget"] is not None else None
+        counts = {name: options[name] for name in benchmark.DEFAULT_COUNTS.keys()}
+        with benchmark.throwaway_environment():
+            self.stdout.write(f"Seeding: {', '.join(f'{count} {name}' for name, count in counts.items())}")
+            admin = benchmark.seed_data(counts, image_size=None if options["no_images"] else (1600, 1067))
+            public_routes = benchmark.get_public_routes() + [
+                ("main:gallery_page (page)", "post", reverse("main:gallery_page"), {"page": 2})]
+            admin_routes = benchmark.get_admin_routes() + get_add_routes()
+            if options["only"]:
+                public_routes = [route for route in public_routes if options["only"] in route[0]]
+                admin_routes = [route for route in admin_routes if options["only"] in route[0]]
+            measure_options = {"top": options["top"], "frames": options["frames"], "cold": not options["warm_cache"]}
+            results = benchmark.measure_memory(benchmark.get_client(), public_routes, **measure_options)
+            results.update(benchmark.measure_memory(benchmark.get_client(admin), admin_routes, **measure_options))
+        self.stdout.write(f"{'Route':<40}{'Status':>8}{'Peak KiB':>12}{'Retained KiB':>14}")
+        for label, summary in results.items():
+            self.stdout.write(f"{label:<40}{summary['status']:>8}{summary['peak_bytes'] / 1024:>12.1f}"
+                              f"{summary['retained_bytes'] / 1024:>14.1f}")
+            for site in summary["sites"]:
+                self.stdout.write(f"    {site['bytes'] / 1024:>9.1f} KiB {site['blocks']:>6} blocks  {site['site']}")
+        benchmark.write_json(options["output"], {"counts": counts, "routes": results})
+        self.stdout.write(f"Saved the results to {options['output']}")
+        problems = benchmark.find_over_budget(results, budgets, default_budget)
+        if problems:
+            for problem in problems:
+                self.stderr.write(problem)
+            raise CommandError(f"{len(problems)} route(s) went over their memory budget")
+        if budgets or default_budget is not None:
+            self.stdout.write(self.style.SUCCESS("Every route is within its memory budget"))
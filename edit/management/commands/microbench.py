@@ -0,0 +1,48 @@
+"""
+    This command times the small functions that run many times per page (see edit/microbenchmarks.py)
+    The results are saved as JSON, so a run from before a change can be used as the baseline for a run after it
+    If a baseline is given, any function whose median got slower than the tolerance allows is reported
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from edit import benchmark, microbenchmarks
+
+
+class Command(BaseCommand):
+    help = "Times formatters, template tags, and serializers, and compares them to an earlier run"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=20, help="How many rounds to time each function for")
+        parser.add_argument("--warmup", type=int, default=3, help="How many rounds to run before timing")
+        parser.add_argument("--round-time", type=float, default=0.01,
+                            help="How long (in seconds) each round should last at least")
+        parser.add_argument("--only", help="Only time functions with this text in their name")
+        parser.add_argument("--output", default="microbench-results.json", help="Where to save the results")
+        parser.add_argument("--baseline", help="Results from an earlier run to compare against")
+        parser.add_argument("--tolerance", type=float, default=1.1,
+                            help="How much slower (ex: 1.1 is 10%%) a function can get before it's a regression")
+
+    def handle(self, *args, **options):
+        if options["rounds"] < 1:
+            raise CommandError("--rounds must be at least 1")
+        results = microbenchmarks.run_cases(microbenchmarks.get_cases(), options["rounds"], options["warmup"],
+                                            options["round_time"], options["only"])
+        self.stdout.write(f"{'Function':<52}{'Calls':>8}{'Min us':>10}{'Median us':>11}{'Stdev us':>10}"
+                          f"{'p95 us':>10}")
+        for name, summary in results.items():
+            self.stdout.write(f"{name:<52}{summary['number']:>8}{summary['min_us']:>10}{summary['median_us']:>11}"
+                              f"{summary['stdev_us']:>10}{summary['p95_us']:>10}")
+        benchmark.write_json(options["output"], {"rounds": options["rounds"], "cases": results})
+        self.stdout.write(f"Saved the results to {options['output']}")
+        if options["baseline"]:
+            try:
+                baseline = benchmark.read_json(options["baseline"])
+            except (OSError, ValueError) as error:
+                raise CommandError(f"Couldn't read the baseline: {error}")
+            regressions = microbenchmarks.compare_to_baseline(results, baseline["cases"], options["tolerance"])
+            if regressions:
+                for regression in regressions:
+                    self.stderr.write(regression)
+                raise CommandError(f"{len(regressions)} regression(s) compared to {options['baseline']}")
+            self.stdout.write(self.style.SUCCESS("No regressions compared to the baseline"))
@@ -0,0 +1,23 @@
+"""
+    This command recalculates the media usage ledger from the files in MEDIA_ROOT
+    The ledger is updated whenever a photo is saved or deleted, but files can be changed outside the site
+    Run this once after updating, and then periodically (ex: as a scheduled task) to correct any drift
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from edit.forms import get_usage_by_folder
+from edit.models import MediaUsage
+
+
+class Command(BaseCommand):
+    help = "Recalculates how much space each folder in MEDIA_ROOT uses"
+
+    def handle(self, *args, **options):
+        usage = get_usage_by_folder(settings.MEDIA_ROOT)
+        drift = MediaUsage.reconcile(usage)
+        for folder, (folder_bytes, folder_files) in sorted(usage.items()):
+            self.stdout.write(f"{folder or '(root)'}: {filesizeformat(folder_bytes)} in {folder_files} file(s)")
+        self.stdout.write(f"The ledger was off by {drift} byte(s)")
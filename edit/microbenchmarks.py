@@ -0,0 +1,213 @@
+"""
+    This file times the small functions that run many times per page (formatters, template tags, and serializers)
+    Each case builds its input once at a realistic size, then the function is called in rounds
+    The number of calls per round is picked so a round is long enough for the clock to be accurate
+    The results (min, median, mean, standard deviation, and p95 per call) can be saved and compared across commits
+    None of the cases use the database, so this can run without a throwaway database
+"""
+
+import statistics
+import uuid
+from datetime import date, datetime, time, timedelta
+from time import perf_counter
+
+from django.db import models as model_fields
+from django.test import RequestFactory
+from django.utils import timezone
+
+from edit import forms, models, views, webcal
+from edit.benchmark import percentile
+from edit.templatetags import adminTags, eventTags
+from edit.validators import RequiredCharactersValidator
+from edit.view_set import formatters
+
+# How many events a month of the calendar has to look through, and how many rows an overview page shows
+CALENDAR_EVENTS = 200
+OVERVIEW_ROWS = 10
+
+
+def make_events(count):
+    """
+    Makes unsaved events, spread out over the weeks around today
+
+    @param count: How many events to make
+    @type count: int
+    @return: The events
+    @rtype: list[Event]
+    """
+
+    today = date.today()
+    events = []
+    for counter in range(count):
+        start = today + timedelta(days=counter * 3 - count * 3 // 2)
+        virtual = counter % 3 == 0
+        events.append(models.Event(id=uuid.uuid4(), name=f"Micro Event {counter}",
+                                   description="A generated event " * 25, startDate=start,
+                                   endDate=start + timedelta(days=counter % 3), startTime=time(9, 0),
+                                   endTime=time(17, 0), virtual=virtual,
+                                   location="" if virtual else "123 Example Street, Reading, PA 19601",
+                                   link="https://example.org/meeting" if virtual else "",
+                                   last_modified=timezone.now()))
+    return events
+
+
+def get_cases():
+    """
+    Builds every case, the inputs are made here so making them isn't part of the timing
+
+    @return: A dict that maps each case's name to a function that takes no arguments
+    @rtype: dict
+    """
+
+    events = make_events(CALENDAR_EVENTS)
+    event = events[1]
+    officer = models.Officer(id=uuid.uuid4(), first_name="Micro", last_name="Officer", title="President",
+                             email="president.berks.dental@example.org", phone="(555) 555-5555")
+    event_view_set = views.EventViewSet()
+    # These are shaped like get_overview_values' rows, with the link the location column is computed from
+    event_rows = [{"name": f"Micro Event {counter}", "virtual": counter % 2 == 0, "location": "123 Example Street",
+                   "link": "https://example.org/meeting", "startDate": date(2021, 5, counter + 1),
+                   "endDate": date(2021, 5, counter + 2), "id": uuid.uuid4()} for counter in range(OVERVIEW_ROWS)]
+    photo_view_set = views.GalleryPhotoViewSet()
+    photo_rows = [{"caption": f"A caption for photo {counter}",
+                   "picture": f"galleryphoto-pictures/{uuid.uuid4()}.jpg", "featured": counter % 2 == 0,
+                   "id": uuid.uuid4()} for counter in range(OVERVIEW_ROWS)]
+    request = RequestFactory().get("/admin/", {"alert": "Saved Successfully", "alertType": "success"})
+    photo_form = forms.PhotoForm()
+    event_form = forms.EventForm()
+    validator = RequiredCharactersValidator(min_special=1)
+    calendar_context = {"events": events, "date": date.today()}
+    date_context = {"day": 15, "month": 6, "year": 2021}
+    now = datetime.now()
+
+    return {
+        "formatters.URLField": lambda: formatters[model_fields.URLField]("https://example.org/some/long/path?q=1"),
+        "formatters.ImageField": lambda: formatters[model_fields.ImageField]("galleryphoto-pictures/photo.jpg"),
+        "formatters.BooleanField": lambda: formatters[model_fields.BooleanField](True),
+        "formatters.TimeField": lambda: formatters[model_fields.TimeField](now.time()),
+        "formatters.DateField": lambda: formatters[model_fields.DateField](now.date()),
+        f"EventViewSet.format_overview_rows ({OVERVIEW_ROWS} rows)": lambda: event_view_set.format_overview_rows(
+            event_rows),
+        f"GalleryPhotoViewSet.format_overview_rows ({OVERVIEW_ROWS} rows)":
+            lambda: photo_view_set.format_overview_rows(photo_rows),
+        "eventTags.makeDateObj": lambda: eventTags.make_date_obj(date_context),
+        f"eventTags.getEventsOnDate ({CALENDAR_EVENTS} events)": lambda: eventTags.get_events_on_day(
+            calendar_context),
+        "adminTags.action": lambda: adminTags.action("Edit Item", "/admin/edit/event/", "fa-edit", show_name=True),
+        "adminTags.homeTile": lambda: adminTags.home_tile("/admin/overview/event/", "calendar-alt", "events"),
+        "adminTags.getAlertIcon": lambda: adminTags.get_alert_icon(request),
+        "adminTags.is_checkbox": lambda: adminTags.is_checkbox(photo_form["featured"]),
+        "adminTags.needs_multi_part (no photo)": lambda: adminTags.needs_multipart(event_form),
+        "Event.as_json_script": event.as_json_script,
+        "Officer.masked_email_link": officer.masked_email_link,
+        "webcal.make_calendar_event": lambda: webcal.make_calendar_event(event),
+        "RequiredCharactersValidator.validate": lambda: validator.validate("Berks-Dental-Password-2021"),
+    }
+
+
+def calibrate(function, minimum_round_time):
+    """
+    Finds how many calls make a round last at least minimum_round_time, like timeit's autorange
+
+    @param function: The function to call
+    @type function: function
+    @param minimum_round_time: How long a round should last, in seconds
+    @type minimum_round_time: float
+    @return: How many calls to make in each round
+    @rtype: int
+    """
+
+    number = 1
+    while True:
+        if time_round(function, number) >= minimum_round_time:
+            return number
+        number *= 2
+
+
+def time_round(function, number):
+    """
+    Calls a function number times in a row
+
+    @return: How long all the calls took, in seconds
+    @rtype: float
+    """
+
+    calls = range(number)
+    start = perf_counter()
+    for _ in calls:
+        function()
+    return perf_counter() - start
+
+
+def time_case(function, rounds=20, warmup=3, minimum_round_time=0.01):
+    """
+    Times a function, times are per call and converted to microseconds
+
+    @param function: The function to time
+    @type function: function
+    @param rounds: How many rounds to measure
+    @type rounds: int
+    @param warmup: How many rounds to run before measuring
+    @type warmup: int
+    @param minimum_round_time: How long each round should last, in seconds
+    @type minimum_round_time: float
+    @return: The summary
+    @rtype: dict
+    """
+
+    number = calibrate(function, minimum_round_time)
+    for _ in range(warmup):
+        time_round(function, number)
+    per_call = [time_round(function, number) / number * 1000000 for _ in range(rounds)]
+    return {
+        "number": number,
+        "rounds": rounds,
+        "min_us": round(min(per_call), 3),
+        "median_us": round(statistics.median(per_call), 3),
+        "mean_us": round(statistics.mean(per_call), 3),
+        "stdev_us": round(statistics.stdev(per_call), 3) if rounds > 1 else 0,
+        "p95_us": round(percentile(per_call, 0.95), 3),
+    }
+
+
+def run_cases(cases, rounds=20, warmup=3, minimum_round_time=0.01, only=None):
+    """
+    Times each case
+
+    @param cases: The cases (see get_cases)
+    @type cases: dict
+    @param only: Only time cases with this text in their name
+    @type only: str
+    @return: A dict that maps each case's name to its summary
+    @rtype: dict
+    """
+
+    return {name: time_case(function, rounds, warmup, minimum_round_time) for name, function in cases.items()
+            if only is None or only.lower() in name.lower()}
+
+
+def compare_to_baseline(results, baseline, tolerance, minimum_us=0.05):
+    """
+    Finds cases whose median got slower than it was in the baseline
+
+    @param results: The cases timed now
+    @type results: dict
+    @param baseline: The cases timed before
+    @type baseline: dict
+    @param tolerance: How much slower a case can be before it counts (ex: 1.1 allows 10% slower)
+    @type tolerance: float
+    @param minimum_us: A case has to be at least this many microseconds slower to count, to ignore noise
+    @type minimum_us: float
+    @return: A description of each regression
+    @rtype: list[str]
+    """
+
+    regressions = []
+    for name, summary in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        slower_by = summary["median_us"] - before["median_us"]
+        if summary["median_us"] > before["median_us"] * tolerance and slower_by >= minimum_us:
+            regressions.append(f"{name}: median went from {before['median_us']}us to {summary['median_us']}us")
+    return regressions
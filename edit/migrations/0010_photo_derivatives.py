@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-16 20:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edit', '0009_auto_20210425_1134'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='galleryphoto',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='officer',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
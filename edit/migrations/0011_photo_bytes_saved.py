@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-16 20:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edit', '0010_photo_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='galleryphoto',
+            name='bytes_saved',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='officer',
+            name='bytes_saved',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
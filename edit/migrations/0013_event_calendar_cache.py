@@ -0,0 +1,25 @@
+# Generated by Django 3.2.9 on 2026-10-16 21:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edit', '0012_mediausage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='event',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='ical_component',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+    ]
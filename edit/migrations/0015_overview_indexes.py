@@ -0,0 +1,34 @@
+# Generated by Django 3.2.9 on 2026-10-16 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('edit', '0014_modelversion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email'], name='edit_user_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='galleryphoto',
+            index=models.Index(fields=['-date_posted'], name='edit_photo_posted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='galleryphoto',
+            index=models.Index(fields=['featured', '-date_posted'], name='edit_photo_featured_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['-startDate', '-endDate', '-startTime', '-endTime'],
+                               name='edit_event_ordering_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(fields=['name'], name='edit_event_name_idx'),
+        ),
+    ]
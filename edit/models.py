@@ -8,9 +8,12 @@ from json import dumps
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from django.forms import ValidationError
 from django.template.defaultfilters import escape
+from django.utils import timezone
+
+from edit.images import optimize_upload
 
 
 class OrderedMixin(models.Model):
@@ -47,6 +50,22 @@ class PhotoMixin(models.Model):
     width = models.IntegerField()
     height = models.IntegerField()
     picture = models.ImageField(upload_to=get_upload_to, width_field='width', height_field='height')
+    # The smaller copies of the picture, see edit/images.py
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    # How many bytes we saved by re-compressing the picture when it was uploaded
+    bytes_saved = models.IntegerField(default=0, editable=False)
+
+    def save(self, *args, **kwargs):
+        """
+        If a new picture was uploaded, we process it (rotate, shrink, strip metadata, re-compress) before saving
+        """
+
+        if self.picture and not self.picture._committed:
+            optimized_file, bytes_saved = optimize_upload(self.picture.file)
+            if optimized_file is not None:
+                self.picture = optimized_file
+                self.bytes_saved = bytes_saved
+        super().save(*args, **kwargs)
 
     def get_extension(self):
         """
@@ -68,6 +87,56 @@ class PhotoMixin(models.Model):
 
         return f"{settings.MEDIA_URL}{self.picture.name}"
 
+    def derivative_link(self, size_name, image_format="jpeg"):
+        """
+        This function provides a link to a smaller copy of the image
+
+        @param size_name: The name of the size to get (grid, medium, or large)
+        @type size_name: str
+        @param image_format: The format to get (jpeg or webp)
+        @type image_format: str
+        @return: The url of the copy, or None if there isn't one
+        @rtype: str
+        """
+
+        name = self.derivatives.get(size_name, {}).get(image_format)
+        return None if name is None else f"{settings.MEDIA_URL}{name}"
+
+    def thumb_link(self):
+        """
+        This function provides a link to the smallest copy of the image, for use in grids
+        If the copies haven't been made, we use the original image
+
+        @return: The url of the thumbnail
+        @rtype: str
+        """
+
+        return self.derivative_link("grid") or self.photo_link()
+
+    def srcset(self, image_format="jpeg"):
+        """
+        This function provides every copy of the image as a srcset attribute
+        So the browser can pick the smallest one that fits
+
+        @param image_format: The format to use (jpeg or webp)
+        @type image_format: str
+        @return: The value for a srcset attribute, empty if the copies haven't been made
+        @rtype: str
+        """
+
+        return ", ".join(f"{settings.MEDIA_URL}{entry[image_format]} {entry['width']}w"
+                         for entry in self.derivatives.values() if image_format in entry)
+
+    def webp_srcset(self):
+        """
+        A shortcut for srcset("webp"), as templates can't pass arguments
+
+        @return: The value for a srcset attribute, empty if the copies haven't been made
+        @rtype: str
+        """
+
+        return self.srcset("webp")
+
     class Meta:
         abstract = True
 
@@ -103,6 +172,10 @@ class User(AbstractUser):
         else:
             return self.username
 
+    class Meta(AbstractUser.Meta):
+        # Lets the user overview sort users by email without scanning the table (searching still scans)
+        indexes = [models.Index(fields=["email"], name="edit_user_email_idx")]
+
 
 class GalleryPhoto(PhotoMixin, BaseModel):
     """
@@ -126,6 +199,11 @@ class GalleryPhoto(PhotoMixin, BaseModel):
 
     class Meta:
         ordering = ['-date_posted']
+        # These let the gallery and the photo overview page through photos (all of them, or just featured ones) in order
+        indexes = [
+            models.Index(fields=["-date_posted"], name="edit_photo_posted_idx"),
+            models.Index(fields=["featured", "-date_posted"], name="edit_photo_featured_idx"),
+        ]
 
 
 class ExternalLink(OrderedMixin, BaseModel):
@@ -161,6 +239,9 @@ class Event(BaseModel):
     endDate = models.DateField()
     startTime = models.TimeField()
     endTime = models.TimeField()
+    last_modified = models.DateTimeField(auto_now=True)
+    # This event serialized as a VEVENT, so we don't need to rebuild every event when one changes (see webcal.py)
+    ical_component = models.TextField(blank=True, default="", editable=False)
 
     def clean(self):
         """
@@ -218,6 +299,11 @@ class Event(BaseModel):
 
     class Meta:
         ordering = ["-startDate", "-endDate", "-startTime", "-endTime"]
+        # These let the event overview page through events in order, and sort them by name
+        indexes = [
+            models.Index(fields=["-startDate", "-endDate", "-startTime", "-endTime"], name="edit_event_ordering_idx"),
+            models.Index(fields=["name"], name="edit_event_name_idx"),
+        ]
 
 
 class Officer(OrderedMixin, PhotoMixin, BaseModel):
@@ -336,3 +422,128 @@ class Social(OrderedMixin, BaseModel):
         """
 
         return f"Berks Dental Assistants' {self.service_label()} Page"
+
+
+class MediaUsage(BaseModel):
+    """
+    This class keeps a running total of how much space each folder in MEDIA_ROOT uses
+    It's updated whenever we save or delete a file, so checking the quota doesn't need to walk the whole folder
+    The reconcile_media_usage command recalculates it from the files on disk in case it drifts
+    """
+
+    folder = models.CharField(max_length=255, unique=True)
+    bytes = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def record(cls, folder, bytes_change, files_change):
+        """
+        Adds to (or subtracts from) the usage of a folder
+
+        @param folder: The folder, relative to MEDIA_ROOT
+        @type folder: str
+        @param bytes_change: How many bytes were added (negative if they were removed)
+        @type bytes_change: int
+        @param files_change: How many files were added (negative if they were removed)
+        @type files_change: int
+        """
+
+        cls.objects.get_or_create(folder=folder)
+        cls.objects.filter(folder=folder).update(bytes=models.F("bytes") + bytes_change,
+                                                 files=models.F("files") + files_change,
+                                                 updated=timezone.now())
+
+    @classmethod
+    def reconcile(cls, usage):
+        """
+        Replaces the ledger with usage that was measured from the files on disk
+
+        @param usage: A dict that maps each folder to its size in bytes and number of files
+        @type usage: dict
+        @return: How many bytes the ledger was off by
+        @rtype: int
+        """
+
+        with transaction.atomic():
+            drift = sum(folder_bytes for folder_bytes, folder_files in usage.values()) - cls.total_bytes()
+            cls.objects.exclude(folder__in=usage.keys()).delete()
+            for folder, (folder_bytes, folder_files) in usage.items():
+                cls.objects.update_or_create(folder=folder, defaults={"bytes": folder_bytes, "files": folder_files})
+        return drift
+
+    @classmethod
+    def total_bytes(cls):
+        """
+        Gets how many bytes are used across all folders
+
+        @return: The total amount of bytes used
+        @rtype: int
+        """
+
+        return cls.objects.aggregate(total=models.Sum("bytes"))["total"] or 0
+
+    def __str__(self):
+        """
+        Defines how this object will be cast to a string
+
+        @return: The folder this object tracks
+        @rtype: str
+        """
+
+        return self.folder
+
+    class Meta:
+        ordering = ["folder"]
+
+
+class ModelVersion(BaseModel):
+    """
+    This class keeps a version number for each model, which goes up every time an object of that model changes
+    The site runs in multiple processes, so caches build their keys from these versions instead of clearing themselves
+    That way, a change made in one process is seen by every process on their next request
+    """
+
+    label = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def bump(cls, label):
+        """
+        Increases the version of a model
+
+        @param label: The "app.Model" label of the model that changed
+        @type label: str
+        """
+
+        cls.objects.get_or_create(label=label)
+        cls.objects.filter(label=label).update(version=models.F("version") + 1, updated=timezone.now())
+
+    @classmethod
+    def get_versions(cls, labels):
+        """
+        Gets the version of multiple models in one query, models that have never changed are at version 0
+
+        @param labels: The "app.Model" labels of the models to check
+        @type labels: list[str]
+        @return: A dict that maps each label to its version and when it last changed (None if it never changed)
+        @rtype: dict
+        """
+
+        found = {label: (version, updated) for label, version, updated in
+                 cls.objects.filter(label__in=labels).values_list("label", "version", "updated")}
+        return {label: found.get(label, (0, None)) for label in labels}
+
+    def __str__(self):
+        """
+        Defines how this object will be cast to a string
+
+        @return: The label of the model and its version
+        @rtype: str
+        """
+
+        return f"{self.label} v{self.version}"
+
+    class Meta:
+        ordering = ["label"]
@@ -0,0 +1,219 @@
+"""
+    This file contains helpers for keyset (or "cursor") pagination
+    Instead of counting rows and skipping them with OFFSET, we remember the sort values of the last row we sent
+    The next page is then every row that comes after those values, which the database can find with an index
+    To make sure every row has a unique position, the primary key is always used as the final sort field
+"""
+
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from uuid import UUID
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def get_keyset_ordering(model, ordering=None):
+    """
+    Gets the fields to sort by for keyset pagination, the primary key is added to break ties
+
+    @param model: The model we're paginating
+    @type model: class:`django.db.models.Model`
+    @param ordering: The ordering to use, defaults to the model's Meta.ordering
+    @type ordering: list[str]
+    @return: A list of field names, prefixed with "-" if they're sorted in descending order
+    @rtype: list[str]
+    """
+
+    if ordering is None:
+        ordering = model._meta.ordering
+    ordering = list(ordering)
+    pk_name = model._meta.pk.name
+    if pk_name not in [field.lstrip("-") for field in ordering]:
+        descending = len(ordering) > 0 and ordering[-1].startswith("-")
+        ordering.append(f"-{pk_name}" if descending else pk_name)
+    return ordering
+
+
+def reverse_ordering(ordering):
+    """
+    Flips the direction of every field in an ordering, used to page backwards
+
+    @param ordering: The ordering to flip
+    @type ordering: list[str]
+    @return: The flipped ordering
+    @rtype: list[str]
+    """
+
+    return [field[1:] if field.startswith("-") else f"-{field}" for field in ordering]
+
+
+def keyset_filter(ordering, values):
+    """
+    Builds a filter that matches every row that comes after the given values in the given ordering
+    For an ordering of (a, b) this is: a > value_a OR (a = value_a AND b > value_b)
+
+    @param ordering: The keyset ordering (see get_keyset_ordering)
+    @type ordering: list[str]
+    @param values: The values of the row to start after, these can also be expressions like OuterRef
+    @type values: list
+    @return: A filter to apply to the queryset
+    @rtype: Q
+    """
+
+    result = Q()
+    equal_so_far = Q()
+    for field, value in zip(ordering, values):
+        name = field.lstrip("-")
+        lookup = "lt" if field.startswith("-") else "gt"
+        result |= equal_so_far & Q(**{f"{name}__{lookup}": value})
+        equal_so_far &= Q(**{name: value})
+    return result
+
+
+def get_row_values(row, ordering):
+    """
+    Reads the sort values from a row
+
+    @param row: The model instance or dict to read from
+    @type row: Model or dict
+    @param ordering: The keyset ordering
+    @type ordering: list[str]
+    @return: The values of the sort fields
+    @rtype: list
+    """
+
+    names = [field.lstrip("-") for field in ordering]
+    if isinstance(row, dict):
+        return [row[name] for name in names]
+    else:
+        return [getattr(row, name) for name in names]
+
+
+def serialize_value(value):
+    """
+    Converts a sort value into something we can store in JSON, this keeps microseconds unlike DjangoJSONEncoder
+
+    @param value: The value to convert
+    @return: A JSON safe version of the value
+    """
+
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    elif isinstance(value, UUID):
+        return str(value)
+    else:
+        return value
+
+
+def encode_cursor(row, ordering):
+    """
+    Creates an opaque cursor that points to the position just after a row
+
+    @param row: The last row of the current page
+    @type row: Model or dict
+    @param ordering: The keyset ordering
+    @type ordering: list[str]
+    @return: A URL safe cursor string
+    @rtype: str
+    """
+
+    raw = json.dumps([serialize_value(value) for value in get_row_values(row, ordering)], separators=(",", ":"))
+    return urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(model, ordering, cursor):
+    """
+    Reads the values back out of a cursor made by encode_cursor
+
+    @param model: The model the cursor was made for
+    @type model: class:`django.db.models.Model`
+    @param ordering: The keyset ordering
+    @type ordering: list[str]
+    @param cursor: The cursor string
+    @type cursor: str
+    @return: The sort values stored in the cursor
+    @rtype: list
+    @raise ValueError: If the cursor is malformed
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw_values = json.loads(urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+        if not isinstance(raw_values, list) or len(raw_values) != len(ordering):
+            raise ValueError("Cursor doesn't match the ordering")
+        return [model._meta.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(ordering, raw_values)]
+    except (Base64Error, UnicodeError, json.JSONDecodeError, ValidationError, TypeError, ValueError) as error:
+        raise ValueError(f"Invalid cursor: {error}")
+
+
+def get_keyset_page(queryset, ordering, size, cursor=None):
+    """
+    Gets a page of rows that come after a cursor, along with the cursor for the following page
+    We fetch one extra row to know if there's another page, so we never need to COUNT the table
+
+    @param queryset: The rows to paginate
+    @type queryset: QuerySet
+    @param ordering: The keyset ordering
+    @type ordering: list[str]
+    @param size: How many rows to put on the page
+    @type size: int
+    @param cursor: The cursor to start after, None to start at the beginning
+    @type cursor: str
+    @return: The rows on this page, and the cursor for the next page (None if this is the last page)
+    @rtype: list, str
+    @raise ValueError: If the cursor is malformed
+    """
+
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(keyset_filter(ordering, decode_cursor(queryset.model, ordering, cursor)))
+    rows = list(queryset[:size + 1])
+    if len(rows) > size:
+        rows = rows[:size]
+        return rows, encode_cursor(rows[-1], ordering)
+    else:
+        return rows, None
+
+
+def get_keyset_window(queryset, ordering, size, after=None, before=None):
+    """
+    Gets a page of rows that come after (or before) a cursor, along with the cursors for the pages on either side
+    Paging backwards flips the ordering, fetches the rows just before the cursor, and then puts them back in order
+    Like get_keyset_page, this fetches one extra row instead of counting the table
+
+    @param queryset: The rows to paginate
+    @type queryset: QuerySet
+    @param ordering: The keyset ordering
+    @type ordering: list[str]
+    @param size: How many rows to put on the page
+    @type size: int
+    @param after: The cursor to start after, for the next page
+    @type after: str
+    @param before: The cursor to end before, for the previous page
+    @type before: str
+    @return: The rows on this page, the cursor for the previous page, and the cursor for the next page
+    (the cursors are None if there's no page in that direction)
+    @rtype: list, str, str
+    @raise ValueError: If a cursor is malformed
+    """
+
+    if before:
+        backwards = reverse_ordering(ordering)
+        queryset = queryset.order_by(*backwards).filter(
+            keyset_filter(backwards, decode_cursor(queryset.model, ordering, before)))
+        rows = list(queryset[:size + 1])
+        has_previous, has_next = len(rows) > size, True
+        rows = rows[:size][::-1]
+    else:
+        queryset = queryset.order_by(*ordering)
+        if after:
+            queryset = queryset.filter(keyset_filter(ordering, decode_cursor(queryset.model, ordering, after)))
+        rows = list(queryset[:size + 1])
+        has_previous, has_next = bool(after), len(rows) > size
+        rows = rows[:size]
+    previous_cursor = encode_cursor(rows[0], ordering) if has_previous and rows else None
+    next_cursor = encode_cursor(rows[-1], ordering) if has_next and rows else None
+    return rows, previous_cursor, next_cursor
@@ -0,0 +1,56 @@
+"""
+    This file bumps the version of a model whenever an object of it is saved or deleted
+    This is how cached pages are dropped after any change, from the admin site or anywhere else (like the shell)
+    Only bulk changes (like update() and bulk_update()) skip these signals, those call invalidate_pages themselves
+    It also keeps each event's stored VEVENT up to date, however the event was saved
+"""
+
+from django.db.models.signals import post_save, post_delete
+
+from edit.models import Event, ModelVersion
+from edit.webcal import refresh_event_component
+
+# These models are bookkeeping, and changing them doesn't change anything a visitor sees
+UNVERSIONED_MODELS = ("edit.ModelVersion", "edit.MediaUsage")
+
+
+def bump_model_version(sender, raw=False, **kwargs):
+    """
+    This receiver bumps the version of the model that was saved or deleted
+    Objects loaded from fixtures (raw, like with loaddata) are skipped, as nothing has been cached for them yet
+
+    @param sender: The model class that changed
+    @type sender: class:`django.db.models.Model`
+    @param raw: Whether the object is being loaded as-is (only sent for saves)
+    @type raw: bool
+    """
+
+    if not raw and sender._meta.app_label == "edit" and sender._meta.label not in UNVERSIONED_MODELS:
+        ModelVersion.bump(sender._meta.label)
+
+
+def refresh_calendar_component(sender, instance, raw=False, **kwargs):
+    """
+    This receiver re-serializes an event's VEVENT after it's saved, so the calendar never serves an old one
+    Events loaded from fixtures (raw) already have their component
+
+    @param sender: The Event model
+    @type sender: class:`django.db.models.Model`
+    @param instance: The event that was saved
+    @type instance: Event
+    @param raw: Whether the event is being loaded as-is (like with loaddata)
+    @type raw: bool
+    """
+
+    if not raw:
+        refresh_event_component(instance)
+
+
+def connect_signals():
+    """
+    Connects bump_model_version to the save and delete signals, and refresh_calendar_component to events being saved
+    """
+
+    post_save.connect(bump_model_version, dispatch_uid="bump_model_version_save")
+    post_delete.connect(bump_model_version, dispatch_uid="bump_model_version_delete")
+    post_save.connect(refresh_calendar_component, sender=Event, dispatch_uid="refresh_calendar_component")
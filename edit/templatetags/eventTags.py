@@ -32,7 +32,8 @@ def make_date_obj(context):
 @register.simple_tag(name="getEventsOnDate", takes_context=True)
 def get_events_on_day(context):
     """
-    This function is used to get events on a given day
+    This function is used to get events on a given day, including days in the middle of multi-day events
+    The events views build an index of events by date instead, as this scans every event
 
     @param context: A dict that should contain a date we can check, and a list of events to pull from
     @type context: dict
@@ -44,6 +45,6 @@ def get_events_on_day(context):
     events = context.get("events")
     date_obj = context.get("date")
     for event in events:
-        if event.startDate == date_obj or event.endDate == date_obj:
+        if event.startDate <= date_obj <= event.endDate:
             results.append(event)
     return results
@@ -14,6 +14,8 @@ urlpatterns = [
     path('login/', LoginView.as_view(template_name="login.html", redirect_authenticated_user=True,
                                      extra_context={'hide_home': True}), name="login"),
     path('logout/', LogoutView.as_view(), name="logout"),
+    path('profiles/', views.profiles, name="profiles"),
+    path('profiles/view/', views.profile_detail, name="profile"),
     path('help/', safe_render("help/home.html", ctx={"back_link": "/admin/"}), name="help"),
     views.help_page("navigation", "Navigation"),
     views.help_page("edit", "Editing And Adding"),
@@ -5,21 +5,29 @@
     Classes that inherit from the base class must specify a model, and a form to use
 """
 
+import itertools
 from uuid import UUID
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.exceptions import FieldDoesNotExist
 from django.core.paginator import Paginator
-from django.db import models as model_fields
+from django.db import models as model_fields, transaction
+from django.db.models import F, Q
 from django.forms import ValidationError
 from django.http import Http404
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template.defaultfilters import slugify, escape
 from django.urls import reverse
+from django.utils.http import urlencode
 from django.views.decorators.http import require_safe, require_http_methods
 
 from edit import forms, exceptions
+from edit.pagination import get_keyset_ordering, get_keyset_window
+from main.cache import get_model_label, get_versions, invalidate_pages
+
+COUNT_KEY_PREFIX = "overview-count"
 
 formatters = {
     model_fields.URLField: lambda input_val: f'<a class="link-value" rel="noopener" target="_blank"'
@@ -43,6 +51,32 @@ class Action:
         self.link = link
 
 
+class ComputedColumn:
+    """
+    A display column that's worked out from the rest of the row, instead of being shown as it's stored
+    The extra fields and annotations are fetched in the same query as the display fields, so no query is run per row
+
+    @type compute: function
+    @type fields: list(str)
+    @type annotations: dict
+    """
+
+    def __init__(self, compute, fields=(), annotations=None):
+        """
+        @param compute: A function that's given the row as a dict (display fields, extra fields, annotations, and id)
+        and returns the value to show, the value isn't escaped by the template
+        @type compute: function
+        @param fields: Extra model fields the function needs
+        @type fields: list[str]
+        @param annotations: Extra values the function needs, that the database works out (name -> expression)
+        @type annotations: dict
+        """
+
+        self.compute = compute
+        self.fields = list(fields)
+        self.annotations = annotations or {}
+
+
 class ViewSet:
     """ A class used to manage and render models easily, this class is meant to be inherited
 
@@ -52,6 +86,12 @@ class ViewSet:
     @type ordered: bool
     @type displayFields: list(str)
     @type labels: str
+    @type computedColumns: dict
+    @type keysetPagination: bool
+    @type cachedCount: bool
+    @type searchFields: list(str)
+    @type filterFields: list(str)
+    @type sortFields: list(str)
     """
 
     displayName: str = "base"
@@ -63,6 +103,17 @@ class ViewSet:
     per_page: int = 10
     displayFields: list = []
     labels: dict = {}
+    computedColumns: dict = {}
+    # Page through the overview by the model's ordering (see edit/pagination.py) instead of counting and skipping rows
+    keysetPagination: bool = False
+    # Cache the number of objects until the model changes, instead of counting them on every overview page
+    cachedCount: bool = False
+    # Fields the overview's search box looks in, fields it can be filtered by, and display fields it can be sorted by
+    # A search matches anywhere in the field (icontains), which no index can serve, so it scans the (filtered) rows
+    # The overview indexes in edit/models.py are only for sorting and filtering
+    searchFields: list = []
+    filterFields: list = []
+    sortFields: list = []
 
     def __init__(self):
         """
@@ -77,14 +128,30 @@ class ViewSet:
             raise exceptions.ImproperlyConfiguredViewSetError("No Model Form Set")
 
         self.format_list = []
+        self.value_fields = []
 
         for field in self.displayFields:
             try:
                 field_object = self.model._meta.get_field(field)
                 self.format_list.append(formatters.get(type(field_object), lambda input_val: str(input_val)))
+                self.value_fields.append(field)
             except FieldDoesNotExist:
-                raise exceptions.ImproperlyConfiguredViewSetError(f"No Field Named: {field} "
-                                                                  f"(double-check displayFields)")
+                if field not in self.computedColumns:
+                    raise exceptions.ImproperlyConfiguredViewSetError(f"No Field Named: {field} "
+                                                                      f"(double-check displayFields)")
+                # Columns that only exist as computed columns are filled in after formatting
+                self.format_list.append(lambda input_val: input_val)
+
+        for name, column in self.computedColumns.items():
+            if name not in self.displayFields:
+                raise exceptions.ImproperlyConfiguredViewSetError(f"{name} is a computed column, but it is not"
+                                                                  f" included in displayFields (computedColumns)")
+            for field in column.fields:
+                try:
+                    self.model._meta.get_field(field)
+                except FieldDoesNotExist:
+                    raise exceptions.ImproperlyConfiguredViewSetError(f"Computed Column {name} Uses Unknown Field:"
+                                                                      f" {field}")
 
         if self.ordered:
             try:
@@ -104,7 +171,20 @@ class ViewSet:
                                                                       f" but it is not included in displayFields"
                                                                       f" (labels)")
             except FieldDoesNotExist:
-                raise exceptions.ImproperlyConfiguredViewSetError(f"Labels Contains Unknown Field: {field}")
+                if field not in self.computedColumns:
+                    raise exceptions.ImproperlyConfiguredViewSetError(f"Labels Contains Unknown Field: {field}")
+
+        for field in self.searchFields + self.filterFields:
+            try:
+                self.model._meta.get_field(field)
+            except FieldDoesNotExist:
+                raise exceptions.ImproperlyConfiguredViewSetError(f"No Field Named: {field} "
+                                                                  f"(double-check searchFields and filterFields)")
+
+        for field in self.sortFields:
+            if field not in self.value_fields:
+                raise exceptions.ImproperlyConfiguredViewSetError(f"{field} can't be sorted by, as it's not a model"
+                                                                  f" field in displayFields (sortFields)")
 
         for action in self.additionalActions:
             if action.__class__.__name__ != "Action":
@@ -128,6 +208,185 @@ class ViewSet:
 
         return new_value_list
 
+    def get_overview_values(self, queryset, extra_fields=()):
+        """
+        Picks the values the overview needs from the objects, so they're all fetched in one query
+        That's the display fields, the fields and annotations computed columns need, and the id
+
+        @param queryset: The objects to show
+        @type queryset: QuerySet
+        @param extra_fields: Other fields to fetch (like the fields used for keyset pagination)
+        @type extra_fields: list[str]
+        @return: A queryset of dicts
+        @rtype: QuerySet
+        """
+
+        value_fields = self.value_fields.copy()
+        annotations = {}
+        for column in self.computedColumns.values():
+            value_fields += [field for field in column.fields if field not in value_fields]
+            annotations.update(column.annotations)
+        value_fields += [field for field in extra_fields if field not in value_fields and field != 'id']
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return queryset.values(*value_fields, *annotations.keys(), 'id')
+
+    def format_overview_rows(self, rows):
+        """
+        Formats the rows fetched with get_overview_values, then fills in the computed columns
+
+        @param rows: The rows to format
+        @type rows: list[dict]
+        @return: A list of rows, each one is a list of the values to show, followed by the object's id
+        @rtype: list[list]
+        """
+
+        new_value_list = self.format_value_list([[row.get(field) for field in self.displayFields] + [row['id']]
+                                                 for row in rows])
+        for row, formatted_row in zip(rows, new_value_list):
+            for name, column in self.computedColumns.items():
+                formatted_row[self.displayFields.index(name)] = column.compute(row)
+        return new_value_list
+
+    def get_overview_rows(self, queryset):
+        """
+        Fetches the rows to show in the overview in one query, and formats them
+
+        @param queryset: The objects to show
+        @type queryset: QuerySet
+        @return: A list of rows, each one is a list of the values to show, followed by the object's id
+        @rtype: list[list]
+        """
+
+        return self.format_overview_rows(list(self.get_overview_values(queryset)))
+
+    def get_filter_choices(self, field):
+        """
+        Gets the values a field can be filtered by
+
+        @param field: The name of the field
+        @type field: str
+        @return: A list of (value, label) tuples, or None if any value can be typed in
+        @rtype: list[tuple]
+        """
+
+        field_object = self.model._meta.get_field(field)
+        if isinstance(field_object, model_fields.BooleanField):
+            return [("yes", "Yes"), ("no", "No")]
+        elif field_object.choices:
+            return [(str(value), label) for value, label in field_object.flatchoices]
+        else:
+            return None
+
+    def get_overview_state(self, request):
+        """
+        Reads the search, filters, and sort out of the query string, anything that isn't allowed is left out
+
+        @param request: A django request object
+        @type request: HttpRequest
+        @return: A dict of the query parameters to keep in the overview's links
+        @rtype: dict
+        """
+
+        state = {}
+        search = request.GET.get("q", "").strip()
+        if search and self.searchFields:
+            state["q"] = search
+        for field in self.filterFields:
+            value = request.GET.get(f"filter_{field}", "")
+            choices = self.get_filter_choices(field)
+            if value != "" and (choices is None or value in [choice for choice, label in choices]):
+                state[f"filter_{field}"] = value
+        sort = request.GET.get("sort", "")
+        if sort.lstrip("-") in self.sortFields:
+            state["sort"] = sort
+        return state
+
+    def filter_overview(self, queryset, state):
+        """
+        Applies the search and filters in the overview's state to a queryset
+
+        @param queryset: The objects to filter
+        @type queryset: QuerySet
+        @param state: The overview's state (see get_overview_state)
+        @type state: dict
+        @return: The filtered queryset
+        @rtype: QuerySet
+        """
+
+        if "q" in state:
+            search = Q()
+            for field in self.searchFields:
+                search |= Q(**{f"{field}__icontains": state["q"]})
+            queryset = queryset.filter(search)
+        for field in self.filterFields:
+            value = state.get(f"filter_{field}")
+            if value is not None:
+                if isinstance(self.model._meta.get_field(field), model_fields.BooleanField):
+                    value = value == "yes"
+                queryset = queryset.filter(**{field: value})
+        return queryset
+
+    def overview_state_link(self, state, **params):
+        """
+        Gets a link to the overview that keeps the search, filters, and sort
+
+        @param state: The overview's state (see get_overview_state)
+        @type state: dict
+        @param params: Other query parameters to add (like the page)
+        @return: The link
+        @rtype: str
+        """
+
+        query = {**state, **params}
+        return f"{self.overview_link()}?{urlencode(query)}" if query else self.overview_link()
+
+    def get_overview_headers(self, state):
+        """
+        Gets each column's header, along with the link to sort by it and the icon to show next to it
+
+        @param state: The overview's state (see get_overview_state)
+        @type state: dict
+        @return: A list of (label, sort link, sort icon) tuples, the link and icon are None if it can't be sorted by
+        @rtype: list[tuple]
+        """
+
+        headers = []
+        current_sort = state.get("sort", "")
+        for field in self.displayFields:
+            label = self.labels.get(field, field)
+            if field in self.sortFields:
+                if current_sort == field:
+                    sort, icon = f"-{field}", "fa-sort-up"
+                elif current_sort == f"-{field}":
+                    sort, icon = field, "fa-sort-down"
+                else:
+                    sort, icon = field, "fa-sort"
+                headers.append((label, self.overview_state_link({**state, "sort": sort}), icon))
+            else:
+                headers.append((label, None, None))
+        return headers
+
+    def get_total_count(self):
+        """
+        Gets how many objects there are
+        If cachedCount is set, the count is cached until the model's version changes (which happens on every save and
+        delete in the admin site), so the table isn't counted on every page
+
+        @return: The number of objects
+        @rtype: int
+        """
+
+        if not self.cachedCount:
+            return self.model.objects.count()
+        version = get_versions([get_model_label(self.model)])[0][0]
+        key = f"{COUNT_KEY_PREFIX}.{get_model_label(self.model)}.{version}"
+        count = cache.get(key)
+        if count is None:
+            count = self.model.objects.count()
+            cache.set(key, count, None)
+        return count
+
     def pre_save(self, new_obj, form_data, new):
         """
         Before saving an object, this function will run
@@ -319,10 +578,12 @@ class ViewSet:
 
         if form.is_valid():
             self.pre_save(None, form.cleaned_data, True)
-            new_obj = form.save()
+            new_obj = form.save(commit=False)
             if self.ordered:
-                new_obj.sort_order = len(list(self.model.objects.all())) - 1
-                new_obj.save()
+                # New objects go at the end, this is set before saving so the object is only saved once
+                new_obj.sort_order = self.model.objects.count()
+            new_obj.save()
+            form.save_m2m()
             self.post_save(new_obj, form.cleaned_data, True)
             return redirect(f'{self.overview_link()}?alert=New {self.displayName} Saved&alertType=success')
         else:
@@ -368,12 +629,12 @@ class ViewSet:
             target_obj = get_object_or_404(self.model, id=request.GET.get('id', ''))
             form.fields["confirm"].set_object_name(str(target_obj))
             self.pre_del(target_obj)
-            target_obj.delete()
-            if self.ordered:
-                objects_to_fix = list(self.model.objects.filter(sort_order__gt=target_obj.sort_order))
-                for object_to_fix in objects_to_fix:
-                    object_to_fix.sort_order -= 1
-                    object_to_fix.save()
+            with transaction.atomic():
+                target_obj.delete()
+                if self.ordered:
+                    # Close the gap with one UPDATE instead of saving every object after the deleted one
+                    self.model.objects.filter(sort_order__gt=target_obj.sort_order)\
+                        .update(sort_order=F("sort_order") - 1)
             self.post_del(target_obj)
             return redirect(f'{self.overview_link()}?alert={self.displayName} Deleted&alertType=success')
         else:
@@ -433,11 +694,24 @@ class ViewSet:
             form.fields["new_order"].set_name(self.displayName)
             if form.is_valid():
                 new_order = [UUID(raw_id) for raw_id in form.cleaned_data.get("new_order").split(",")]
-                current_order = list(self.model.objects.values_list("id", flat=True).order_by("sort_order"))
-                for target_id in current_order:
-                    object_to_be_sorted = self.model.objects.get(id=target_id)
-                    object_to_be_sorted.sort_order = new_order.index(target_id)
-                    object_to_be_sorted.save()
+                positions = {target_id: index for index, target_id in enumerate(new_order)}
+                extra_positions = itertools.count(len(positions))
+                with transaction.atomic():
+                    objects_to_be_sorted = list(self.model.objects.select_for_update().only("id", "sort_order"))
+                    changed_objects = []
+                    for object_to_be_sorted in objects_to_be_sorted:
+                        # Anything added since the form was checked goes at the end, in the order it had
+                        if object_to_be_sorted.id in positions:
+                            new_position = positions[object_to_be_sorted.id]
+                        else:
+                            new_position = next(extra_positions)
+                        if object_to_be_sorted.sort_order != new_position:
+                            object_to_be_sorted.sort_order = new_position
+                            changed_objects.append(object_to_be_sorted)
+                    # One UPDATE (per batch) for every object that moved, rather than a get and save for each one
+                    self.model.objects.bulk_update(changed_objects, ["sort_order"], batch_size=500)
+                # bulk_update doesn't send save signals, so we drop the cached pages ourselves
+                invalidate_pages(self.model)
                 return redirect(f'{self.overview_link()}?alert=New Order Saved&alertType=success')
             else:
                 return render(request, "db/form_base.html", {'viewSet': self, 'back_link': self.overview_link(),
@@ -455,6 +729,7 @@ class ViewSet:
     def obj_overview_view(self, request):
         """
         This view is used to view objects in the database
+        The objects can be searched, filtered, and sorted, and the page links keep those settings
 
         @param request: A django request object
         @type request: HttpRequest
@@ -462,37 +737,70 @@ class ViewSet:
         @rtype: HttpResponse
         """
 
+        blank_link = "javascript:void(0);"
+        state = self.get_overview_state(request)
+        searching = any(key != "sort" for key in state.keys())
+        queryset = self.filter_overview(self.model.objects.all(), state)
+        context = {'headers': self.get_overview_headers(state), 'viewSet': self,
+                   'canEdit': request.user.has_perms(self.get_permissions_as_dict()["Edit"]),
+                   'back_link': reverse("edit:admin_home"), 'verb': "View/Edit", 'plural': True,
+                   'help_link': reverse("edit:help_navigation"), 'keyset': self.keysetPagination,
+                   'searching': searching, 'search': state.get("q", ""), 'sort': state.get("sort", ""),
+                   'search_labels': ", ".join(self.labels.get(field, field) for field in self.searchFields),
+                   'filters': [{'name': f"filter_{field}", 'label': self.labels.get(field, field),
+                                'choices': self.get_filter_choices(field), 'value': state.get(f"filter_{field}", "")}
+                               for field in self.filterFields]}
+        # The count is only cached for every object, a search has to be counted
+        use_cached_count = self.cachedCount and not searching
+        if self.keysetPagination:
+            ordering = get_keyset_ordering(self.model, [state["sort"]] if "sort" in state else None)
+            try:
+                rows, previous_cursor, next_cursor = get_keyset_window(
+                    self.get_overview_values(queryset, [field.lstrip("-") for field in ordering]),
+                    ordering, self.per_page, after=request.GET.get('after'), before=request.GET.get('before'))
+            except ValueError:
+                raise Http404("Invalid Cursor")
+            context.update({
+                'objects': self.format_overview_rows(rows),
+                'has_previous': previous_cursor is not None, 'has_next': next_cursor is not None,
+                'first_link': self.overview_state_link(state) if previous_cursor is not None else blank_link,
+                'previous_link': self.overview_state_link(state, before=previous_cursor)
+                if previous_cursor is not None else blank_link,
+                'next_link': self.overview_state_link(state, after=next_cursor)
+                if next_cursor is not None else blank_link,
+                'total_count': self.get_total_count() if use_cached_count else None,
+            })
+            return render(request, 'db/view.html', context)
+
+        if "sort" in state:
+            queryset = queryset.order_by(state["sort"], "id")
+        else:
+            # Models without an ordering (like User) would page in whatever order the database returns rows
+            queryset = queryset.order_by(*(self.model._meta.ordering or ()), "id")
         page_number = request.GET.get('page', 1)
-        model_paginator = Paginator(self.model.objects.all(), self.per_page, allow_empty_first_page=True)
+        model_paginator = Paginator(queryset, self.per_page, allow_empty_first_page=True)
+        if use_cached_count:
+            model_paginator.count = self.get_total_count()
         page = model_paginator.get_page(page_number)
         start = page.start_index() - 1
         end = page.end_index()
-        blank_link = "javascript:void(0);"
         next_link = blank_link
         last_link = blank_link
         previous_link = blank_link
         first_link = blank_link
         if page.has_next():
-            next_link = f"{self.overview_link()}?page={page.next_page_number()}"
-            last_link = f"{self.overview_link()}?page={model_paginator.num_pages}"
+            next_link = self.overview_state_link(state, page=page.next_page_number())
+            last_link = self.overview_state_link(state, page=model_paginator.num_pages)
         if page.has_previous():
-            previous_link = f"{self.overview_link()}?page={page.previous_page_number()}"
-            first_link = f"{self.overview_link()}?page=1"
-        headers = self.displayFields.copy()
+            previous_link = self.overview_state_link(state, page=page.previous_page_number())
+            first_link = self.overview_state_link(state, page=1)
         if start >= 0:
-            objects = self.model.objects.all()[start:end].values_list(*self.displayFields, 'id')
+            objects = self.get_overview_rows(queryset[start:end])
         else:
             objects = []
-        for target in self.labels.keys():
-            if target in headers:
-                headers[headers.index(target)] = self.labels[target]
-        return render(request, 'db/view.html',
-                      {'headers': headers, 'objects': self.format_value_list(objects), 'viewSet': self,
-                       'canEdit': request.user.has_perms(self.get_permissions_as_dict()["Edit"]),
-                       'back_link': reverse("edit:admin_home"), 'verb': "View/Edit",
-                       'page': page, 'next_link': next_link, 'previous_link': previous_link, 'plural': True,
-                       'max_pages': model_paginator.num_pages, 'help_link': reverse("edit:help_navigation"),
-                       'first_link': first_link, 'last_link': last_link})
+        context.update({'objects': objects, 'page': page, 'next_link': next_link, 'previous_link': previous_link,
+                        'max_pages': model_paginator.num_pages, 'first_link': first_link, 'last_link': last_link})
+        return render(request, 'db/view.html', context)
 
     @staticmethod
     def missing_permissions_link():
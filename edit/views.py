@@ -13,14 +13,18 @@ from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import Permission
 from django.db import models as source_fields
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404, redirect
+from django.template.defaultfilters import escape
 from django.urls import path, reverse
 from django.views.decorators.http import require_safe, require_http_methods
 
 from edit import forms, models
 from edit.exceptions import ImproperlyConfiguredViewSetError
-from edit.view_set import ViewSet, formatters, Action
-from edit.webcal import update_file
+from edit.images import generate_derivatives, get_derivative_files
+from edit.view_set import ViewSet, ComputedColumn, formatters, Action
+from edit.webcal import schedule_update
+from main import profiling
 
 
 # The following classes inherit from the ViewSet class, and are used to add functionality to the models we want
@@ -33,24 +37,23 @@ class EventViewSet(ViewSet):
     modelForm = forms.EventForm
     displayFields = ['name', 'virtual', 'location', 'startDate', 'endDate']
     labels = {'location': "Location/Link", 'startDate': "Start Date", 'endDate': "End Date"}
-
-    def format_value_list(self, value_list):
-        new_value_list = super().format_value_list(value_list)
-
-        for event in new_value_list:
-            virtual_location = self.displayFields.index("virtual")
-            location_index = self.displayFields.index("location")
-            if "check" in event[virtual_location]:
-                new_value = self.model.objects.get(id=event[-1]).link
-                event[location_index] = formatters[source_fields.URLField](new_value)
-
-        return new_value_list
+    keysetPagination = True
+    cachedCount = True
+    searchFields = ['name', 'location']
+    filterFields = ['virtual']
+    sortFields = ['name', 'startDate', 'endDate']
+    computedColumns = {
+        'location': ComputedColumn(lambda row: formatters[source_fields.URLField](row['link']) if row['virtual']
+                                   else escape(row['location'] or ""), fields=['link'])
+    }
 
     def post_save(self, new_obj, form_data, new):
-        update_file()
+        schedule_update()
+        super().post_save(new_obj, form_data, new)
 
     def post_del(self, obj_deleted):
-        update_file()
+        schedule_update()
+        super().post_del(obj_deleted)
 
 
 class SocialViewSet(ViewSet):
@@ -81,6 +84,7 @@ class LinkViewSet(ViewSet):
     ordered = True
     displayFields = ['display_name', 'url']
     labels = {'display_name': "Name"}
+    searchFields = ['display_name', 'url']
 
 
 class GalleryPhotoViewSet(ViewSet):
@@ -91,10 +95,47 @@ class GalleryPhotoViewSet(ViewSet):
     # The photo-folder attribute tells the model where to store pictures
     photoFolder = "galleryphoto-pictures"
     displayFields = ["caption", "picture", "featured"]
+    keysetPagination = True
+    cachedCount = True
+    searchFields = ["caption"]
+    filterFields = ["featured"]
+
+    @staticmethod
+    def remove_media_files(names):
+        """
+        This function deletes files from MEDIA_ROOT and removes them from the media usage ledger
+
+        @param names: The names of the files to remove, relative to MEDIA_ROOT
+        @type names: list[str]
+        """
+
+        for name in names:
+            path = settings.MEDIA_ROOT + name
+            if os.path.exists(path):
+                models.MediaUsage.record(os.path.dirname(name), -os.path.getsize(path), -1)
+                os.remove(path)
+
+    @staticmethod
+    def add_media_files(names):
+        """
+        This function adds new files to the media usage ledger, grouped by folder
+
+        @param names: The names of the files that were added, relative to MEDIA_ROOT
+        @type names: list[str]
+        """
+
+        usage_by_folder = {}
+        for name in names:
+            folder_bytes, folder_files = usage_by_folder.get(os.path.dirname(name), (0, 0))
+            usage_by_folder[os.path.dirname(name)] = (folder_bytes + os.path.getsize(settings.MEDIA_ROOT + name),
+                                                      folder_files + 1)
+        for folder, (folder_bytes, folder_files) in usage_by_folder.items():
+            models.MediaUsage.record(folder, folder_bytes, folder_files)
 
     def rename_photo_file(self, photo_object):
         """
         This function renames the photo file uploaded to the GalleryPhoto object's id
+        The new name isn't saved here, update_derivatives saves it along with the derivatives
 
         @param photo_object: The object with the photo file
         @type photo_object: Model
@@ -103,20 +144,47 @@ class GalleryPhotoViewSet(ViewSet):
         initial_path = photo_object.picture.path
         photo_object.picture.name = f"{self.photoFolder}/{photo_object.id}.{photo_object.get_extension()}"
         new_path = settings.MEDIA_ROOT + photo_object.picture.name
-        if os.path.exists(new_path):
-            os.remove(new_path)
+        self.remove_media_files([photo_object.picture.name])
         os.rename(initial_path, new_path)
-        photo_object.save()
+
+    def update_derivatives(self, photo_object, update_fields=("derivatives",)):
+        """
+        This function replaces the smaller copies of the photo with new ones made from the current photo file
+
+        @param photo_object: The object with the photo file
+        @type photo_object: Model
+        @param update_fields: The fields to save, this lets a renamed photo be saved once (and bump its version once)
+        @type update_fields: tuple[str]
+        """
+
+        self.remove_media_files(get_derivative_files(photo_object))
+        photo_object.derivatives = generate_derivatives(photo_object, self.photoFolder)
+        photo_object.save(update_fields=list(update_fields))
+        self.add_media_files(get_derivative_files(photo_object))
+
+    def pre_save(self, new_obj, form_data, new):
+
+        if not new:
+            # Remember the old file, so we can remove it if a new photo was uploaded
+            new_obj.previous_picture = self.model.objects.values_list("picture", flat=True).get(id=new_obj.id)
+        super().pre_save(new_obj, form_data, new)
 
     def post_save(self, new_obj, form_data, new):
 
         if new or str(new_obj.id) not in new_obj.picture.name:
+            self.add_media_files([new_obj.picture.name])
+            previous_picture = getattr(new_obj, "previous_picture", None)
+            if previous_picture and previous_picture != new_obj.picture.name:
+                self.remove_media_files([previous_picture])
             self.rename_photo_file(new_obj)
+            self.update_derivatives(new_obj, update_fields=("picture", "derivatives"))
+        elif not new_obj.derivatives:
+            self.update_derivatives(new_obj)
+        super().post_save(new_obj, form_data, new)
 
     def pre_del(self, obj_to_delete):
 
-        if os.path.exists(obj_to_delete.picture.path):
-            os.remove(obj_to_delete.picture.path)
+        self.remove_media_files([obj_to_delete.picture.name] + get_derivative_files(obj_to_delete))
 
 
 class OfficerViewSet(GalleryPhotoViewSet):
@@ -126,19 +194,18 @@ class OfficerViewSet(GalleryPhotoViewSet):
     modelForm = forms.OfficerForm
     photoFolder = "officer-pictures"
     ordered = True
+    keysetPagination = False
+    cachedCount = False
+    searchFields = ["first_name", "last_name", "title"]
+    filterFields = []
     displayFields = ["first_name", "title", 'picture']
     labels = {
         "first_name": "Name"
     }
-
-    def format_value_list(self, value_list):
-        new_value_list = super().format_value_list(value_list)
-
-        for officer in new_value_list:
-            first_name_index = self.displayFields.index("first_name")
-            officer[first_name_index] = str(self.model.objects.get(id=officer[-1]))
-
-        return new_value_list
+    computedColumns = {
+        "first_name": ComputedColumn(lambda row: escape(f"{row['first_name']} {row['last_name']}"),
+                                     fields=["last_name"])
+    }
 
 
 REGISTERED_VIEWSETS = [EventViewSet, LinkViewSet, GalleryPhotoViewSet, OfficerViewSet, SocialViewSet]
@@ -210,19 +277,18 @@ class UserViewSet(ViewSet):
     model = models.User
     modelForm = forms.UserEditForm
     displayFields = ["username", "first_name", "email", "is_staff"]
+    searchFields = ["username", "email", "first_name", "last_name"]
+    filterFields = ["is_staff"]
+    sortFields = ["username", "email"]
     labels = {
         "is_staff": "Manager",
         "first_name": "Name",
     }
-
-    def format_value_list(self, value_list):
-        new_value_list = super().format_value_list(value_list)
-
-        for user in new_value_list:
-            first_name_index = self.displayFields.index("first_name")
-            user[first_name_index] = str(self.model.objects.get(id=user[-1]))
-
-        return new_value_list
+    computedColumns = {
+        "first_name": ComputedColumn(lambda row: escape(f"{row['first_name']} {row['last_name']}"
+                                                        if row['first_name'] and row['last_name']
+                                                        else row['username']), fields=["last_name"])
+    }
 
     @staticmethod
     def gen_json_from_viewsets(user, viewsets):
@@ -260,6 +326,7 @@ class UserViewSet(ViewSet):
                 target_perms += [Permission.objects.get(codename=perm) for perm in perms_to_add]
         user.user_permissions.set(target_perms)
         user.save()
+        super().post_save(user, form_data, new)
 
     def get_form_object(self, data_sources, instance=None):
         if instance is None:
@@ -392,8 +459,57 @@ def admin_home(request):
     if request.user.has_perms(UserViewSet().get_permissions_as_dict()["View"]):
         accessible_viewsets.append(UserViewSet())
 
+    media_usage = models.MediaUsage.objects.all() if request.user.is_staff else []
     return render(request, 'admin_home.html', {"viewsets": accessible_viewsets,
-                                               'hide_home': True})
+                                               'hide_home': True, "media_usage": media_usage,
+                                               "media_total": sum(usage.bytes for usage in media_usage),
+                                               "media_max": forms.MAX_BYTES})
+
+
+@require_safe
+@login_required
+def profiles(request):
+    """
+    This view lists the requests that were profiled, newest first, only staff users can see it
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: A response to the request
+    @rtype: HttpResponse
+    """
+
+    if not request.user.is_staff:
+        return redirect(ViewSet.missing_permissions_link())
+    return render(request, "profiles.html", {"profiles": profiling.list_profiles(),
+                                             "back_link": reverse("edit:admin_home")})
+
+
+@require_safe
+@login_required
+def profile_detail(request):
+    """
+    This view shows the functions that took the most time in a profiled request, only staff users can see it
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: A response to the request
+    @rtype: HttpResponse
+    @raise Http404: If there's no such profile
+    """
+
+    if not request.user.is_staff:
+        return redirect(ViewSet.missing_permissions_link())
+    path = profiling.get_profile_path(request.GET.get("folder", ""), request.GET.get("name", ""))
+    if path is None:
+        raise Http404("No Such Profile")
+    try:
+        with open(path + profiling.INFO_EXTENSION) as info_file:
+            info = loads(info_file.read())
+        functions = profiling.get_top_functions(path)
+    except (OSError, ValueError, EOFError):
+        raise Http404("No Such Profile")
+    return render(request, "profile.html", {"info": info, "functions": functions,
+                                            "back_link": reverse("edit:profiles")})
 
 
 def help_page(name, display_name):
@@ -2,19 +2,49 @@
     This file sets up the use of the webcal protocol
     It allows users to sync our calendar with a service of their choice
     They do this via a link
+    Each event's VEVENT is serialized once when the event is saved and stored on the event
+    The .ics file is then put together by joining those stored components, so nothing is re-serialized
+    Rebuilding the file is done on a background thread a moment after the change, so edits made close together
+    only rebuild it once, and the new file replaces the old one all at once so nobody reads a half written file
 """
 
 import os
+import tempfile
+import threading
 from datetime import datetime, date, time, timedelta
 
 from django.conf import settings
+from django.db import connections, transaction
+from django.urls import reverse
 from icalendar import Calendar
 from icalendar import Event as CalendarEvent, vText, vDuration
 
 from edit.models import Event
 
-CALENDAR_PATH = settings.MEDIA_ROOT + "event-calendar/" + settings.ICAL_FILE_NAME + ".ics"
-CALENDAR_URL = settings.MEDIA_URL + "event-calendar/" + settings.ICAL_FILE_NAME + ".ics"
+try:
+    import fcntl
+except ImportError:
+    # fcntl is only available on Unix, elsewhere we can only keep threads in this process from overlapping
+    fcntl = None
+
+CALENDAR_FOOTER = b"END:VCALENDAR\r\n"
+# How many events to load from the database at a time when streaming the calendar
+CALENDAR_CHUNK_SIZE = 200
+
+# The rebuild that's waiting to run in this process, if there is one
+rebuild_timer = None
+rebuild_timer_lock = threading.Lock()
+
+
+def get_calendar_path():
+    """
+    Gets the path to the calendar file, this reads MEDIA_ROOT each time so it follows changes to the setting
+
+    @return: The path to the calendar file
+    @rtype: str
+    """
+
+    return settings.MEDIA_ROOT + "event-calendar/" + settings.ICAL_FILE_NAME + ".ics"
 
 
 def setup_calendar():
@@ -37,24 +67,35 @@ def setup_calendar():
     cal.add("color", "dodgerblue")
     cal.add('refresh-interval', vDuration(timedelta(hours=12)))
     if not settings.DEBUG:
-        cal.add('url', f"webcal://{settings.ALLOWED_HOSTS[0]}/{CALENDAR_URL}")
+        # Points apps that subscribed to the static file at the feed, which only sends the calendar when it changes
+        cal.add('url', f"webcal://{settings.ALLOWED_HOSTS[0]}{reverse('main:calendar_feed')}")
     return cal
 
 
-def write_calendar(cal, path=CALENDAR_PATH):
+def write_calendar(cal, path=None):
     """
-    This function saves a calendar object to a file
+    This function saves a calendar object to a file, replacing the old file in one step
 
-    @param path: path to the calendar file
+    @param path: path to the calendar file, defaults to get_calendar_path()
     @type path: str
-    @param cal: The calendar to save
-    @type cal: Calendar
+    @param cal: The calendar to save, or the already serialized calendar
+    @type cal: Calendar or bytes
     """
 
-    if not os.path.exists(settings.MEDIA_ROOT + "event-calendar/"):
-        os.mkdir(settings.MEDIA_ROOT + "event-calendar/")
-    with open(path, 'wb+') as calendar_file:
-        calendar_file.write(cal.to_ical())
+    if path is None:
+        path = get_calendar_path()
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    # We write to a temporary file next to the calendar, then swap it in, so readers see the old or new file in full
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as calendar_file:
+            calendar_file.write(cal if isinstance(cal, bytes) else cal.to_ical())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
 
 def combine(date_object, time_object):
@@ -87,27 +128,180 @@ def make_calendar_event(event):
     calendar_event.add("summary", vText(event.name))
     calendar_event.add("dtstart", combine(event.startDate, event.startTime))
     calendar_event.add("dtend", combine(event.endDate, event.endTime))
-    calendar_event.add("dtstamp", datetime.now())
+    # The stamp comes from when the event was last changed, so the output is the same until it changes again
+    calendar_event.add("dtstamp", event.last_modified)
+    calendar_event.add("last-modified", event.last_modified)
     calendar_event.add("description", vText(event.description))
     calendar_event.add("location", vText(event.link) if event.virtual else vText(event.location))
     return calendar_event
 
 
-def update_file(path=CALENDAR_PATH):
+def serialize_event(event):
+    """
+    Serializes an event as a VEVENT
+
+    @param event: The event to serialize
+    @type event: Event
+    @return: The VEVENT text
+    @rtype: str
+    """
+
+    return make_calendar_event(event).to_ical().decode("utf-8")
+
+
+def refresh_event_component(event):
+    """
+    Re-serializes one event and stores the result on it
+    This uses update() so saving the component doesn't change last_modified
+
+    @param event: The event that changed
+    @type event: Event
+    @return: The new VEVENT text
+    @rtype: str
+    """
+
+    event.ical_component = serialize_event(event)
+    Event.objects.filter(id=event.id).update(ical_component=event.ical_component)
+    return event.ical_component
+
+
+def build_calendar(components):
+    """
+    Puts together a calendar file from serialized VEVENTs
+    This gives the same bytes as adding each event to the Calendar and calling to_ical()
+
+    @param components: The serialized VEVENTs, in the order they should appear
+    @type components: iterable[str]
+    @return: The calendar file's contents
+    @rtype: bytes
     """
-    This file updates the calendar file from all events
-    This can be resource heavy, so only run it after a change
 
-    @param path: the path to the calendar file
+    header = setup_calendar().to_ical()[:-len(CALENDAR_FOOTER)]
+    return header + "".join(components).encode("utf-8") + CALENDAR_FOOTER
+
+
+def stream_calendar(events, chunk_size=CALENDAR_CHUNK_SIZE):
+    """
+    Yields a calendar file piece by piece, so we never have to hold every event in memory
+
+    @param events: The events to put in the calendar
+    @type events: QuerySet
+    @param chunk_size: How many events to load from the database at a time
+    @type chunk_size: int
+    @return: The pieces of the calendar file
+    @rtype: generator[bytes]
+    """
+
+    yield setup_calendar().to_ical()[:-len(CALENDAR_FOOTER)]
+    for event in events.iterator(chunk_size=chunk_size):
+        component = event.ical_component or refresh_event_component(event)
+        yield component.encode("utf-8")
+    yield CALENDAR_FOOTER
+
+
+def get_calendar_components():
+    """
+    Gets the stored VEVENT of every event, any event that doesn't have one yet is serialized now
+
+    @return: The VEVENTs, ordered by id so the file doesn't change unless an event does
+    @rtype: list[str]
+    """
+
+    components = []
+    for event in Event.objects.order_by("id").only("id", "ical_component"):
+        if event.ical_component:
+            components.append(event.ical_component)
+        else:
+            components.append(refresh_event_component(Event.objects.get(id=event.id)))
+    return components
+
+
+def update_file(path=None):
+    """
+    This file updates the calendar file from the stored component of every event
+    Saving an event refreshes its component (see edit/signals.py), so this only has to put them together
+
+    @param path: the path to the calendar file, defaults to get_calendar_path()
     @type path: str
     @return: the path to the file that was saved
     @rtype: str
     """
 
-    events = Event.objects.all()
-    cal = setup_calendar()
-    for event in events:
-        calendar_event = make_calendar_event(event)
-        cal.add_component(calendar_event)
-    write_calendar(cal, path=path)
-    return CALENDAR_PATH
+    if path is None:
+        path = get_calendar_path()
+    write_calendar(build_calendar(get_calendar_components()), path=path)
+    return path
+
+
+def locked_update_file(path=None):
+    """
+    Rebuilds the calendar file while holding a lock on it, so two processes can't rebuild it at once
+
+    @param path: the path to the calendar file, defaults to get_calendar_path()
+    @type path: str
+    """
+
+    if path is None:
+        path = get_calendar_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            update_file(path=path)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run_scheduled_update(path=None):
+    """
+    Runs a rebuild that was scheduled by schedule_update, this runs on the timer's thread
+
+    @param path: the path to the calendar file, defaults to get_calendar_path()
+    @type path: str
+    """
+
+    global rebuild_timer
+    # Anything changed after this point gets its own rebuild, as we may have already read the events it changed
+    with rebuild_timer_lock:
+        rebuild_timer = None
+    try:
+        locked_update_file(path=path)
+    finally:
+        # This thread got its own database connection, so we have to close it ourselves
+        connections.close_all()
+
+
+def start_update_timer(path=None):
+    """
+    Starts the timer for a rebuild, if one isn't already waiting to run
+    If one is already waiting, it'll pick up this change too as it reads the events when it runs
+
+    @param path: the path to the calendar file, defaults to get_calendar_path()
+    @type path: str
+    """
+
+    global rebuild_timer
+    with rebuild_timer_lock:
+        if rebuild_timer is None:
+            rebuild_timer = threading.Timer(settings.CALENDAR_REBUILD_DELAY, run_scheduled_update,
+                                            kwargs={"path": path})
+            rebuild_timer.start()
+
+
+def schedule_update(path=None):
+    """
+    Rebuilds the calendar file after an event changes
+    The rebuild waits for the current transaction to commit, then CALENDAR_REBUILD_DELAY seconds on another thread
+
+    @param path: the path to the calendar file, defaults to get_calendar_path()
+    @type path: str
+    """
+
+    if path is None:
+        path = get_calendar_path()
+    if settings.CALENDAR_REBUILD_DELAY is None:
+        locked_update_file(path=path)
+    else:
+        transaction.on_commit(lambda: start_update_timer(path=path))
@@ -0,0 +1,16 @@
+"""
+    This file configures the main app
+    When the app is ready, we start timing templates if SERVER_TIMING is on (see main/timing.py)
+"""
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class MainConfig(AppConfig):
+    name = 'main'
+
+    def ready(self):
+        if settings.SERVER_TIMING:
+            from main import timing
+            timing.install_template_timing()
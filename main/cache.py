@@ -0,0 +1,168 @@
+"""
+    This file contains a cache for the public pages of the site
+    Anonymous visitors all see the same pages, so we can store the rendered response and send it again
+    Each cached view declares which models it reads from, and the version of those models is part of the cache key
+    When a model is changed in the admin site, we bump its version, which drops every page that depends on it
+    The versions are stored in the database (see ModelVersion), so a change made in one process is seen by all of them
+    The versions also give us an ETag and Last-Modified for each page, so browsers that already have the page get a 304
+"""
+
+from datetime import date, datetime, time
+from functools import wraps
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from edit.models import ModelVersion
+from main.timing import record_cache
+
+PAGE_KEY_PREFIX = "page"
+
+# Every public page extends base.html, which renders the social media links in the footer
+BASE_DEPENDENCIES = ("edit.Social",)
+
+
+def get_model_label(model):
+    """
+    Gets the label used to track a model's version, this accepts either a model class or a label
+
+    @param model: The model (or its "app.Model" label) to get the label of
+    @type model: Model or str
+    @return: The label for the model
+    @rtype: str
+    """
+
+    return model if isinstance(model, str) else model._meta.label
+
+
+def get_versions(labels):
+    """
+    Gets the current version of each model, and when it last changed, in one query
+
+    @param labels: The labels of the models to check
+    @type labels: list[str]
+    @return: The version of each model and when it last changed (None if it never has), in the same order as the labels
+    @rtype: list[tuple]
+    """
+
+    versions = ModelVersion.get_versions(labels)
+    return [versions[label] for label in labels]
+
+
+def invalidate_pages(model):
+    """
+    Drops every cached page that depends on the given model, in every process
+
+    @param model: The model that was changed
+    @type model: Model or str
+    """
+
+    ModelVersion.bump(get_model_label(model))
+
+
+def get_page_key(request, versions):
+    """
+    Generates the cache key for a request, this is based off the host, path, query string, and model versions
+    We also include today's date, as some pages (like the events page) change depending on the day
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @param versions: The versions of the models the page depends on (see get_versions)
+    @type versions: list[tuple]
+    @return: The cache key for the page
+    @rtype: str
+    """
+
+    version_text = ".".join(str(version) for version, updated in versions)
+    raw_key = f"{date.today()}:{request.get_host()}:{request.get_full_path()}"
+    return f"{PAGE_KEY_PREFIX}:{version_text}:{md5(raw_key.encode('utf-8')).hexdigest()}"
+
+
+def get_last_modified(versions):
+    """
+    Gets when a page last changed, this is when one of its models last changed, or midnight if that's more recent
+    Midnight is included as some pages (like the events page) change depending on the day
+
+    @param versions: The versions of the models the page depends on (see get_versions)
+    @type versions: list[tuple]
+    @return: When the page last changed
+    @rtype: datetime
+    """
+
+    midnight = timezone.make_aware(datetime.combine(date.today(), time.min))
+    return max([updated for version, updated in versions if updated is not None] + [midnight])
+
+
+def should_cache(request):
+    """
+    Checks whether a request can be answered from the cache
+    We only cache safe requests from anonymous users, as logged in users may see different content
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: Whether we can use the cache for this request
+    @rtype: bool
+    """
+
+    user = getattr(request, "user", None)
+    return request.method in ("GET", "HEAD") and (user is None or not user.is_authenticated)
+
+
+def public_page(*dependencies):
+    """
+    This decorator caches a view's response for anonymous users until one of its dependencies changes
+    It also answers conditional requests (If-None-Match or If-Modified-Since) with a 304 when the page is the same
+    That works whether or not the page was still cached, as the ETag only depends on the request and the versions
+
+    @param dependencies: The models (or "app.Model" labels) the view reads from
+    @return: A decorator that adds caching to a view
+    @rtype: function
+    """
+
+    labels = sorted(set(BASE_DEPENDENCIES + tuple(get_model_label(model) for model in dependencies)))
+
+    def decorator(view):
+        @wraps(view)
+        def cached_view(request, *args, **kwargs):
+            if not should_cache(request):
+                return view(request, *args, **kwargs)
+            versions = get_versions(labels)
+            key = get_page_key(request, versions)
+            etag = quote_etag(key.split(":", 1)[1])
+            last_modified = get_last_modified(versions)
+            response = cache.get(key)
+            record_cache(response is not None)
+            if response is None:
+                response = view(request, *args, **kwargs)
+                if response.status_code != 200 or response.streaming:
+                    # Only pages we cache (which are always 200s) can be answered with a 304, so a request that
+                    # would have been a 404 or a redirect never gets one
+                    return response
+                response["ETag"] = etag
+                response["Last-Modified"] = http_date(last_modified.timestamp())
+                # Browsers should check with us before reusing the page, which only costs a 304 if it's the same
+                patch_cache_control(response, no_cache=True)
+                if hasattr(response, "add_post_render_callback"):
+                    # TemplateResponses (like the sitemap's) can only be stored once they've been rendered
+                    response.add_post_render_callback(
+                        lambda rendered: cache.set(key, rendered, settings.PAGE_CACHE_TIMEOUT))
+                else:
+                    cache.set(key, response, settings.PAGE_CACHE_TIMEOUT)
+            not_modified = get_conditional_response(request, etag=etag, last_modified=int(last_modified.timestamp()))
+            if not_modified is not None:
+                if hasattr(response, "add_post_render_callback") and not response.is_rendered:
+                    # The 304 replaces the page, so it has to be rendered here for it to be stored
+                    response.render()
+                not_modified["ETag"] = etag
+                patch_cache_control(not_modified, no_cache=True)
+                return not_modified
+            return response
+
+        cached_view.page_dependencies = labels
+        return cached_view
+
+    return decorator
@@ -0,0 +1,276 @@
+"""
+    This file collects metrics about each route (request count, latency, queries, response size, and status codes)
+    Each process keeps its own counters in memory, and every few seconds it saves them to a JSON file in METRICS_DIR
+    When /metrics is scraped, we add up the files from every process and output them in Prometheus' text format
+    Files left behind by processes that have exited (like after a worker restart) are deleted when /metrics is scraped
+"""
+
+import hmac
+import json
+import os
+import tempfile
+import threading
+from time import monotonic
+
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+METRIC_PREFIX = "berks_dental"
+
+route_metrics = {}
+metrics_lock = threading.Lock()
+last_flush = monotonic()
+
+
+def new_route_entry():
+    """
+    Creates the counters for a route that hasn't been seen yet
+
+    @return: The empty counters
+    @rtype: dict
+    """
+
+    return {
+        "statuses": {},
+        "latency_buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+        "latency_sum": 0.0,
+        "query_buckets": [0] * (len(QUERY_BUCKETS) + 1),
+        "query_sum": 0,
+        "size_sum": 0,
+        "count": 0,
+    }
+
+
+def get_bucket(buckets, value):
+    """
+    Gets the index of the first bucket a value fits in, the last index is for values bigger than every bucket
+
+    @param buckets: The upper bounds of the buckets
+    @type buckets: tuple
+    @param value: The value to place
+    @type value: float
+    @return: The index of the bucket
+    @rtype: int
+    """
+
+    for index, upper_bound in enumerate(buckets):
+        if value <= upper_bound:
+            return index
+    return len(buckets)
+
+
+def record_request(route, status, duration, queries, size):
+    """
+    Records a finished request, and saves this process' counters if it's been long enough since the last save
+
+    @param route: The name of the route (like main:gallery)
+    @type route: str
+    @param status: The status code of the response
+    @type status: int
+    @param duration: How long the request took, in seconds
+    @type duration: float
+    @param queries: How many queries the request ran
+    @type queries: int
+    @param size: The size of the response body in bytes
+    @type size: int
+    """
+
+    global last_flush
+    with metrics_lock:
+        entry = route_metrics.setdefault(route, new_route_entry())
+        status_text = str(status)
+        entry["statuses"][status_text] = entry["statuses"].get(status_text, 0) + 1
+        entry["latency_buckets"][get_bucket(LATENCY_BUCKETS, duration)] += 1
+        entry["latency_sum"] += duration
+        entry["query_buckets"][get_bucket(QUERY_BUCKETS, queries)] += 1
+        entry["query_sum"] += queries
+        entry["size_sum"] += size
+        entry["count"] += 1
+        should_flush = monotonic() - last_flush >= settings.METRICS_FLUSH_INTERVAL
+        if should_flush:
+            last_flush = monotonic()
+            snapshot = json.dumps(route_metrics)
+    if should_flush:
+        write_snapshot(snapshot)
+
+
+def get_snapshot_path(pid=None):
+    """
+    Gets the path to the file a process saves its counters in
+
+    @param pid: The process id, defaults to this process
+    @type pid: int
+    @return: The path to the file
+    @rtype: str
+    """
+
+    return os.path.join(settings.METRICS_DIR, f"{pid or os.getpid()}.json")
+
+
+def write_snapshot(snapshot):
+    """
+    Saves this process' counters, the file is replaced in one step so a scrape never reads half of it
+
+    @param snapshot: The counters, as JSON
+    @type snapshot: str
+    """
+
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=settings.METRICS_DIR, suffix=".tmp")
+    with os.fdopen(file_descriptor, 'w') as snapshot_file:
+        snapshot_file.write(snapshot)
+    os.replace(temp_path, get_snapshot_path())
+
+
+def is_process_alive(pid):
+    """
+    Checks whether a process is still running, so we know if its counters should still be reported
+    We can only check on POSIX systems, everywhere else we assume the process is running
+
+    @param pid: The process id
+    @type pid: int
+    @return: Whether the process is running
+    @rtype: bool
+    """
+
+    if os.name != "posix":
+        return True
+    if pid <= 0:
+        # These aren't real process ids (os.kill would signal a whole process group)
+        return False
+    try:
+        # Signal 0 doesn't do anything to the process, it only checks that it exists
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, it just belongs to another user
+        return True
+    return True
+
+
+def has_scrape_token(request):
+    """
+    Checks whether a request sent the METRICS_TOKEN as a bearer token (Authorization: Bearer <token>)
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: Whether the request has the token, this is always False when METRICS_TOKEN isn't set
+    @rtype: bool
+    """
+
+    if not settings.METRICS_TOKEN:
+        return False
+    authorization = request.META.get("HTTP_AUTHORIZATION", "")
+    return hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {settings.METRICS_TOKEN}".encode("utf-8"))
+
+
+def merge_entries(total, entry):
+    """
+    Adds the counters of one route in one process to the running total
+
+    @param total: The running total, this is changed in place
+    @type total: dict
+    @param entry: The counters to add
+    @type entry: dict
+    """
+
+    for status, count in entry["statuses"].items():
+        total["statuses"][status] = total["statuses"].get(status, 0) + count
+    for key in ("latency_buckets", "query_buckets"):
+        total[key] = [existing + new for existing, new in zip(total[key], entry[key])]
+    for key in ("latency_sum", "query_sum", "size_sum", "count"):
+        total[key] += entry[key]
+
+
+def collect_metrics():
+    """
+    Adds up the counters from every running process, we use our own live counters instead of our (possibly old) file
+    As the counters of exited processes are dropped, totals can go down, which Prometheus treats as a counter reset
+
+    @return: A dict that maps each route to its counters
+    @rtype: dict
+    """
+
+    snapshots = []
+    own_file = os.path.basename(get_snapshot_path())
+    if os.path.isdir(settings.METRICS_DIR):
+        for file_name in sorted(os.listdir(settings.METRICS_DIR)):
+            if not file_name.endswith(".json") or file_name == own_file:
+                continue
+            path = os.path.join(settings.METRICS_DIR, file_name)
+            pid = file_name[:-len(".json")]
+            if pid.isdigit() and not is_process_alive(int(pid)):
+                # The process is gone, so its counters would never change again, and would be counted forever
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (OSError, ValueError):
+                continue
+    with metrics_lock:
+        snapshots.append(json.loads(json.dumps(route_metrics)))
+    totals = {}
+    for snapshot in snapshots:
+        for route, entry in snapshot.items():
+            merge_entries(totals.setdefault(route, new_route_entry()), entry)
+    return totals
+
+
+def format_histogram(name, route, buckets, counts, total_sum, count):
+    """
+    Formats a histogram in Prometheus' text format, Prometheus expects each bucket to include the ones before it
+
+    @return: The lines for the histogram
+    @rtype: list[str]
+    """
+
+    lines = []
+    running_total = 0
+    for upper_bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+        running_total += bucket_count
+        lines.append(f'{name}_bucket{{route="{route}",le="{upper_bound}"}} {running_total}')
+    lines.append(f'{name}_sum{{route="{route}"}} {total_sum}')
+    lines.append(f'{name}_count{{route="{route}"}} {count}')
+    return lines
+
+
+def render_metrics():
+    """
+    Outputs every metric in Prometheus' text format
+
+    @return: The metrics
+    @rtype: str
+    """
+
+    totals = collect_metrics()
+    requests_name = f"{METRIC_PREFIX}_http_requests_total"
+    latency_name = f"{METRIC_PREFIX}_http_request_duration_seconds"
+    queries_name = f"{METRIC_PREFIX}_http_request_queries"
+    size_name = f"{METRIC_PREFIX}_http_response_size_bytes"
+    lines = [f"# HELP {requests_name} Requests handled, by route and status code",
+             f"# TYPE {requests_name} counter"]
+    for route, entry in sorted(totals.items()):
+        for status, count in sorted(entry["statuses"].items()):
+            lines.append(f'{requests_name}{{route="{route}",status="{status}"}} {count}')
+    lines += [f"# HELP {latency_name} How long requests took, by route",
+              f"# TYPE {latency_name} histogram"]
+    for route, entry in sorted(totals.items()):
+        lines += format_histogram(latency_name, route, LATENCY_BUCKETS, entry["latency_buckets"],
+                                  entry["latency_sum"], entry["count"])
+    lines += [f"# HELP {queries_name} How many database queries requests ran, by route",
+              f"# TYPE {queries_name} histogram"]
+    for route, entry in sorted(totals.items()):
+        lines += format_histogram(queries_name, route, QUERY_BUCKETS, entry["query_buckets"],
+                                  entry["query_sum"], entry["count"])
+    lines += [f"# HELP {size_name} The size of response bodies, by route",
+              f"# TYPE {size_name} summary"]
+    for route, entry in sorted(totals.items()):
+        lines.append(f'{size_name}_sum{{route="{route}"}} {entry["size_sum"]}')
+        lines.append(f'{size_name}_count{{route="{route}"}} {entry["count"]}')
+    return "\n".join(lines) + "\n"
@@ -2,9 +2,20 @@
     This file contains custom middleware, which is run between receiving a request, and sending the response
 """
 
+import logging
+from time import perf_counter, time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
 from django.shortcuts import redirect
 from django.urls import reverse, resolve
 
+from main import metrics, profiling, timing
+from main.querycheck import QueryRecorder, find_repeated_queries
+
+logger = logging.getLogger(__name__)
+
 
 def trident_redirect(get_response):
     """
@@ -27,3 +38,120 @@ def trident_redirect(get_response):
             return get_response(request)
 
     return middleware
+
+
+def server_timing(get_response):
+    """
+    Adds a Server-Timing header to the response, which shows how long the database, templates, and cache took
+    Browsers show this in their developer tools, this is sent to staff users, or everyone if SERVER_TIMING is True
+    Template times are only included when SERVER_TIMING is True (see main/apps.py)
+
+    @param get_response: A function to get the response from a request
+    @type get_response: function
+    @return: The middleware function
+    @rtype: function
+    """
+
+    def middleware(request):
+        user = getattr(request, "user", None)
+        if settings.SERVER_TIMING or (user is not None and user.is_staff):
+            with timing.measure() as timer:
+                response = get_response(request)
+            response["Server-Timing"] = timer.get_header()
+            return response
+        else:
+            return get_response(request)
+
+    return middleware
+
+
+def collect_metrics(get_response):
+    """
+    Records how long each request took, how many queries it ran, its status, and its size, grouped by route
+    These are reported by the metrics view
+
+    @param get_response: A function to get the response from a request
+    @type get_response: function
+    @return: The middleware function
+    @rtype: function
+    """
+
+    def middleware(request):
+        with timing.measure() as timer:
+            response = get_response(request)
+        match = request.resolver_match
+        route = match.view_name if match is not None else "unmatched"
+        size = int(response.get("Content-Length", 0)) if response.streaming else len(response.content)
+        metrics.record_request(route, response.status_code, timer.total_time, timer.query_count, size)
+        return response
+
+    return middleware
+
+
+def detect_repeated_queries(get_response):
+    """
+    When DEBUG is True, this warns about requests that run the same shape of query over and over (N+1 queries)
+    The warning is logged, and the number of repeated shapes is sent in the X-Repeated-Queries header
+
+    @param get_response: A function to get the response from a request
+    @type get_response: function
+    @return: The middleware function
+    @rtype: function
+    """
+
+    if not settings.DEBUG:
+        raise MiddlewareNotUsed()
+
+    def middleware(request):
+        recorder = QueryRecorder()
+        with connections["default"].execute_wrapper(recorder):
+            response = get_response(request)
+        repeated = find_repeated_queries(recorder.queries)
+        if repeated:
+            for shape, count in repeated.items():
+                logger.warning("%s ran the same query %d times: %s", request.path, count, shape)
+            response["X-Repeated-Queries"] = str(len(repeated))
+        return response
+
+    return middleware
+
+
+def profile_requests(get_response):
+    """
+    Profiles some requests with cProfile, and saves them so staff users can look at them in the admin site
+    A fraction of requests are profiled (PROFILE_SAMPLE_RATE), and any request slower than PROFILE_SLOW_THRESHOLD
+    This is off unless one of those settings is set
+
+    @param get_response: A function to get the response from a request
+    @type get_response: function
+    @return: The middleware function
+    @rtype: function
+    """
+
+    if settings.PROFILE_SAMPLE_RATE <= 0 and settings.PROFILE_SLOW_THRESHOLD is None:
+        raise MiddlewareNotUsed()
+
+    def middleware(request):
+        profile, sampled = profiling.should_profile()
+        profiler = profiling.start_profiler() if profile else None
+        if profiler is None:
+            return get_response(request)
+        start = perf_counter()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.disable()
+        duration = perf_counter() - start
+        slow = settings.PROFILE_SLOW_THRESHOLD is not None and duration >= settings.PROFILE_SLOW_THRESHOLD
+        if sampled or slow:
+            match = request.resolver_match
+            info = {"route": match.view_name if match is not None else "unmatched", "path": request.path,
+                    "method": request.method, "status": response.status_code, "duration": duration,
+                    "reason": "slow" if slow else "sampled", "time": time()}
+            try:
+                profiling.save_profile(profiler, info)
+            except OSError:
+                logger.exception("Couldn't save the profile of %s", request.path)
+        return response
+
+    return middleware
@@ -0,0 +1,184 @@
+"""
+    This file profiles requests with cProfile, so slow requests in production can be looked into later
+    A fraction of requests (PROFILE_SAMPLE_RATE), and any request slower than PROFILE_SLOW_THRESHOLD, are saved
+    Profiles are saved in PROFILE_DIR, in a folder for each route, and only the newest PROFILE_KEEP of each are kept
+    Each profile is a pstats file, with a JSON file next to it that says which request it was
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+PROFILE_EXTENSION = ".prof"
+INFO_EXTENSION = ".json"
+
+
+def should_profile():
+    """
+    Decides whether to profile a request
+    When PROFILE_SLOW_THRESHOLD is set, every request has to be profiled, as we don't know it's slow until it's done
+
+    @return: Whether to profile the request, and whether it was picked by sampling
+    @rtype: bool, bool
+    """
+
+    sampled = settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+    return sampled or settings.PROFILE_SLOW_THRESHOLD is not None, sampled
+
+
+def start_profiler():
+    """
+    Starts profiling this thread
+
+    @return: The profiler, or None if another profiler is already running
+    @rtype: Profile
+    """
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Newer versions of Python only allow one profiler at a time
+        return None
+    return profiler
+
+
+def get_route_folder(route):
+    """
+    Gets the folder a route's profiles are kept in
+
+    @param route: The name of the route (like main:gallery)
+    @type route: str
+    @return: The path to the folder
+    @rtype: str
+    """
+
+    return os.path.join(settings.PROFILE_DIR, re.sub(r"[^\w-]", "-", route))
+
+
+def save_profile(profiler, info):
+    """
+    Saves a profile, and removes the route's oldest profiles if there are more than PROFILE_KEEP
+    The files are written under a temporary name and then renamed, so the admin page never reads half a profile
+
+    @param profiler: The profiler, it should already be disabled
+    @type profiler: Profile
+    @param info: What request this was (route, path, method, status, duration, reason, and time)
+    @type info: dict
+    """
+
+    folder = get_route_folder(info["route"])
+    os.makedirs(folder, exist_ok=True)
+    # The time goes first so sorting the names sorts the profiles from oldest to newest
+    name = f"{time.time_ns()}-{os.getpid()}"
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    os.close(file_descriptor)
+    profiler.dump_stats(temp_path)
+    os.replace(temp_path, os.path.join(folder, name + PROFILE_EXTENSION))
+    file_descriptor, temp_path = tempfile.mkstemp(dir=folder, suffix=".tmp")
+    with os.fdopen(file_descriptor, 'w') as info_file:
+        json.dump(info, info_file)
+    os.replace(temp_path, os.path.join(folder, name + INFO_EXTENSION))
+    for old_name in list_profile_names(folder)[:-settings.PROFILE_KEEP]:
+        for extension in (PROFILE_EXTENSION, INFO_EXTENSION):
+            try:
+                os.remove(os.path.join(folder, old_name + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profile_names(folder):
+    """
+    Gets the names of the profiles in a folder, from oldest to newest
+
+    @param folder: The folder to look in
+    @type folder: str
+    @return: The names, without extensions
+    @rtype: list[str]
+    """
+
+    if not os.path.isdir(folder):
+        return []
+    return sorted(file_name[:-len(PROFILE_EXTENSION)] for file_name in os.listdir(folder)
+                  if file_name.endswith(PROFILE_EXTENSION))
+
+
+def list_profiles():
+    """
+    Gets every saved profile, newest first
+
+    @return: A list of dicts with each profile's info, plus its folder and name
+    @rtype: list[dict]
+    """
+
+    profiles = []
+    if not os.path.isdir(settings.PROFILE_DIR):
+        return profiles
+    for folder_name in sorted(os.listdir(settings.PROFILE_DIR)):
+        folder = os.path.join(settings.PROFILE_DIR, folder_name)
+        for name in list_profile_names(folder):
+            try:
+                with open(os.path.join(folder, name + INFO_EXTENSION)) as info_file:
+                    info = json.load(info_file)
+            except (OSError, ValueError):
+                continue
+            info.update({"folder": folder_name, "name": name,
+                         "recorded": datetime.fromtimestamp(info["time"], tz=timezone.utc)})
+            profiles.append(info)
+    profiles.sort(key=lambda profile: profile["time"], reverse=True)
+    return profiles
+
+
+def get_profile_path(folder_name, name):
+    """
+    Gets the path to a saved profile, only names that are actually in PROFILE_DIR are allowed
+
+    @param folder_name: The name of the route's folder
+    @type folder_name: str
+    @param name: The name of the profile
+    @type name: str
+    @return: The path to the profile, or None if there's no such profile
+    @rtype: str
+    """
+
+    if not os.path.isdir(settings.PROFILE_DIR) or folder_name not in os.listdir(settings.PROFILE_DIR):
+        return None
+    folder = os.path.join(settings.PROFILE_DIR, folder_name)
+    if name not in list_profile_names(folder):
+        return None
+    return os.path.join(folder, name)
+
+
+def get_top_functions(path, limit=40):
+    """
+    Reads a profile, and gets the functions that took the most cumulative time
+
+    @param path: The path to the profile, without the extension
+    @type path: str
+    @param limit: How many functions to get
+    @type limit: int
+    @return: A list of dicts with each function's name, calls, total time, and cumulative time
+    @rtype: list[dict]
+    """
+
+    stats = pstats.Stats(path + PROFILE_EXTENSION)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    functions = []
+    for function in stats.fcn_list[:limit]:
+        primitive_calls, calls, total_time, cumulative_time, callers = stats.stats[function]
+        file_name, line, function_name = function
+        functions.append({
+            "function": function_name if file_name == "~" else f"{function_name} ({file_name}:{line})",
+            "calls": calls if calls == primitive_calls else f"{calls}/{primitive_calls}",
+            "total_ms": round(total_time * 1000, 3),
+            "cumulative_ms": round(cumulative_time * 1000, 3),
+        })
+    return functions
@@ -0,0 +1,64 @@
+"""
+    This file finds repeated queries, which usually mean a loop is running one query per row (an N+1 query)
+    Queries are grouped by their shape, which is the SQL with every literal value replaced by a ?
+    So SELECT ... WHERE id = 1 and SELECT ... WHERE id = 2 have the same shape
+"""
+
+import re
+from collections import Counter
+
+from django.conf import settings
+
+PLACEHOLDER = re.compile(r"%s")
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def get_query_shape(sql):
+    """
+    Gets the shape of a query, by replacing every literal, parameter placeholder, and list of them with a ?
+
+    @param sql: The SQL of the query
+    @type sql: str
+    @return: The shape of the query
+    @rtype: str
+    """
+
+    shape = PLACEHOLDER.sub("?", sql)
+    shape = STRING_LITERAL.sub("?", shape)
+    shape = NUMBER_LITERAL.sub("?", shape)
+    shape = VALUE_LIST.sub("(?)", shape)
+    return WHITESPACE.sub(" ", shape).strip()
+
+
+def find_repeated_queries(queries, threshold=None):
+    """
+    Finds the shapes of queries that were run at least threshold times
+
+    @param queries: The SQL of each query that was run
+    @type queries: list[str]
+    @param threshold: How many times a shape has to be repeated to count, defaults to REPEATED_QUERY_THRESHOLD
+    @type threshold: int
+    @return: A dict that maps each repeated shape to how many times it was run
+    @rtype: dict
+    """
+
+    if threshold is None:
+        threshold = settings.REPEATED_QUERY_THRESHOLD
+    counts = Counter(get_query_shape(sql) for sql in queries)
+    return {shape: count for shape, count in counts.items() if count >= threshold}
+
+
+class QueryRecorder:
+    """
+    This is a database execute wrapper that keeps the SQL of every query that's run while it's installed
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
@@ -1,10 +1,17 @@
 """
     This file has the sitemap for the site, this sitemap generates an XML document for search engines
+    The sitemap is split into sections (main pages, gallery photos, and event months) behind a sitemap index
+    Every entry has a lastmod, so search engines only need to re-fetch the pages that changed
 """
 
+from datetime import date
+
 from django.contrib import sitemaps
+from django.db.models import Max
 from django.urls import reverse
 
+from edit import models
+
 priorities = {
     'main:home': 1.0,
     'main:gallery': 0.8,
@@ -18,6 +25,28 @@ frequencies = {
 }
 
 
+def get_latest_photo():
+    """
+    Gets when the newest gallery photo was posted
+
+    @return: When the newest photo was posted, None if there aren't any
+    @rtype: datetime
+    """
+
+    return models.GalleryPhoto.objects.aggregate(latest=Max("date_posted"))["latest"]
+
+
+def get_latest_event():
+    """
+    Gets when an event was last changed
+
+    @return: When an event was last changed, None if there aren't any
+    @rtype: datetime
+    """
+
+    return models.Event.objects.aggregate(latest=Max("last_modified"))["latest"]
+
+
 def get_priority(sitemap, item):
     return priorities.get(item, 0.5)
 
@@ -36,3 +65,69 @@ class MainSiteMap(sitemaps.Sitemap):
 
     def location(self, item):
         return reverse(item)
+
+    def lastmod(self, item):
+        if item == 'main:gallery':
+            return get_latest_photo()
+        elif item == 'main:events':
+            return get_latest_event()
+        elif item == 'main:home':
+            return max([latest for latest in (get_latest_photo(), get_latest_event()) if latest is not None],
+                       default=None)
+        else:
+            return None
+
+
+class GallerySiteMap(sitemaps.Sitemap):
+    """
+    This sitemap has an entry for the page of every photo in the gallery
+    """
+
+    priority = 0.4
+    changefreq = 'never'
+    protocol = 'https'
+    limit = 1000
+
+    def items(self):
+        return models.GalleryPhoto.objects.order_by('-date_posted', 'id').only('id', 'date_posted')
+
+    def location(self, item):
+        return f"{reverse('main:view_photo')}?id={item.id}"
+
+    def lastmod(self, item):
+        return item.date_posted
+
+
+class EventMonthSiteMap(sitemaps.Sitemap):
+    """
+    This sitemap has an entry for every month that has an event, pointing to that month of the calendar
+    """
+
+    priority = 0.5
+    changefreq = 'weekly'
+    protocol = 'https'
+    limit = 1000
+
+    def items(self):
+        """
+        Gets every month an event happens in, along with when the newest change to those events was
+        An event that spans multiple months is counted in each of them
+
+        @return: A list of (year, month, last modified) tuples, newest month first
+        @rtype: list[tuple]
+        """
+
+        months = {}
+        for start, end, last_modified in models.Event.objects.values_list('startDate', 'endDate', 'last_modified'):
+            current = date(start.year, start.month, 1)
+            while current <= end:
+                key = (current.year, current.month)
+                months[key] = max(months.get(key, last_modified), last_modified)
+                current = date(current.year + current.month // 12, current.month % 12 + 1, 1)
+        return [(year, month, last_modified) for (year, month), last_modified in sorted(months.items(), reverse=True)]
+
+    def location(self, item):
+        return f"{reverse('main:events')}?month={item[1]}&year={item[0]}"
+
+    def lastmod(self, item):
+        return item[2]
@@ -0,0 +1,172 @@
+"""
+    This file measures where the time for a request goes (database, templates, context processors, and the cache)
+    A RequestTimer is attached to the current thread while a request is handled, and the hooks below add to it
+    Queries are measured with a database execute wrapper, and templates by wrapping Django's template render method
+    The template wrappers replace private parts of Django, so MainConfig only installs them if SERVER_TIMING is on
+    When no request is being measured, the hooks only do a single thread-local lookup
+"""
+
+import threading
+from contextlib import ExitStack, contextmanager
+from time import perf_counter
+
+from django.db import connections
+from django.template.backends.django import Template as BackendTemplate
+from django.template.context import RequestContext
+
+current_timer = threading.local()
+# Whether install_template_timing has wrapped Django's template rendering yet
+templates_timed = False
+install_lock = threading.Lock()
+original_render = None
+original_bind_template = None
+
+
+class RequestTimer:
+    """
+    This class holds the measurements for one request, all times are in seconds
+    """
+
+    def __init__(self):
+        self.query_count = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.context_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.total_time = 0.0
+        self.render_depth = 0
+
+    def record_query(self, execute, sql, params, many, context):
+        """
+        This is a database execute wrapper, it times every query that's run while it's installed
+
+        @return: The result of the query
+        """
+
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += perf_counter() - start
+            self.query_count += 1
+
+    def get_header(self):
+        """
+        Formats the measurements as a Server-Timing header, durations are in milliseconds
+        The template time doesn't include the time spent in context processors, that's reported as ctx
+        The template and context processor times are left out when templates aren't being timed
+
+        @return: The value of the Server-Timing header
+        @rtype: str
+        """
+
+        metrics = [f'db;dur={self.query_time * 1000:.2f};desc="{self.query_count} queries"']
+        # Templates are only measured once install_template_timing has run
+        if templates_timed:
+            metrics += [f'tpl;dur={(self.template_time - self.context_time) * 1000:.2f};desc="Templates"',
+                        f'ctx;dur={self.context_time * 1000:.2f};desc="Context processors"']
+        metrics += [f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+                    f'total;dur={self.total_time * 1000:.2f};desc="Total"']
+        return ", ".join(metrics)
+
+
+def get_current_timer():
+    """
+    Gets the timer for the request being handled on this thread
+
+    @return: The timer, or None if this request isn't being measured
+    @rtype: RequestTimer
+    """
+
+    return getattr(current_timer, "timer", None)
+
+
+@contextmanager
+def measure():
+    """
+    Measures everything that happens inside the with block
+
+    @return: The timer that holds the measurements
+    @rtype: RequestTimer
+    """
+
+    timer = RequestTimer()
+    start = perf_counter()
+    # These can be nested (the metrics middleware wraps the Server-Timing one), so we put back the outer timer after
+    outer_timer = get_current_timer()
+    current_timer.timer = timer
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(timer.record_query))
+            yield timer
+    finally:
+        timer.total_time = perf_counter() - start
+        current_timer.timer = outer_timer
+
+
+def record_cache(hit):
+    """
+    Records a lookup in the page cache
+
+    @param hit: Whether the page was found in the cache
+    @type hit: bool
+    """
+
+    timer = get_current_timer()
+    if timer is not None:
+        if hit:
+            timer.cache_hits += 1
+        else:
+            timer.cache_misses += 1
+
+
+def timed_render(self, context=None, request=None):
+    """
+    Wraps Django's template render method to time it, templates rendered inside another one aren't counted twice
+    """
+
+    timer = get_current_timer()
+    if timer is None:
+        return original_render(self, context, request)
+    timer.render_depth += 1
+    start = perf_counter()
+    try:
+        return original_render(self, context, request)
+    finally:
+        timer.render_depth -= 1
+        if timer.render_depth == 0:
+            timer.template_time += perf_counter() - start
+
+
+@contextmanager
+def timed_bind_template(self, template):
+    """
+    Wraps RequestContext.bind_template, which is where the context processors are run, to time them
+    """
+
+    timer = get_current_timer()
+    start = perf_counter()
+    with original_bind_template(self, template):
+        # Templates rendered inside another template are already part of the outer template's time
+        if timer is not None and timer.render_depth <= 1:
+            timer.context_time += perf_counter() - start
+        yield
+
+
+def install_template_timing():
+    """
+    Wraps Django's template render method and RequestContext.bind_template so templates can be timed
+    These are private parts of Django, so this is only done when asked (see MainConfig), and only ever once
+    """
+
+    global templates_timed, original_render, original_bind_template
+    with install_lock:
+        if templates_timed:
+            return
+        original_render = BackendTemplate.render
+        original_bind_template = RequestContext.bind_template
+        BackendTemplate.render = timed_render
+        RequestContext.bind_template = timed_bind_template
+        templates_timed = True
@@ -4,17 +4,25 @@
 """
 
 from django.conf import settings
-from django.contrib.sitemaps.views import sitemap
+from django.contrib.sitemaps import views as sitemap_views
 from django.urls import path
 
+from edit import models
 from main import views, sitemaps
+from main.cache import public_page
 
 app_name = "main"
 
 sitemaps = {
-    'main': sitemaps.MainSiteMap
+    'main': sitemaps.MainSiteMap,
+    'gallery': sitemaps.GallerySiteMap,
+    'events': sitemaps.EventMonthSiteMap,
 }
 
+# The sitemaps are cached until a photo or event changes
+sitemap_index = public_page(models.GalleryPhoto, models.Event)(sitemap_views.index)
+sitemap = public_page(models.GalleryPhoto, models.Event)(sitemap_views.sitemap)
+
 urlpatterns = [
     path('', views.home, name="home"),
     path('gallery/', views.gallery, name="gallery"),
@@ -22,11 +30,15 @@ urlpatterns = [
     path('gallery/view/', views.view_photo, name="view_photo"),
     path('officers/', views.officers, name="officers"),
     path('events/', views.events, name="events"),
+    path('events/calendar.ics', views.calendar_feed, name="calendar_feed"),
     path('about/', views.safe_render("about.html"), name="about"),
     path('unsupported/', views.safe_render("ie-card.html"), name="ie"),
     path('sitemap/', views.safe_render("sitemap.html"), name="sitemap"),
-    path('sitemap.xml/', sitemap, {'sitemaps': sitemaps}, name='django.contrib.sitemaps.views.sitemap'),
-    path('robots.txt/', views.robots, name="robots")
+    path('sitemap.xml/', sitemap_index, {'sitemaps': sitemaps, 'sitemap_url_name': 'main:sitemap_section'},
+         name='sitemap_index'),
+    path('sitemap-<section>.xml/', sitemap, {'sitemaps': sitemaps}, name='sitemap_section'),
+    path('robots.txt/', views.robots, name="robots"),
+    path('metrics/', views.metrics, name="metrics")
 ]
 
 if settings.DEBUG:
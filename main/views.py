@@ -1,21 +1,27 @@
 import calendar
-from datetime import date
+from datetime import date, timedelta
+from hashlib import md5
 
+from django.conf import settings
 from django.core.paginator import Paginator
-from django.db.models import Q
+from django.db.models import Count, Max, OuterRef, Subquery
 from django.forms import ValidationError
-from django.http import Http404, JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.template.exceptions import TemplateDoesNotExist
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_safe, require_http_methods
+from django.views.decorators.http import condition, require_safe, require_http_methods
 
 from edit import models
-from edit.webcal import CALENDAR_URL
+from edit.pagination import get_keyset_ordering, get_keyset_page, keyset_filter, reverse_ordering
+from edit.webcal import stream_calendar
+from main.cache import public_page
+from main.metrics import has_scrape_token, render_metrics
 
 
 @require_safe
+@public_page(models.Event, models.GalleryPhoto, models.ExternalLink)
 def home(request):
     """
     This view function renders the home page
@@ -35,6 +41,7 @@ def home(request):
 
 
 MAX_IMAGES_PER_PAGE = 12
+GALLERY_ORDERING = get_keyset_ordering(models.GalleryPhoto)
 
 
 @csrf_exempt
@@ -42,30 +49,54 @@ MAX_IMAGES_PER_PAGE = 12
 def get_gallery_page(request):
     """
     This view is to be called via AJAX to get more photos to load in the gallery page
+    If a cursor is sent, we return the photos that come after it, along with the cursor for the next set
+    Otherwise, we fall back to the older page number system
 
     @param request: A django request object
     @type request: HttpRequest
-    @return: A json object that has the photos, and whether there are more photos to load
+    @return: A json object that has the photos, and the cursor to the next photos (or whether there are more photos)
     @rtype: JsonResponse
     """
 
-    target_page_number = request.POST.get("page", 1)
-    photo_objects = models.GalleryPhoto.objects.all()
-    photo_paginator = Paginator(photo_objects, MAX_IMAGES_PER_PAGE, allow_empty_first_page=True)
-    target_page = photo_paginator.get_page(target_page_number)
-    start = target_page.start_index() - 1
-    if start < 0:
-        start = 0
-    target_list = list(photo_objects[start:target_page.end_index()])
+    if "cursor" in request.POST:
+        try:
+            target_list, next_cursor = get_keyset_page(models.GalleryPhoto.objects.all(), GALLERY_ORDERING,
+                                                       MAX_IMAGES_PER_PAGE, cursor=request.POST.get("cursor"))
+        except ValueError:
+            raise Http404("Invalid Cursor")
+        return JsonResponse({'photos': photos_as_json(target_list), 'next_cursor': next_cursor})
+    else:
+        target_page_number = request.POST.get("page", 1)
+        photo_objects = models.GalleryPhoto.objects.all()
+        photo_paginator = Paginator(photo_objects, MAX_IMAGES_PER_PAGE, allow_empty_first_page=True)
+        target_page = photo_paginator.get_page(target_page_number)
+        start = target_page.start_index() - 1
+        if start < 0:
+            start = 0
+        target_list = list(photo_objects[start:target_page.end_index()])
+        return JsonResponse({'photos': photos_as_json(target_list), 'hasNext': target_page.has_next()})
+
+
+def photos_as_json(photo_list):
+    """
+    Converts a list of photos into a list of dicts that can be sent to gallery.js
+
+    @param photo_list: The photos to convert
+    @type photo_list: list[models.GalleryPhoto]
+    @return: A list of dicts that represent the photos
+    @rtype: list[dict]
+    """
+
     view_link_base = reverse("main:view_photo")
-    photos = [
-        {'id': photo.id, 'src': photo.photo_link(), 'link': f"{view_link_base}?id={photo.id}", 'alt': photo.caption,
-         'height': photo.height, 'width': photo.width}
-        for photo in target_list]
-    return JsonResponse({'photos': photos, 'hasNext': target_page.has_next()})
+    return [
+        {'id': photo.id, 'src': photo.thumb_link(), 'srcset': photo.srcset(), 'webp_srcset': photo.webp_srcset(),
+         'link': f"{view_link_base}?id={photo.id}", 'alt': photo.caption, 'height': photo.height,
+         'width': photo.width}
+        for photo in photo_list]
 
 
 @require_safe
+@public_page(models.GalleryPhoto)
 def gallery(request):
     """
     This view renders the gallery page, it only renders a few images at first,
@@ -77,63 +108,61 @@ def gallery(request):
     @rtype: HttpResponse
     """
 
-    photo_objects = models.GalleryPhoto.objects.all()
-    photo_paginator = Paginator(photo_objects, MAX_IMAGES_PER_PAGE, allow_empty_first_page=True)
-    first_page = photo_paginator.get_page(1)
-    first_list = models.GalleryPhoto.objects.all()[0:first_page.end_index()]
-    return render(request, "gallery.html", {"photos": first_list, 'hasNext': first_page.has_next()})
+    first_list, next_cursor = get_keyset_page(models.GalleryPhoto.objects.all(), GALLERY_ORDERING,
+                                              MAX_IMAGES_PER_PAGE)
+    return render(request, "gallery.html", {"photos": first_list, 'hasNext': next_cursor is not None,
+                                            'next_cursor': next_cursor})
 
 
-def get_last_photo(photo, featured_only):
+def get_neighbor_query(featured_only, ordering):
     """
-    This function is used by photo_view to get the previous photo relative to another photo
+    This function builds a subquery that finds the first photo after the outer photo in the given ordering
 
-    @param photo: The photo to check
-    @type photo: models.GalleryPhoto
     @param featured_only: whether to only get featured photos
     @type featured_only: bool
-    @return: The previous photo object, if any
-    @rtype: models.GalleryPhoto
+    @param ordering: The keyset ordering to move through
+    @type ordering: list[str]
+    @return: A queryset that can be used with Subquery to find a neighbor
+    @rtype: QuerySet
     """
 
-    try:
-        query = models.GalleryPhoto.objects.exclude(date_posted=photo.date_posted).filter(
-            date_posted__gte=photo.date_posted).order_by("date_posted")
-        if featured_only:
-            return query.filter(featured=True)[0]
-        else:
-            return query[0]
-    except IndexError:
-        return None
+    query = models.GalleryPhoto.objects.all()
+    if featured_only:
+        query = query.filter(featured=True)
+    outer_values = [OuterRef(field.lstrip("-")) for field in ordering]
+    return query.filter(keyset_filter(ordering, outer_values)).order_by(*ordering)
 
 
-def get_next_photo(photo, featured_only):
+def get_photo_with_neighbors(target_id, featured_only):
     """
-    This function is used by photo_view to get the next photo relative to another photo
+    This function is used by photo_view to get a photo along with the photos before and after it
+    The neighbors are found with subqueries, so everything is fetched in one round trip
+    We move through the photos with (date_posted, id), so photos that share a timestamp aren't skipped
 
-    @param photo: The photo to check
-    @type photo: models.GalleryPhoto
-    @param featured_only: whether to only get featured photos
+    @param target_id: The id of the photo to get
+    @type target_id: str
+    @param featured_only: whether to only get featured photos as neighbors
     @type featured_only: bool
-    @return: The next photo object, if any
+    @return: The photo, with next_id, next_picture, last_id, and last_picture set (None if there's no neighbor)
     @rtype: models.GalleryPhoto
+    @raise Http404: If the photo doesn't exist
     """
 
-    try:
-        query = models.GalleryPhoto.objects.exclude(date_posted=photo.date_posted).filter(
-            date_posted__lte=photo.date_posted).order_by("-date_posted")
-        if featured_only:
-            return query.filter(featured=True)[0]
-        else:
-            return query[0]
-    except IndexError:
-        return None
+    next_query = get_neighbor_query(featured_only, GALLERY_ORDERING)
+    last_query = get_neighbor_query(featured_only, reverse_ordering(GALLERY_ORDERING))
+    query = models.GalleryPhoto.objects.annotate(next_id=Subquery(next_query.values("id")[:1]),
+                                                 next_picture=Subquery(next_query.values("picture")[:1]),
+                                                 last_id=Subquery(last_query.values("id")[:1]),
+                                                 last_picture=Subquery(last_query.values("picture")[:1]))
+    return get_object_or_404(query, id=target_id)
 
 
 @require_safe
+@public_page(models.GalleryPhoto)
 def view_photo(request):
     """
     This view renders a specific photo and lets you go to the next or the previous
+    If featured is set to "yes", we only move between featured photos
 
     @param request: A django request object
     @type request: HttpRequest
@@ -145,20 +174,21 @@ def view_photo(request):
     featured = request.GET.get("featured", "no")
     featured_only = featured == "yes"
     try:
-        target_photo = get_object_or_404(models.GalleryPhoto, id=target_id)
-        next_photo = get_next_photo(target_photo, featured_only)
-        last_photo = get_last_photo(target_photo, featured_only)
-        next_link = None if next_photo is None else f"{reverse('main:view_photo')}" \
-                                                    f"?id={next_photo.id}&featured={featured}"
-        last_link = None if last_photo is None else f"{reverse('main:view_photo')}" \
-                                                    f"?id={last_photo.id}&featured={featured}"
-        return render(request, "photo_view.html",
-                      {"photo": target_photo, "next_link": next_link, "last_link": last_link})
+        target_photo = get_photo_with_neighbors(target_id, featured_only)
     except ValidationError:
         raise Http404()
+    link_base = reverse('main:view_photo')
+    next_link = None if target_photo.next_id is None else f"{link_base}?id={target_photo.next_id}&featured={featured}"
+    last_link = None if target_photo.last_id is None else f"{link_base}?id={target_photo.last_id}&featured={featured}"
+    prefetch_links = [f"{settings.MEDIA_URL}{picture}" for picture in
+                      (target_photo.next_picture, target_photo.last_picture) if picture]
+    return render(request, "photo_view.html",
+                  {"photo": target_photo, "next_link": next_link, "last_link": last_link,
+                   "prefetch_links": prefetch_links})
 
 
 @require_safe
+@public_page(models.Officer)
 def officers(request):
     """
     This view renders the officers and displays their info
@@ -230,7 +260,33 @@ def get_next_and_previous_links(month, year, view_type):
     return next_link, previous_link
 
 
+def get_events_by_date(event_list, first_day, last_day):
+    """
+    Builds an index of which events happen on each day between two dates
+    Every day an event spans is included, not just the days it starts and ends on
+
+    @param event_list: The events to index
+    @type event_list: list[models.Event]
+    @param first_day: The first day to include in the index
+    @type first_day: date
+    @param last_day: The last day to include in the index
+    @type last_day: date
+    @return: A dict that maps each date to a list of events on that date
+    @rtype: dict
+    """
+
+    events_by_date = {}
+    for event in event_list:
+        current_day = max(event.startDate, first_day)
+        end_day = min(event.endDate, last_day)
+        while current_day <= end_day:
+            events_by_date.setdefault(current_day, []).append(event)
+            current_day += timedelta(days=1)
+    return events_by_date
+
+
 @require_safe
+@public_page(models.Event)
 def events(request):
     """
     This view renders events to either a calendar, or a list view
@@ -245,29 +301,138 @@ def events(request):
 
     if view_type == "calendar" or view_type == "list":
         try:
-            calendar.setfirstweekday(calendar.SUNDAY)
             today = date.today()
             month = int(request.GET.get("month", today.month))
             year = int(request.GET.get("year", today.year))
-            month_calendar = calendar.monthcalendar(year, month)
-            month_name = calendar.month_name[month]
-            matching_events = models.Event.objects.filter(
-                (Q(startDate__month=month) & Q(startDate__year=year)) | (
-                        Q(endDate__month=month) & Q(endDate__year=year)))
-            next_link, previous_link = get_next_and_previous_links(month, year, view_type)
-            return render(request, f"events-{view_type}.html",
-                          {"events": matching_events, "weeks": month_calendar, 'today': today, "month": month,
-                           "month_name": month_name, "year": year,
-                           "next_link": next_link, "previous_link": previous_link,
-                           "weekdays": ["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"], 'ics_link': CALENDAR_URL})
+            if month < 1 or month > 12:
+                raise calendar.IllegalMonthError(month)
+            # We use our own Calendar object, as calendar.setfirstweekday changes global state shared between threads
+            month_calendar = calendar.Calendar(firstweekday=calendar.SUNDAY)
+            month_dates = month_calendar.monthdatescalendar(year, month)
+            first_day = date(year, month, 1)
+            last_day = date(year, month, calendar.monthrange(year, month)[1])
         except calendar.IllegalMonthError:
             raise Http404("Invalid Month")
-        except ValueError:
+        except (ValueError, OverflowError):
             raise Http404("Invalid Month/Year")
+        month_name = calendar.month_name[month]
+        matching_events = list(models.Event.objects.filter(startDate__lte=last_day, endDate__gte=first_day))
+        events_by_date = get_events_by_date(matching_events, first_day, last_day)
+        weeks = [[(day.day, day, events_by_date.get(day, [])) if day.month == month else (0, None, [])
+                  for day in week] for week in month_dates]
+        next_link, previous_link = get_next_and_previous_links(month, year, view_type)
+        return render(request, f"events-{view_type}.html",
+                      {"events": matching_events, "weeks": weeks, 'today': today, "month": month,
+                       "month_name": month_name, "year": year,
+                       "next_link": next_link, "previous_link": previous_link,
+                       "weekdays": ["SUN", "MON", "TUE", "WED", "THU", "FRI", "SAT"],
+                       'ics_link': reverse("main:calendar_feed")})
     else:
         raise Http404("Invalid View Type")
 
 
+# The values the "type" filter of the calendar feed accepts, and whether they mean virtual events
+CALENDAR_FEED_TYPES = {"virtual": True, "in-person": False}
+
+
+def get_feed_events(request):
+    """
+    Gets the events to put in the calendar feed, based off the filters in the query string:
+        from: Only events that end on or after this date (YYYY-MM-DD)
+        to: Only events that start on or before this date (YYYY-MM-DD)
+        type: Only "virtual" or "in-person" events
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: The events that match the filters
+    @rtype: QuerySet
+    @raise Http404: If a filter is invalid
+    """
+
+    events = models.Event.objects.all()
+    try:
+        if request.GET.get("from"):
+            events = events.filter(endDate__gte=date.fromisoformat(request.GET["from"]))
+        if request.GET.get("to"):
+            events = events.filter(startDate__lte=date.fromisoformat(request.GET["to"]))
+    except ValueError:
+        raise Http404("Invalid Date")
+    if request.GET.get("type"):
+        if request.GET["type"] not in CALENDAR_FEED_TYPES:
+            raise Http404("Invalid Event Type")
+        events = events.filter(virtual=CALENDAR_FEED_TYPES[request.GET["type"]])
+    return events.order_by("id")
+
+
+def get_feed_state(request):
+    """
+    Gets how many events are in the feed and when the newest change was
+    An edit changes the latest time, and a delete changes the count, so together they tell us if the feed changed
+    This is stored on the request, as both the ETag and Last-Modified need it
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: The number of events, and the latest time one of them was modified (None if there are no events)
+    @rtype: int, datetime
+    """
+
+    if not hasattr(request, "calendar_feed_state"):
+        state = get_feed_events(request).aggregate(count=Count("id"), latest=Max("last_modified"))
+        request.calendar_feed_state = state["count"], state["latest"]
+    return request.calendar_feed_state
+
+
+def get_feed_etag(request):
+    """
+    Generates a strong ETag for the calendar feed from the filters and the state of the matching events
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: The ETag for the feed
+    @rtype: str
+    """
+
+    count, latest = get_feed_state(request)
+    filters = "&".join(f"{key}={request.GET.get(key, '')}" for key in ("from", "to", "type"))
+    latest_text = latest.isoformat() if latest is not None else ""
+    return md5(f"{filters}:{count}:{latest_text}".encode("utf-8")).hexdigest()
+
+
+def get_feed_last_modified(request):
+    """
+    Gets when the calendar feed last changed
+    Deleting an event doesn't leave a last_modified behind, so we also use when the Event model last changed
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: The latest time one of the events was modified or deleted
+    @rtype: datetime
+    """
+
+    latest = get_feed_state(request)[1]
+    model_updated = models.ModelVersion.get_versions(["edit.Event"])["edit.Event"][1]
+    return max([changed for changed in (latest, model_updated) if changed is not None], default=None)
+
+
+@require_safe
+@condition(etag_func=get_feed_etag, last_modified_func=get_feed_last_modified)
+def calendar_feed(request):
+    """
+    This view streams our events as an iCalendar file, calendar apps subscribe to this with the webcal protocol
+    If the feed hasn't changed since the app last checked, it gets an empty 304 response
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: A response to the request
+    @rtype: StreamingHttpResponse
+    """
+
+    response = StreamingHttpResponse(stream_calendar(get_feed_events(request)),
+                                     content_type="text/calendar; charset=utf-8")
+    response["Content-Disposition"] = f'inline; filename="{settings.ICAL_FILE_NAME}.ics"'
+    return response
+
+
 def safe_render(template_name, ctx=None):
     """
     This function is used as a shortcut to generate a view that renders a given html file safely
@@ -282,6 +447,7 @@ def safe_render(template_name, ctx=None):
         ctx = {}
 
     @require_safe
+    @public_page()
     def render_view(request):
         return render(request, template_name, ctx)
 
@@ -308,6 +474,25 @@ def test_error(request):
         raise Http404()
 
 
+@require_safe
+def metrics(request):
+    """
+    This view reports metrics about every route in Prometheus' text format
+    Only staff users, requests with the METRICS_TOKEN, and requests from METRICS_ALLOWED_ADDRESSES can see it
+
+    @param request: A django request object
+    @type request: HttpRequest
+    @return: A response to the request
+    @rtype: HttpResponse
+    """
+
+    if request.user.is_staff or has_scrape_token(request) or \
+            request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_ADDRESSES:
+        return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+    else:
+        raise Http404()
+
+
 def robots(request):
     """
     This view renders robots.txt for search engines
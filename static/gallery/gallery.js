@@ -1,32 +1,37 @@
-function requestNextImageSet(number) {
+function requestNextImageSet(cursor) {
     return new Promise((resolve) => {
-        $.post("/gallery-page/", {'page': number}, (data) => {
+        $.post("/gallery-page/", {'cursor': cursor}, (data) => {
             resolve(data);
         });
     });
 }
 
 $(document).ready(function() {
-    let current = 1;
     let grid = $(".image-grid");
     let cell = $("#load-images-cell")
     let button = $("#load-images-button");
+    let cursor = button.data("cursor");
+    let sizes = grid.data("sizes");
     button.click(function() {
-        current++;
         button.addClass("is-loading");
-        requestNextImageSet(current).then(function(results) {
+        requestNextImageSet(cursor).then(function(results) {
             let photos = results["photos"];
             for (let photo of photos) {
                 let appendString = `
                 <div class="image-grid-cell">
                     <a href="${photo["link"]}" class="image-grid-item-wrapper">
-                        <img class="image-grid-item" src="${photo["src"]}" alt="${photo["alt"]}" />
+                        <picture class="responsive-picture">
+                            ${photo["webp_srcset"] ? `<source type="image/webp" srcset="${photo["webp_srcset"]}" sizes="${sizes}">` : ""}
+                            <img class="image-grid-item" src="${photo["src"]}" alt="${photo["alt"]}"
+                                 ${photo["srcset"] ? `srcset="${photo["srcset"]}" sizes="${sizes}"` : ""} />
+                        </picture>
                     </a>
                 </div>`;
                 cell.detach()
                 $(appendString).appendTo(grid);
             }
-            if (results["hasNext"]) {
+            cursor = results["next_cursor"];
+            if (cursor) {
                 grid.append(cell);
                 button.removeClass("is-loading");
             }
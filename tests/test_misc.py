@@ -1,15 +1,26 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
 from datetime import date, time
 
 from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import AnonymousUser
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections
+from django.db.models.functions import Length
 from django.shortcuts import redirect
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, RequestFactory, Client, override_settings
+from django.urls import reverse
 
-from edit import models, views, forms, exceptions
+from edit import benchmark, microbenchmarks, models, views, forms, exceptions, webcal
 from edit.templatetags import adminTags, eventTags, socialTags
-from edit.view_set import ViewSet
+from edit.management.commands.loadtest import LoadTest
+from edit.view_set import ViewSet, ComputedColumn
 from main import contexts
+from main.querycheck import get_query_shape, find_repeated_queries
 from tests import utils
 from tests.utils import test_url, test_email
 
@@ -299,6 +310,41 @@ class ViewSetConfigurations(TestCase):
         except exceptions.ImproperlyConfiguredViewSetError:
             self.fail()
 
+    def test_computed_column_checks(self):
+        class NotDisplayedVS(ViewSet):
+            model = models.ExternalLink
+            modelForm = forms.LinkForm
+            displayFields = ["url"]
+            displayName = "Link"
+            computedColumns = {"display_name": ComputedColumn(str)}
+
+        class UnknownFieldVS(ViewSet):
+            model = models.ExternalLink
+            modelForm = forms.LinkForm
+            displayFields = ["url"]
+            displayName = "Link"
+            computedColumns = {"url": ComputedColumn(str, fields=["asdf"])}
+
+        self.assertRaises(exceptions.ImproperlyConfiguredViewSetError, NotDisplayedVS)
+        self.assertRaises(exceptions.ImproperlyConfiguredViewSetError, UnknownFieldVS)
+
+    def test_computed_columns(self):
+        class ComputedVS(ViewSet):
+            model = models.ExternalLink
+            modelForm = forms.LinkForm
+            displayFields = ["display_name", "name_length"]
+            displayName = "Link"
+            labels = {"name_length": "Length"}
+            computedColumns = {
+                "display_name": ComputedColumn(lambda row: f"{row['display_name']} ({row['url']})", fields=["url"]),
+                "name_length": ComputedColumn(lambda row: row["length"],
+                                              annotations={"length": Length("display_name")}),
+            }
+
+        link = models.ExternalLink.objects.create(display_name="Four", url=test_url)
+        self.assertEqual(ComputedVS().get_overview_rows(models.ExternalLink.objects.all()),
+                         [[f"Four ({test_url})", 4, link.id]])
+
     def test_registered_viewsets(self):
         for vs in views.REGISTERED_VIEWSETS:
             try:
@@ -309,3 +355,208 @@ class ViewSetConfigurations(TestCase):
             views.UserViewSet()
         except exceptions.ImproperlyConfiguredViewSetError:
             self.fail()
+
+
+class CalendarFile(TestCase):
+    def setUp(self):
+        self.first_event = models.Event.objects.create(name="First Event", startDate=date(2021, 3, 5),
+                                                       endDate=date(2021, 3, 5), startTime=time(10, 30),
+                                                       endTime=time(11, 30), location="Test", description="Test")
+        self.second_event = models.Event.objects.create(name="Second Event", startDate=date(2021, 4, 5),
+                                                        endDate=date(2021, 4, 5), startTime=time(10, 30),
+                                                        endTime=time(11, 30), location="Test", description="Test")
+        self.path = os.path.join(tempfile.mkdtemp(), "calendar.ics")
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def read_file(self):
+        webcal.update_file(path=self.path)
+        with open(self.path, 'rb') as calendar_file:
+            return calendar_file.read()
+
+    def test_missing_components_are_filled(self):
+        self.read_file()
+        for event in models.Event.objects.all():
+            self.assertEqual(event.ical_component, webcal.serialize_event(event))
+
+    def test_same_as_calendar_object(self):
+        cal = webcal.setup_calendar()
+        for event in models.Event.objects.order_by("id"):
+            cal.add_component(webcal.make_calendar_event(event))
+        self.assertEqual(self.read_file(), cal.to_ical())
+
+    def test_unchanged_output_is_identical(self):
+        self.assertEqual(self.read_file(), self.read_file())
+
+    def test_stamp_from_last_modified(self):
+        component = webcal.serialize_event(self.first_event)
+        self.assertIn(f"DTSTAMP;VALUE=DATE-TIME:{self.first_event.last_modified.strftime('%Y%m%dT%H%M%SZ')}", component)
+
+    def test_only_changed_event_is_refreshed(self):
+        self.read_file()
+        old_second = models.Event.objects.get(id=self.second_event.id).ical_component
+        # Saving outside of the admin site (like from the shell) still refreshes the stored component
+        self.first_event.name = "Renamed Event"
+        self.first_event.save()
+        self.assertIn("Renamed Event", models.Event.objects.get(id=self.first_event.id).ical_component)
+        contents = self.read_file().decode("utf-8")
+        self.assertIn("Renamed Event", contents)
+        self.assertIn(old_second, contents)
+        self.assertEqual(models.Event.objects.get(id=self.second_event.id).ical_component, old_second)
+
+    def test_write_replaces_file(self):
+        webcal.write_calendar(b"old", path=self.path)
+        webcal.write_calendar(b"new", path=self.path)
+        with open(self.path, 'rb') as calendar_file:
+            self.assertEqual(calendar_file.read(), b"new")
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ["calendar.ics"])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+    def test_write_creates_missing_folders(self):
+        # On a clean checkout neither the media folder nor the calendar folder exist yet
+        path = os.path.join(os.path.dirname(self.path), "media", "event-calendar", "calendar.ics")
+        webcal.write_calendar(b"new", path=path)
+        with open(path, 'rb') as calendar_file:
+            self.assertEqual(calendar_file.read(), b"new")
+
+    @override_settings(CALENDAR_REBUILD_DELAY=None)
+    def test_synchronous_update(self):
+        webcal.schedule_update(path=self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+    @override_settings(CALENDAR_REBUILD_DELAY=0.01)
+    def test_updates_are_coalesced(self):
+        timers = []
+        timer_class = threading.Timer
+
+        def make_timer(*args, **kwargs):
+            timers.append(timer_class(*args, **kwargs))
+            return timers[-1]
+
+        with mock.patch("edit.webcal.update_file") as update_file, \
+                mock.patch("edit.webcal.threading.Timer", side_effect=make_timer):
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(3):
+                    webcal.schedule_update(path=self.path)
+                self.assertEqual(timers, [])
+            self.assertEqual(len(timers), 1)
+            timers[0].join()
+            update_file.assert_called_once_with(path=self.path)
+            self.assertIsNone(webcal.rebuild_timer)
+
+
+class QueryShapes(TestCase):
+    def test_literals_are_replaced(self):
+        self.assertEqual(get_query_shape("SELECT * FROM edit_event WHERE id = 'abc' AND  sort_order > 3"),
+                         "SELECT * FROM edit_event WHERE id = ? AND sort_order > ?")
+        self.assertEqual(get_query_shape("SELECT * FROM edit_event WHERE id IN (%s, %s, %s)"),
+                         get_query_shape("SELECT * FROM edit_event WHERE id IN (%s)"))
+
+    def test_find_repeated_queries(self):
+        queries = [f"SELECT * FROM edit_event WHERE id = {counter}" for counter in range(5)] + ["SELECT 1"]
+        self.assertEqual(find_repeated_queries(queries, threshold=5), {"SELECT * FROM edit_event WHERE id = ?": 5})
+        self.assertEqual(find_repeated_queries(queries, threshold=6), {})
+
+
+class Benchmark(TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 0.5), 50)
+        self.assertEqual(benchmark.percentile(values, 0.95), 95)
+        self.assertEqual(benchmark.percentile(values, 0.99), 99)
+        self.assertEqual(benchmark.percentile([], 0.5), 0)
+
+    def test_seed_and_measure(self):
+        counts = {"events": 3, "photos": 2, "officers": 2, "links": 2, "socials": 2, "users": 2}
+        admin = benchmark.seed_data(counts, image_size=None)
+        self.assertEqual(models.Event.objects.count(), 3)
+        self.assertEqual(models.User.objects.count(), 3)
+        results = benchmark.measure_routes(benchmark.get_client(admin), benchmark.get_admin_routes(), 1, warmup=0)
+        self.assertIn("edit:event_view", results)
+        for summary in results.values():
+            self.assertEqual(summary["statuses"], [200])
+            self.assertGreater(summary["bytes"], 0)
+
+    def test_compare_to_baseline(self):
+        baseline = {"main:home": {"p95_ms": 10.0, "queries": 3}, "main:gallery": {"p95_ms": 10.0, "queries": 3}}
+        results = {"main:home": {"p95_ms": 20.0, "queries": 3}, "main:gallery": {"p95_ms": 10.5, "queries": 4},
+                   "main:new": {"p95_ms": 50.0, "queries": 9}}
+        regressions = benchmark.compare_to_baseline(results, baseline, 1.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("main:home: p95"))
+        self.assertTrue(regressions[1].startswith("main:gallery: queries"))
+
+    def test_load_test_gallery_cursors(self):
+        benchmark.seed_data({"photos": 30}, image_size=None)
+        cursors = LoadTest.get_gallery_cursors()
+        self.assertEqual(len(cursors), 3)
+        self.assertEqual(cursors[0], "")
+        seen_ids = []
+        for cursor in cursors:
+            response = Client().post(reverse("main:gallery_page"), {"cursor": cursor})
+            self.assertEqual(response.status_code, 200)
+            seen_ids += [photo["id"] for photo in response.json()["photos"]]
+        self.assertEqual(len(set(seen_ids)), 30)
+
+    def test_measure_memory(self):
+        admin = benchmark.seed_data({"links": 3}, image_size=None)
+        link_view_set = views.LinkViewSet()
+        routes = [("edit:link_view", "get", link_view_set.overview_link(), None),
+                  ("edit:link_add", "post", link_view_set.edit_link(),
+                   lambda: {"display_name": "Memory Link", "url": test_url})]
+        results = benchmark.measure_memory(benchmark.get_client(admin), routes, warmup=0, top=3)
+        self.assertEqual(results["edit:link_view"]["status"], 200)
+        self.assertEqual(results["edit:link_add"]["status"], 302)
+        self.assertGreater(results["edit:link_view"]["peak_bytes"], 0)
+        self.assertLessEqual(len(results["edit:link_view"]["sites"]), 3)
+        self.assertEqual(models.ExternalLink.objects.filter(display_name="Memory Link").count(), 1)
+
+    def test_find_over_budget(self):
+        results = {"main:home": {"peak_bytes": 2048}, "main:gallery": {"peak_bytes": 512}}
+        self.assertEqual(benchmark.find_over_budget(results, {"main:gallery": 1024}), [])
+        self.assertEqual(len(benchmark.find_over_budget(results, {"main:gallery": 256})), 1)
+        self.assertEqual(len(benchmark.find_over_budget(results, {}, default_budget=1024)), 1)
+
+    def test_micro_benchmarks(self):
+        cases = microbenchmarks.get_cases()
+        for function in cases.values():
+            function()
+        # The event rows are formatted the way the overview formats them, with virtual events linking to the meeting
+        event_rows = cases[f"EventViewSet.format_overview_rows ({microbenchmarks.OVERVIEW_ROWS} rows)"]()
+        self.assertIn("https://example.org/meeting", event_rows[0][2])
+        self.assertEqual(event_rows[1][2], "123 Example Street")
+        results = microbenchmarks.run_cases(cases, rounds=2, warmup=0, minimum_round_time=0, only="eventTags")
+        self.assertEqual(len(results), 2)
+        for summary in results.values():
+            self.assertEqual(summary["number"], 1)
+            self.assertLessEqual(summary["min_us"], summary["median_us"])
+
+    def test_compare_micro_benchmarks(self):
+        baseline = {"fast": {"median_us": 1.0}, "slow": {"median_us": 100.0}}
+        results = {"fast": {"median_us": 1.04}, "slow": {"median_us": 120.0}, "new": {"median_us": 5.0}}
+        self.assertEqual(microbenchmarks.compare_to_baseline(results, baseline, 1.01),
+                         ["slow: median went from 100.0us to 120.0us"])
+
+    def test_wsgi_requests(self):
+        from BerksDentalAssistants.wsgi import application
+
+        link = models.ExternalLink.objects.create(display_name="Load Link", url=test_url)
+        admin = models.User.objects.create_superuser(username="load_admin", password="Testing123")
+        cookies, csrf_token = benchmark.get_session_cookies(admin)
+        # The handler closes the database connection after each request, which would end the test's transaction
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            status, size = benchmark.call_wsgi(application, benchmark.make_environ("GET", "/"))
+            self.assertEqual(status, 200)
+            self.assertGreater(size, 0)
+            environ = benchmark.make_environ("POST", views.LinkViewSet().order_link(),
+                                             data={"new_order": str(link.id)}, cookies=cookies, csrf_token=csrf_token)
+            self.assertEqual(benchmark.call_wsgi(application, environ)[0], 302)
+            environ = benchmark.make_environ("POST", views.LinkViewSet().order_link(),
+                                             data={"new_order": str(link.id)}, cookies=cookies)
+            self.assertEqual(benchmark.call_wsgi(application, environ)[0], 403)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
@@ -1,8 +1,13 @@
+import os
 from datetime import date, time
+from io import BytesIO
 
-from django.test import TestCase, RequestFactory
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, RequestFactory, override_settings
+from PIL import Image
 
-from edit import models, views
+from edit import models, views, images, signals
 from tests import utils
 from tests.utils import test_url, test_email, test_image_path
 
@@ -75,5 +80,134 @@ class PhotoModelUtilFunctions(TestCase):
     def test_photo_link(self):
         self.assertEqual(self.picture.photo_link(), f"/media/galleryphoto-pictures/{self.picture.id}.png")
 
+    def test_derivatives(self):
+        # The test image is 480px wide, so we should stop after the size that reaches its full width
+        self.assertEqual(list(self.picture.derivatives.keys()), ["grid", "medium"])
+        self.assertEqual(self.picture.derivatives["medium"]["width"], 480)
+        for entry in self.picture.derivatives.values():
+            for format_name in images.DERIVATIVE_FORMATS.keys():
+                self.assertTrue(os.path.exists(settings.MEDIA_ROOT + entry[format_name]))
+
+    def test_thumb_link(self):
+        self.assertEqual(self.picture.thumb_link(),
+                         f"/media/galleryphoto-pictures/derivatives/{self.picture.id}-grid.jpg")
+        self.assertEqual(models.GalleryPhoto(caption="No Copies").thumb_link(), "/media/")
+
+    def test_srcset(self):
+        self.assertIn(f"{self.picture.id}-grid.jpg 400w", self.picture.srcset())
+        self.assertIn(f"{self.picture.id}-medium.jpg 480w", self.picture.srcset())
+        if "webp" in images.DERIVATIVE_FORMATS:
+            self.assertIn(f"{self.picture.id}-grid.webp 400w", self.picture.webp_srcset())
+        else:
+            self.assertEqual(self.picture.webp_srcset(), "")
+
     def tearDown(self):
         utils.delete_image(self.picture)
+
+
+class PhotoUploadProcessing(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.picture = None
+
+    def upload(self, image_file):
+        request = self.factory.post("/admin/edit/photo/", {"picture": image_file, "caption": "Processed Photo"})
+        views.GalleryPhotoViewSet().obj_add(request)
+        self.picture = models.GalleryPhoto.objects.get(caption="Processed Photo")
+        return self.picture
+
+    @override_settings(PHOTO_MAX_EDGE=100)
+    def test_rotate_shrink_and_strip(self):
+        picture = self.upload(utils.gen_jpeg_upload(300, 200, orientation=6))
+        # Orientation 6 means the camera was rotated, so the width and height swap
+        self.assertEqual((picture.width, picture.height), (67, 100))
+        self.assertEqual(picture.get_extension(), "jpg")
+        self.assertGreater(picture.bytes_saved, 0)
+        with Image.open(picture.picture.path) as saved_image:
+            self.assertEqual(len(saved_image.getexif()), 0)
+            self.assertTrue(saved_image.info.get("progressive"))
+
+    def test_larger_result_keeps_original(self):
+        # A small, heavily compressed JPEG with no metadata only gets bigger when it's re-saved
+        image = Image.effect_noise((300, 200), 80).convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=10)
+        original = output.getvalue()
+        picture = self.upload(SimpleUploadedFile("upload.jpeg", original, content_type="image/jpeg"))
+        self.assertEqual(picture.bytes_saved, 0)
+        with open(picture.picture.path, 'rb') as saved_file:
+            self.assertEqual(saved_file.read(), original)
+
+    def test_xmp_is_stripped(self):
+        # XMP isn't EXIF, but it can still hold things like a location, so the photo is re-saved even if it gets bigger
+        image = Image.effect_noise((300, 200), 80).convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=10)
+        xmp = b"http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta><exif:GPSLatitude>40,20N</exif:GPSLatitude></x:xmpmeta>"
+        segment = b"\xff\xe1" + (len(xmp) + 2).to_bytes(2, "big") + xmp
+        original = output.getvalue()[:2] + segment + output.getvalue()[2:]
+        picture = self.upload(SimpleUploadedFile("upload.jpeg", original, content_type="image/jpeg"))
+        with open(picture.picture.path, 'rb') as saved_file:
+            self.assertNotIn(b"GPSLatitude", saved_file.read())
+        self.assertLess(picture.bytes_saved, 0)
+
+    def test_metadata_is_found(self):
+        for info in ({"xmp": b"<x:xmpmeta/>"}, {"photoshop": {}}, {"comment": b"Taken at home"},
+                     {"icc_profile": b"profile"}, {"Author": "Someone"}):
+            with self.subTest(info=list(info.keys())):
+                image = Image.new("RGB", (10, 10))
+                image.info.update(info)
+                self.assertTrue(images.has_metadata(image))
+        self.assertFalse(images.has_metadata(Image.new("RGB", (10, 10))))
+
+    def test_small_png_keeps_format(self):
+        with open(test_image_path, 'rb') as image:
+            picture = self.upload(image)
+        self.assertEqual(picture.get_extension(), "png")
+        self.assertEqual((picture.width, picture.height), (480, 480))
+
+    def tearDown(self):
+        if self.picture is not None:
+            utils.delete_image(self.picture)
+
+
+class ModelVersions(TestCase):
+    def get_version(self, label):
+        return models.ModelVersion.get_versions([label])[label][0]
+
+    def test_unchanged_model_is_version_zero(self):
+        self.assertEqual(models.ModelVersion.get_versions(["edit.Officer"]), {"edit.Officer": (0, None)})
+
+    def test_bump(self):
+        models.ModelVersion.bump("edit.Officer")
+        models.ModelVersion.bump("edit.Officer")
+        self.assertEqual(self.get_version("edit.Officer"), 2)
+
+    def test_signals_bump_version(self):
+        link = models.ExternalLink.objects.create(url="https://example.com", display_name="Version Link")
+        self.assertEqual(self.get_version("edit.ExternalLink"), 1)
+        link.delete()
+        self.assertEqual(self.get_version("edit.ExternalLink"), 2)
+
+    def test_raw_saves_are_skipped(self):
+        signals.bump_model_version(models.ExternalLink, raw=True)
+        self.assertEqual(self.get_version("edit.ExternalLink"), 0)
+
+    def test_admin_save_bumps_once(self):
+        request = RequestFactory().post("/admin/edit/link/", {'url': test_url, 'display_name': "Version Link"})
+        views.LinkViewSet().obj_add(request)
+        self.assertEqual(self.get_version("edit.ExternalLink"), 1)
+
+    def test_photo_upload_bumps_twice(self):
+        # Once when the form saves the photo, and once more when its new name and derivatives are saved together
+        with open(test_image_path, 'rb') as image:
+            request = RequestFactory().post("/admin/edit/photo/", {"picture": image, "caption": "Version Photo"})
+            views.GalleryPhotoViewSet().obj_add(request)
+        picture = models.GalleryPhoto.objects.get(caption="Version Photo")
+        self.addCleanup(utils.delete_image, picture)
+        self.assertEqual(self.get_version("edit.GalleryPhoto"), 2)
+
+    def test_bookkeeping_is_not_versioned(self):
+        models.MediaUsage.record("test-folder", 10, 1)
+        self.assertEqual(self.get_version("edit.MediaUsage"), 0)
+        self.assertFalse(models.ModelVersion.objects.filter(label="edit.ModelVersion").exists())
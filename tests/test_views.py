@@ -1,11 +1,35 @@
+import json
 import os
+import shutil
+import tempfile
+import warnings
+from base64 import urlsafe_b64encode
+from datetime import date, time, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
 from django.conf import settings
-from django.test import TestCase, RequestFactory
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.paginator import UnorderedObjectListWarning
+from django.db import connection
+from django.db.models import F
+from django.http import HttpResponse
+from django.template.backends.django import Template as BackendTemplate
+from django.template.context import RequestContext
+from django.test import TestCase, RequestFactory, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import http_date, quote_etag
 
-from edit import models, views
+from edit import models, views, forms
+from main import metrics, middleware, profiling, timing, urls
+from main import views as main_views
+from main.cache import get_last_modified, get_page_key, get_versions, invalidate_pages
+from edit.images import get_derivative_files
 from tests import utils
-from tests.utils import test_url, test_image_path
+from tests.utils import test_url, test_email, test_image_path
 
 
 class BasicDBActions(TestCase):
@@ -85,6 +109,45 @@ class Ordering(TestCase):
         self.assertEqual(link3_new.sort_order, 1)
         self.assertEqual(link2_new.sort_order, 2)
 
+    def test_objects_added_during_reorder_go_last(self):
+        link1, link2, link3 = self.test_links
+        models.ExternalLink.objects.create(url=test_url, display_name="Test 4", sort_order=3)
+        models.ExternalLink.objects.create(url=test_url, display_name="Test 5", sort_order=4)
+        request = self.factory.post("/admin/order/link/", {'new_order': f"{link3.id},{link2.id},{link1.id}"})
+        # The new links were added after the form was checked, so they aren't in the new order
+        with mock.patch.object(forms.OrderForm, "clean", autospec=True, return_value=None):
+            views.LinkViewSet().object_order_view(request)
+        self.assertEqual(list(models.ExternalLink.objects.values_list("display_name", "sort_order")),
+                         [("Test 3", 0), ("Test 2", 1), ("Test 1", 2), ("Test 4", 3), ("Test 5", 4)])
+
+    def test_order_editing_is_bulk(self):
+        models.ExternalLink.objects.bulk_create(
+            models.ExternalLink(url=test_url, display_name=f"Bulk {index}", sort_order=index + 3)
+            for index in range(200))
+        new_order = [str(link_id) for link_id in
+                     models.ExternalLink.objects.order_by("-sort_order").values_list("id", flat=True)]
+        request = self.factory.post("/admin/order/link/", {'new_order': ",".join(new_order)})
+        vs = views.LinkViewSet()
+        with CaptureQueriesContext(connection) as queries:
+            vs.object_order_view(request)
+        self.assertLess(len(queries), 15)
+        saved_order = [str(link_id) for link_id in
+                       models.ExternalLink.objects.order_by("sort_order").values_list("id", flat=True)]
+        self.assertEqual(saved_order, new_order)
+
+    def test_deletion_is_bulk(self):
+        models.ExternalLink.objects.bulk_create(
+            models.ExternalLink(url=test_url, display_name=f"Bulk {index}", sort_order=index + 3)
+            for index in range(200))
+        target_link = models.ExternalLink.objects.get(display_name="Test 1")
+        request = self.factory.post(f"/admin/delete/link/?id={target_link.id}")
+        vs = views.LinkViewSet()
+        with CaptureQueriesContext(connection) as queries:
+            vs.obj_delete_view(request)
+        self.assertLess(len(queries), 15)
+        sort_orders = list(models.ExternalLink.objects.order_by("sort_order").values_list("sort_order", flat=True))
+        self.assertEqual(sort_orders, list(range(202)))
+
 
 class PictureUploads(TestCase):
     def setUp(self):
@@ -111,6 +174,7 @@ class PictureUploads(TestCase):
         request = self.factory.post(f"/admin/delete/photo/?id={self.picture.id}")
         self.vs.obj_delete_view(request)
         self.assertFalse(os.path.exists(settings.MEDIA_ROOT + self.picture.picture.name))
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT + self.picture.derivatives["grid"]["jpeg"]))
 
     def tearDown(self):
         utils.delete_image(self.picture)
@@ -122,10 +186,10 @@ class Pagination(TestCase):
         self.vs = views.LinkViewSet()
         self.vs.per_page = 2
         self.admin = models.User.objects.create_superuser(username="admin", password="Testing123")
-        self.link1 = models.ExternalLink.objects.create(url=test_url, display_name="Test1")
-        self.link2 = models.ExternalLink.objects.create(url=test_url, display_name="Test2")
-        self.link3 = models.ExternalLink.objects.create(url=test_url, display_name="Test3")
-        self.link4 = models.ExternalLink.objects.create(url=test_url, display_name="Test4")
+        self.link1 = models.ExternalLink.objects.create(url=test_url, display_name="Test1", sort_order=0)
+        self.link2 = models.ExternalLink.objects.create(url=test_url, display_name="Test2", sort_order=1)
+        self.link3 = models.ExternalLink.objects.create(url=test_url, display_name="Test3", sort_order=2)
+        self.link4 = models.ExternalLink.objects.create(url=test_url, display_name="Test4", sort_order=3)
         self.test_links = [self.link1, self.link2, self.link3, self.link4]
 
     def test_page_separation(self):
@@ -139,3 +203,866 @@ class Pagination(TestCase):
         self.assertNotIn(self.test_links[2].display_name, str(page_1_response.content))
         self.assertIn(self.test_links[2].display_name, str(page_2_response.content))
         self.assertNotIn(self.test_links[0].display_name, str(page_2_response.content))
+
+
+class KeysetOverview(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.vs = views.EventViewSet()
+        self.admin = models.User.objects.create_superuser(username="admin", password="Testing123")
+        self.client.force_login(self.admin)
+        for counter in range(25):
+            # Only a few different dates, so the id has to break ties between events
+            models.Event.objects.create(name=f"Event {counter}", startDate=date(2021, 1, counter % 3 + 1),
+                                        endDate=date(2021, 1, counter % 3 + 1), startTime=time(5, 0),
+                                        endTime=time(6, 0), location="Test")
+
+    def get_page(self, query=""):
+        response = self.client.get(f"{self.vs.overview_link()}{query}")
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_pages_cover_every_event(self):
+        seen_ids = []
+        context = self.get_page()
+        self.assertFalse(context["has_previous"])
+        while True:
+            seen_ids += [row[-1] for row in context["objects"]]
+            if not context["has_next"]:
+                break
+            context = self.get_page(context["next_link"][len(self.vs.overview_link()):])
+        self.assertEqual(seen_ids, list(models.Event.objects.order_by(
+            "-startDate", "-endDate", "-startTime", "-endTime", "-id").values_list("id", flat=True)))
+
+    def test_previous_page(self):
+        first_page = self.get_page()
+        second_page = self.get_page(first_page["next_link"][len(self.vs.overview_link()):])
+        self.assertTrue(second_page["has_previous"])
+        previous_page = self.get_page(second_page["previous_link"][len(self.vs.overview_link()):])
+        self.assertEqual([row[-1] for row in previous_page["objects"]], [row[-1] for row in first_page["objects"]])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(f"{self.vs.overview_link()}?after=asdf").status_code, 404)
+
+    def test_cached_count(self):
+        self.assertEqual(self.get_page()["total_count"], 25)
+        # A raw delete doesn't send signals, so the version (and the cached count) stay the same
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {models.Event._meta.db_table} WHERE id = %s",
+                           [models.Event.objects.first().id.hex])
+        self.assertEqual(self.get_page()["total_count"], 25)
+        invalidate_pages(models.Event)
+        self.assertEqual(self.get_page()["total_count"], 24)
+
+    def test_count_follows_deletes(self):
+        self.assertEqual(self.get_page()["total_count"], 25)
+        models.Event.objects.first().delete()
+        self.assertEqual(self.get_page()["total_count"], 24)
+
+
+class OverviewSearch(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.admin = models.User.objects.create_superuser(username="admin", password="Testing123",
+                                                          email="admin@example.org")
+        self.client.force_login(self.admin)
+        for counter in range(12):
+            models.Event.objects.create(name=f"{'Meeting' if counter % 2 == 0 else 'Social'} {counter:02}",
+                                        startDate=date(2021, 1, counter + 1), endDate=date(2021, 1, counter + 1),
+                                        startTime=time(5, 0), endTime=time(6, 0), location="Hall",
+                                        virtual=counter % 3 == 0, link=test_url)
+            models.User.objects.create_user(username=f"user{counter:02}", password="Testing123",
+                                            email=f"{'staff' if counter < 4 else 'member'}{counter}@example.org")
+
+    def get_context(self, view_set, query):
+        response = self.client.get(f"{view_set.overview_link()}?{query}")
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_search_and_filter(self):
+        context = self.get_context(views.EventViewSet(), "q=meeting&filter_virtual=yes")
+        self.assertEqual(sorted(row[0] for row in context["objects"]), ["Meeting 00", "Meeting 06"])
+        self.assertTrue(context["searching"])
+
+    def test_sort_with_keyset_pages(self):
+        view_set = views.EventViewSet()
+        context = self.get_context(view_set, "q=i&sort=name")
+        names = [row[0] for row in context["objects"]]
+        self.assertIn("q=i", context["next_link"])
+        self.assertIn("sort=name", context["next_link"])
+        context = self.get_context(view_set, context["next_link"].split("?", 1)[1])
+        names += [row[0] for row in context["objects"]]
+        self.assertEqual(names, sorted(models.Event.objects.values_list("name", flat=True)))
+        self.assertIsNone(context["total_count"])
+
+    def test_unsorted_page_numbers_are_ordered(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", UnorderedObjectListWarning)
+            context = self.get_context(views.UserViewSet(), "")
+        self.assertEqual([row[0] for row in context["objects"]],
+                         list(models.User.objects.order_by("id").values_list("username", flat=True)[:10]))
+
+    def test_sort_with_page_numbers(self):
+        view_set = views.UserViewSet()
+        context = self.get_context(view_set, "q=example&sort=-username")
+        self.assertEqual([row[0] for row in context["objects"]], [f"user{counter:02}" for counter in range(11, 1, -1)])
+        self.assertIn("sort=-username", context["next_link"])
+        context = self.get_context(view_set, context["next_link"].split("?", 1)[1])
+        self.assertEqual([row[0] for row in context["objects"]], ["user01", "user00", "admin"])
+        context = self.get_context(view_set, "q=staff&filter_is_staff=no")
+        self.assertEqual(len(context["objects"]), 4)
+
+    def test_unknown_options_are_ignored(self):
+        context = self.get_context(views.EventViewSet(), "sort=description&filter_virtual=maybe")
+        self.assertFalse(context["searching"])
+        self.assertEqual(context["sort"], "")
+        self.assertEqual(context["total_count"], 12)
+
+
+class PageCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.factory = RequestFactory()
+        self.admin = models.User.objects.create_superuser(username="admin", password="Testing123")
+        self.link = models.ExternalLink.objects.create(url=test_url, display_name="Cached Link")
+
+    def test_anonymous_pages_are_cached(self):
+        self.client.get(reverse("main:home"))
+        # The only query is for the model versions
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("main:home"))
+        self.assertIn(self.link.display_name, str(response.content))
+
+    def test_logged_in_pages_are_not_cached(self):
+        self.client.force_login(self.admin)
+        self.client.get(reverse("main:officers"))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("main:officers"))
+        self.assertGreater(len(queries), 0)
+
+    def test_save_invalidates_dependent_pages(self):
+        self.client.get(reverse("main:home"))
+        self.client.get(reverse("main:officers"))
+        request = self.factory.post(f"/admin/edit/link/?id={self.link.id}",
+                                    {'url': test_url, 'display_name': "Renamed Link"})
+        views.LinkViewSet().obj_edit(request)
+        response = self.client.get(reverse("main:home"))
+        self.assertIn("Renamed Link", str(response.content))
+        with self.assertNumQueries(1):
+            self.client.get(reverse("main:officers"))
+
+    def test_change_from_another_process_invalidates_pages(self):
+        self.client.get(reverse("main:home"))
+        # Another process would only share the database with us, not the cache
+        models.ExternalLink.objects.filter(id=self.link.id).update(display_name="Renamed Elsewhere")
+        models.ModelVersion.objects.filter(label="edit.ExternalLink").update(version=F("version") + 1)
+        self.assertIn("Renamed Elsewhere", str(self.client.get(reverse("main:home")).content))
+
+    def test_delete_invalidates_dependent_pages(self):
+        self.client.get(reverse("main:home"))
+        request = self.factory.post(f"/admin/delete/link/?id={self.link.id}")
+        views.LinkViewSet().obj_delete_view(request)
+        response = self.client.get(reverse("main:home"))
+        self.assertNotIn(self.link.display_name, str(response.content))
+
+
+class ConditionalPages(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.link = models.ExternalLink.objects.create(url=test_url, display_name="Conditional Link")
+
+    def test_validators_sent(self):
+        response = self.client.get(reverse("main:home"))
+        self.assertIn("ETag", response)
+        self.assertIn("Last-Modified", response)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_etag_not_modified(self):
+        etag = self.client.get(reverse("main:home"))["ETag"]
+        # The only query is for the model versions, the view itself isn't run
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("main:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_last_modified_not_modified(self):
+        last_modified = self.client.get(reverse("main:officers"))["Last-Modified"]
+        response = self.client.get(reverse("main:officers"), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_change_gives_new_page(self):
+        etag = self.client.get(reverse("main:home"))["ETag"]
+        self.link.display_name = "Changed Link"
+        self.link.save()
+        response = self.client.get(reverse("main:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertIn("Changed Link", str(response.content))
+
+    def test_unrelated_change_keeps_etag(self):
+        etag = self.client.get(reverse("main:officers"))["ETag"]
+        self.link.delete()
+        self.assertEqual(self.client.get(reverse("main:officers"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_evicted_page_not_modified(self):
+        etag = self.client.get(reverse("main:home"))["ETag"]
+        # The page fell out of the cache, but the browser's copy is still current
+        cache.clear()
+        response = self.client.get(reverse("main:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        # The page was still rendered and stored for the next request
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse("main:home")).status_code, 200)
+
+    def test_evicted_sitemap_is_stored(self):
+        sitemap_url = reverse("main:sitemap_section", args=("main",))
+        etag = self.client.get(sitemap_url)["ETag"]
+        cache.clear()
+        self.assertEqual(self.client.get(sitemap_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # The sitemap's TemplateResponse was rendered so it could be stored, even though it wasn't sent
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(sitemap_url).status_code, 200)
+
+    def test_missing_page_not_modified(self):
+        missing_photo = f"{reverse('main:view_photo')}?id=00000000-0000-0000-0000-000000000000"
+        # The validators the page would have, if it existed
+        versions = get_versions(main_views.view_photo.page_dependencies)
+        etag = quote_etag(get_page_key(RequestFactory().get(missing_photo), versions).split(":", 1)[1])
+        last_modified = http_date(get_last_modified(versions).timestamp())
+        self.assertEqual(self.client.get(missing_photo, HTTP_IF_NONE_MATCH=etag).status_code, 404)
+        self.assertEqual(self.client.get(missing_photo, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 404)
+        self.assertEqual(self.client.get(missing_photo, HTTP_IF_NONE_MATCH="*").status_code, 404)
+
+    def test_logged_in_not_conditional(self):
+        admin = models.User.objects.create_superuser(username="admin", password="Testing123")
+        etag = self.client.get(reverse("main:home"))["ETag"]
+        self.client.force_login(admin)
+        response = self.client.get(reverse("main:home"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+
+
+class ServerTiming(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+
+    def test_not_sent_to_anonymous_users(self):
+        self.assertNotIn("Server-Timing", self.client.get(reverse("main:home")))
+
+    def test_sent_to_staff(self):
+        staff = models.User.objects.create_user(username="staff", password="Testing123", is_staff=True)
+        self.client.force_login(staff)
+        header = self.client.get(reverse("main:officers"))["Server-Timing"]
+        for metric in ("db;dur=", "cache;desc=", "total;dur="):
+            self.assertIn(metric, header)
+        self.assertNotIn('desc="0 queries"', header)
+
+    def test_template_timing(self):
+        # Put Django (and the timing module) back the way they were, so later tests don't run with the wrappers
+        render, bind_template = BackendTemplate.render, RequestContext.bind_template
+        for target, attribute in ((BackendTemplate, "render"), (RequestContext, "bind_template"),
+                                  (timing, "templates_timed"), (timing, "original_render"),
+                                  (timing, "original_bind_template")):
+            patcher = mock.patch.object(target, attribute, getattr(target, attribute))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        timing.install_template_timing()
+        # Installing again mustn't wrap the wrappers
+        timing.install_template_timing()
+        self.assertIsNot(timing.original_render, timing.timed_render)
+        self.assertIsNot(timing.original_bind_template, timing.timed_bind_template)
+        staff = models.User.objects.create_user(username="staff", password="Testing123", is_staff=True)
+        self.client.force_login(staff)
+        header = self.client.get(reverse("main:officers"))["Server-Timing"]
+        self.assertIn("tpl;dur=", header)
+        self.assertIn("ctx;dur=", header)
+        self.doCleanups()
+        self.assertIs(BackendTemplate.render, render)
+        self.assertIs(RequestContext.bind_template, bind_template)
+
+    def test_wrapped_attributes_exist(self):
+        # install_template_timing replaces these private parts of Django, this fails if an upgrade removes them
+        self.assertTrue(callable(getattr(BackendTemplate, "render", None)))
+        self.assertTrue(callable(getattr(RequestContext, "bind_template", None)))
+
+    @override_settings(SERVER_TIMING=True)
+    def test_cache_hits_and_misses(self):
+        self.assertIn('"0 hits, 1 misses"', self.client.get(reverse("main:home"))["Server-Timing"])
+        header = self.client.get(reverse("main:home"))["Server-Timing"]
+        self.assertIn('"1 hits, 0 misses"', header)
+        self.assertIn('desc="1 queries"', header)
+
+
+class Metrics(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(METRICS_DIR=self.metrics_dir, METRICS_TOKEN="scrape-token")
+        self.settings_override.enable()
+        metrics.route_metrics.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.metrics_dir)
+        metrics.route_metrics.clear()
+
+    def scrape(self):
+        response = self.client.get(reverse("main:metrics"), HTTP_AUTHORIZATION="Bearer scrape-token")
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode("utf-8")
+
+    def test_requests_are_counted(self):
+        self.client.get(reverse("main:home"))
+        self.client.get(reverse("main:home"))
+        self.client.get(f"{reverse('main:events')}?view=asdf")
+        output = self.scrape()
+        self.assertIn('berks_dental_http_requests_total{route="main:home",status="200"} 2', output)
+        self.assertIn('berks_dental_http_requests_total{route="main:events",status="404"} 1', output)
+        self.assertIn('berks_dental_http_request_duration_seconds_bucket{route="main:home",le="+Inf"} 2', output)
+        self.assertIn('berks_dental_http_request_queries_count{route="main:home"} 2', output)
+
+    def test_processes_are_merged(self):
+        self.client.get(reverse("main:home"))
+        other_process = metrics.new_route_entry()
+        other_process["statuses"]["200"] = 3
+        other_process["count"] = 3
+        other_process["size_sum"] = 30
+        # The test runner's parent process stands in for another worker that's still running
+        with open(os.path.join(self.metrics_dir, f"{os.getppid()}.json"), 'w') as snapshot_file:
+            json.dump({"main:home": other_process}, snapshot_file)
+        self.assertIn('berks_dental_http_requests_total{route="main:home",status="200"} 4', self.scrape())
+
+    @skipUnless(os.name == "posix", "Only POSIX systems can check if a process is running")
+    def test_exited_processes_are_dropped(self):
+        self.client.get(reverse("main:home"))
+        exited_process = metrics.new_route_entry()
+        exited_process["statuses"]["200"] = 3
+        exited_process["count"] = 3
+        exited_path = os.path.join(self.metrics_dir, "999999999.json")
+        with open(exited_path, 'w') as snapshot_file:
+            json.dump({"main:home": exited_process}, snapshot_file)
+        self.assertIn('berks_dental_http_requests_total{route="main:home",status="200"} 1', self.scrape())
+        self.assertFalse(os.path.exists(exited_path))
+
+    @override_settings(METRICS_FLUSH_INTERVAL=0)
+    def test_snapshot_is_saved(self):
+        self.client.get(reverse("main:home"))
+        with open(metrics.get_snapshot_path()) as snapshot_file:
+            self.assertEqual(json.load(snapshot_file)["main:home"]["count"], 1)
+
+    def test_restricted(self):
+        self.assertEqual(self.client.get(reverse("main:metrics"), REMOTE_ADDR="10.0.0.1").status_code, 404)
+        self.assertEqual(self.client.get(reverse("main:metrics"), HTTP_AUTHORIZATION="Bearer wrong").status_code, 404)
+        # The test client's requests come from 127.0.0.1, like every request behind a local reverse proxy
+        self.assertEqual(self.client.get(reverse("main:metrics")).status_code, 404)
+
+    @override_settings(METRICS_ALLOWED_ADDRESSES=("10.0.0.1",))
+    def test_allowed_address(self):
+        self.assertEqual(self.client.get(reverse("main:metrics"), REMOTE_ADDR="10.0.0.1").status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_no_token_configured(self):
+        self.assertEqual(self.client.get(reverse("main:metrics"), HTTP_AUTHORIZATION="Bearer None").status_code, 404)
+
+
+class Profiles(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.profile_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(PROFILE_DIR=self.profile_dir, PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2)
+        self.settings_override.enable()
+        self.client = Client()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.profile_dir)
+
+    def test_ring_buffer(self):
+        for _ in range(3):
+            self.client.get(reverse("main:home"))
+        self.client.get(reverse("main:about"))
+        saved = profiling.list_profiles()
+        self.assertEqual([profile["route"] for profile in saved], ["main:about", "main:home", "main:home"])
+        self.assertEqual(saved[0]["reason"], "sampled")
+        self.assertEqual(len(os.listdir(profiling.get_route_folder("main:home"))), 4)
+
+    @override_settings(PROFILE_SAMPLE_RATE=0, PROFILE_SLOW_THRESHOLD=0)
+    def test_slow_requests(self):
+        self.client.get(reverse("main:home"))
+        self.assertEqual(profiling.list_profiles()[0]["reason"], "slow")
+
+    def test_admin_pages(self):
+        self.client.get(reverse("main:home"))
+        profile = profiling.list_profiles()[0]
+        detail_link = f"{reverse('edit:profile')}?folder={profile['folder']}&name={profile['name']}"
+        editor = models.User.objects.create_user(username="editor", password="Testing123")
+        self.client.force_login(editor)
+        self.assertEqual(self.client.get(reverse("edit:profiles")).status_code, 302)
+        self.assertEqual(self.client.get(detail_link).status_code, 302)
+        staff = models.User.objects.create_user(username="staff", password="Testing123", is_staff=True)
+        self.client.force_login(staff)
+        self.assertContains(self.client.get(reverse("edit:profiles")), profile["name"])
+        self.assertContains(self.client.get(detail_link), "views.py")
+        bad_link = f"{reverse('edit:profile')}?folder=..&name={profile['name']}"
+        self.assertEqual(self.client.get(bad_link).status_code, 404)
+
+
+class QueryBudgets(TestCase):
+    """
+    Each public page and ViewSet overview has a query budget, which can't grow with the number of rows shown
+    """
+
+    # Overviews with a cached count look up their model's version (and count the rows on a miss), so they get one more
+    cached_count_budget = 6
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.admin = models.User.objects.create_superuser(username="budget_admin", password="Testing123")
+
+    @staticmethod
+    def seeder(model, make_row):
+        def seed(size):
+            for counter in range(model.objects.count(), size):
+                make_row(counter)
+        return seed
+
+    @staticmethod
+    def make_link(counter):
+        models.ExternalLink.objects.create(url=test_url, display_name=f"Link {counter}")
+
+    @staticmethod
+    def make_photo(counter):
+        models.GalleryPhoto.objects.create(caption=f"Photo {counter}", width=100, height=100, featured=True)
+
+    @staticmethod
+    def make_event(counter):
+        models.Event.objects.create(name=f"Event {counter}", startDate=date.today(), endDate=date.today(),
+                                    startTime=time(5, 0), endTime=time(6, 0), location="Test",
+                                    virtual=counter % 2 == 0, link=test_url)
+
+    @staticmethod
+    def make_officer(counter):
+        models.Officer.objects.create(first_name=f"Officer {counter}", last_name="Test", title="Test", width=100,
+                                      height=100)
+
+    @staticmethod
+    def make_social(counter):
+        models.Social.objects.create(service=models.Social.Services.FACEBOOK, link=test_url)
+
+    @staticmethod
+    def make_user(counter):
+        models.User.objects.create_user(username=f"user{counter}", first_name="Test", last_name="Test",
+                                        email=test_email, password="Testing123")
+
+    def get_public(self, url):
+        def run():
+            cache.clear()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # Streamed responses only query the database as they're read
+            b"".join(response)
+        return run
+
+    def get_overview(self, view_set):
+        def run():
+            self.assertEqual(self.client.get(view_set.overview_link()).status_code, 200)
+        self.client.force_login(self.admin)
+        return run
+
+    def test_home(self):
+        def seed(size):
+            for make_row, model in ((self.make_link, models.ExternalLink), (self.make_photo, models.GalleryPhoto),
+                                    (self.make_event, models.Event), (self.make_social, models.Social)):
+                self.seeder(model, make_row)(size)
+        utils.assert_query_budget(self, 5, seed, self.get_public(reverse("main:home")))
+
+    def test_gallery(self):
+        utils.assert_query_budget(self, 3, self.seeder(models.GalleryPhoto, self.make_photo),
+                                  self.get_public(reverse("main:gallery")))
+
+    def test_officers(self):
+        utils.assert_query_budget(self, 3, self.seeder(models.Officer, self.make_officer),
+                                  self.get_public(reverse("main:officers")))
+
+    def test_events(self):
+        utils.assert_query_budget(self, 3, self.seeder(models.Event, self.make_event),
+                                  self.get_public(reverse("main:events")))
+
+    def test_gallery_page(self):
+        def run():
+            response = self.client.post(reverse("main:gallery_page"), {"cursor": ""})
+            self.assertEqual(response.status_code, 200)
+        utils.assert_query_budget(self, 1, self.seeder(models.GalleryPhoto, self.make_photo), run)
+
+    def test_view_photo(self):
+        self.make_photo(0)
+        url = f"{reverse('main:view_photo')}?id={models.GalleryPhoto.objects.get().id}"
+        utils.assert_query_budget(self, 3, self.seeder(models.GalleryPhoto, self.make_photo), self.get_public(url))
+
+    def test_calendar_feed(self):
+        utils.assert_query_budget(self, 3, self.seeder(models.Event, self.make_event),
+                                  self.get_public(reverse("main:calendar_feed")))
+
+    def test_about(self):
+        utils.assert_query_budget(self, 2, self.seeder(models.ExternalLink, self.make_link),
+                                  self.get_public(reverse("main:about")))
+
+    def test_sitemaps(self):
+        def seed(size):
+            for make_row, model in ((self.make_photo, models.GalleryPhoto), (self.make_event, models.Event)):
+                self.seeder(model, make_row)(size)
+        utils.assert_query_budget(self, 3, seed, self.get_public(reverse("main:sitemap_index")))
+        for section in urls.sitemaps:
+            with self.subTest(section=section):
+                utils.assert_query_budget(self, 5, seed, self.get_public(reverse("main:sitemap_section",
+                                                                                 args=(section,))))
+
+    def test_link_overview(self):
+        utils.assert_query_budget(self, 5, self.seeder(models.ExternalLink, self.make_link),
+                                  self.get_overview(views.LinkViewSet()))
+
+    def test_social_overview(self):
+        utils.assert_query_budget(self, 5, self.seeder(models.Social, self.make_social),
+                                  self.get_overview(views.SocialViewSet()))
+
+    def test_photo_overview(self):
+        utils.assert_query_budget(self, self.cached_count_budget, self.seeder(models.GalleryPhoto, self.make_photo),
+                                  self.get_overview(views.GalleryPhotoViewSet()))
+
+    def test_event_overview(self):
+        utils.assert_query_budget(self, self.cached_count_budget, self.seeder(models.Event, self.make_event),
+                                  self.get_overview(views.EventViewSet()))
+
+    def test_officer_overview(self):
+        utils.assert_query_budget(self, 5, self.seeder(models.Officer, self.make_officer),
+                                  self.get_overview(views.OfficerViewSet()))
+
+    def test_user_overview(self):
+        utils.assert_query_budget(self, 5, self.seeder(models.User, self.make_user),
+                                  self.get_overview(views.UserViewSet()))
+
+    def test_every_overview_has_a_budget(self):
+        overview_tests = {views.LinkViewSet: "test_link_overview", views.SocialViewSet: "test_social_overview",
+                          views.GalleryPhotoViewSet: "test_photo_overview", views.EventViewSet: "test_event_overview",
+                          views.OfficerViewSet: "test_officer_overview", views.UserViewSet: "test_user_overview"}
+        for view_set in views.REGISTERED_VIEWSETS + [views.UserViewSet]:
+            with self.subTest(view_set=view_set.__name__):
+                budget_test = getattr(self, overview_tests.get(view_set, ""), None)
+                self.assertIsNotNone(budget_test, f"{view_set.__name__} has no overview budget")
+                # A budget marked as an expected failure isn't actually enforced
+                self.assertFalse(getattr(budget_test, "__unittest_expecting_failure__", False),
+                                 f"{view_set.__name__}'s overview budget isn't enforced")
+
+    @override_settings(DEBUG=True)
+    def test_repeated_queries_are_reported(self):
+        self.seeder(models.Event, self.make_event)(12)
+
+        def per_row_view(request):
+            # A deliberate N+1, every event is fetched on its own
+            names = [models.Event.objects.get(id=event_id).name for event_id in
+                     models.Event.objects.values_list("id", flat=True)]
+            return HttpResponse(", ".join(names))
+
+        detector = middleware.detect_repeated_queries(per_row_view)
+        with self.assertLogs("main.middleware", level="WARNING"):
+            response = detector(RequestFactory().get("/n-plus-one/"))
+        self.assertEqual(response["X-Repeated-Queries"], "1")
+
+    @override_settings(DEBUG=True)
+    def test_overviews_have_no_repeated_queries(self):
+        self.seeder(models.Event, self.make_event)(12)
+        self.client.force_login(self.admin)
+        response = self.client.get(views.EventViewSet().overview_link())
+        self.assertNotIn("X-Repeated-Queries", response)
+
+
+class GalleryPagination(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        for counter in range(0, 30):
+            models.GalleryPhoto.objects.create(caption=f"Photo {counter}", width=100, height=100)
+        # Give some photos the same timestamp to make sure ties aren't skipped or repeated
+        shared_time = models.GalleryPhoto.objects.first().date_posted
+        models.GalleryPhoto.objects.filter(caption__in=["Photo 3", "Photo 4", "Photo 5"]).update(
+            date_posted=shared_time)
+
+    def test_cursor_pages_cover_every_photo(self):
+        seen_ids = []
+        cursor = ""
+        while cursor is not None:
+            response = self.client.post(reverse("main:gallery_page"), {'cursor': cursor}).json()
+            seen_ids += [photo["id"] for photo in response["photos"]]
+            cursor = response["next_cursor"]
+        expected_ids = [str(photo_id) for photo_id in
+                        models.GalleryPhoto.objects.order_by("-date_posted", "-id").values_list("id", flat=True)]
+        self.assertEqual(seen_ids, expected_ids)
+
+    def test_gallery_page_provides_cursor(self):
+        response = self.client.get(reverse("main:gallery"))
+        self.assertTrue(response.context["hasNext"])
+        self.assertIsNotNone(response.context["next_cursor"])
+
+    def test_invalid_cursor(self):
+        response = self.client.post(reverse("main:gallery_page"), {'cursor': "not a cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_cursor_with_wrong_types(self):
+        for raw in ('[{"a":1},"x"]', '[["x"],[1]]', '["not a date",1]'):
+            cursor = urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+            response = self.client.post(reverse("main:gallery_page"), {'cursor': cursor})
+            self.assertEqual(response.status_code, 404)
+
+    def test_page_number_fallback(self):
+        response = self.client.post(reverse("main:gallery_page"), {'page': 3}).json()
+        self.assertEqual(len(response["photos"]), 6)
+        self.assertFalse(response["hasNext"])
+
+
+class PhotoNavigation(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.photos = [models.GalleryPhoto.objects.create(caption=f"Photo {counter}", width=100, height=100,
+                                                          featured=counter % 2 == 0) for counter in range(0, 5)]
+        shared_time = self.photos[0].date_posted
+        models.GalleryPhoto.objects.update(date_posted=shared_time)
+        self.ordered_ids = list(models.GalleryPhoto.objects.order_by("-date_posted", "-id").values_list("id",
+                                                                                                         flat=True))
+
+    def get_neighbors(self, photo_id, featured="no"):
+        response = self.client.get(f"{reverse('main:view_photo')}?id={photo_id}&featured={featured}")
+        return response.context["last_link"], response.context["next_link"]
+
+    def test_neighbors_with_shared_timestamps(self):
+        last_link, next_link = self.get_neighbors(self.ordered_ids[2])
+        self.assertIn(str(self.ordered_ids[1]), last_link)
+        self.assertIn(str(self.ordered_ids[3]), next_link)
+
+    def test_ends_have_no_neighbor(self):
+        last_link, next_link = self.get_neighbors(self.ordered_ids[0])
+        self.assertIsNone(last_link)
+        last_link, next_link = self.get_neighbors(self.ordered_ids[-1])
+        self.assertIsNone(next_link)
+
+    def test_featured_only(self):
+        featured_ids = [photo_id for photo_id in self.ordered_ids
+                        if models.GalleryPhoto.objects.get(id=photo_id).featured]
+        last_link, next_link = self.get_neighbors(featured_ids[0], featured="yes")
+        self.assertIsNone(last_link)
+        self.assertIn(str(featured_ids[1]), next_link)
+        self.assertIn("featured=yes", next_link)
+
+    def test_single_query(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(f"{reverse('main:view_photo')}?id={self.ordered_ids[2]}")
+        photo_queries = [query for query in queries if "edit_galleryphoto" in query["sql"]]
+        self.assertEqual(len(photo_queries), 1)
+
+    def test_invalid_id(self):
+        response = self.client.get(f"{reverse('main:view_photo')}?id=not-an-id")
+        self.assertEqual(response.status_code, 404)
+
+
+class EventCalendar(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.long_event = models.Event.objects.create(name="Long Event", startDate=date(2021, 2, 25),
+                                                      endDate=date(2021, 4, 2), startTime=time(5, 0),
+                                                      endTime=time(6, 0), location="Test")
+        self.short_event = models.Event.objects.create(name="Short Event", startDate=date(2021, 3, 10),
+                                                       endDate=date(2021, 3, 12), startTime=time(5, 0),
+                                                       endTime=time(6, 0), location="Test")
+
+    def get_days(self, view_type="calendar"):
+        response = self.client.get(f"{reverse('main:events')}?month=3&year=2021&view={view_type}")
+        self.assertEqual(response.status_code, 200)
+        return {day_date: events for week in response.context["weeks"] for day, day_date, events in week if day != 0}
+
+    def test_every_day_of_an_event_is_included(self):
+        days = self.get_days()
+        self.assertEqual(len(days), 31)
+        self.assertIn(self.long_event, days[date(2021, 3, 1)])
+        self.assertIn(self.long_event, days[date(2021, 3, 31)])
+        self.assertIn(self.short_event, days[date(2021, 3, 11)])
+        self.assertNotIn(self.short_event, days[date(2021, 3, 13)])
+
+    def test_list_view(self):
+        days = self.get_days(view_type="list")
+        self.assertEqual(days[date(2021, 3, 10)], [self.short_event, self.long_event])
+
+    def test_weeks_start_on_sunday(self):
+        response = self.client.get(f"{reverse('main:events')}?month=3&year=2021")
+        first_week = response.context["weeks"][0]
+        self.assertEqual(first_week[0], (0, None, []))
+        self.assertEqual(first_week[1][0], 1)
+
+    def test_invalid_month(self):
+        self.assertEqual(self.client.get(f"{reverse('main:events')}?month=13&year=2021").status_code, 404)
+        self.assertEqual(self.client.get(f"{reverse('main:events')}?month=asdf").status_code, 404)
+
+
+class CalendarFeed(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.in_person_event = models.Event.objects.create(name="In Person Event", startDate=date(2021, 3, 5),
+                                                           endDate=date(2021, 3, 5), startTime=time(5, 0),
+                                                           endTime=time(6, 0), location="Test")
+        self.virtual_event = models.Event.objects.create(name="Virtual Event", startDate=date(2021, 6, 5),
+                                                         endDate=date(2021, 6, 5), startTime=time(5, 0),
+                                                         endTime=time(6, 0), virtual=True, link=test_url)
+
+    def get_feed(self, query="", **headers):
+        return self.client.get(f"{reverse('main:calendar_feed')}{query}", **headers)
+
+    def test_feed_contents(self):
+        response = self.get_feed()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/calendar"))
+        contents = b"".join(response.streaming_content).decode("utf-8")
+        self.assertTrue(contents.startswith("BEGIN:VCALENDAR"))
+        self.assertTrue(contents.endswith("END:VCALENDAR\r\n"))
+        self.assertIn("In Person Event", contents)
+        self.assertIn("Virtual Event", contents)
+
+    def test_not_modified(self):
+        response = self.get_feed()
+        self.assertFalse(response["ETag"].startswith("W/"))
+        self.assertIn("Last-Modified", response)
+        repeat = self.get_feed(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat.content, b"")
+
+    def test_etag_changes(self):
+        etag = self.get_feed()["ETag"]
+        self.in_person_event.name = "Changed Event"
+        self.in_person_event.save()
+        changed_etag = self.get_feed()["ETag"]
+        self.assertNotEqual(etag, changed_etag)
+        # Move every change an hour back, so the delete is in a later second than the Last-Modified we get
+        hour_ago = timezone.now() - timedelta(hours=1)
+        models.Event.objects.update(last_modified=hour_ago)
+        models.ModelVersion.objects.update(updated=hour_ago)
+        last_modified = self.get_feed()["Last-Modified"]
+        self.virtual_event.delete()
+        self.assertNotEqual(changed_etag, self.get_feed()["ETag"])
+        self.assertEqual(self.get_feed(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200)
+        self.assertNotEqual(self.get_feed("?type=virtual")["ETag"], self.get_feed()["ETag"])
+
+    def test_filters(self):
+        contents = b"".join(self.get_feed("?type=virtual").streaming_content).decode("utf-8")
+        self.assertIn("Virtual Event", contents)
+        self.assertNotIn("In Person Event", contents)
+        contents = b"".join(self.get_feed("?from=2021-04-01").streaming_content).decode("utf-8")
+        self.assertIn("Virtual Event", contents)
+        self.assertNotIn("In Person Event", contents)
+        contents = b"".join(self.get_feed("?to=2021-04-01&type=in-person").streaming_content).decode("utf-8")
+        self.assertIn("In Person Event", contents)
+        self.assertNotIn("Virtual Event", contents)
+
+    def test_invalid_filters(self):
+        self.assertEqual(self.get_feed("?from=asdf").status_code, 404)
+        self.assertEqual(self.get_feed("?type=asdf").status_code, 404)
+
+
+class SiteMaps(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.photo = models.GalleryPhoto.objects.create(caption="Sitemap Photo", width=100, height=100)
+        self.event = models.Event.objects.create(name="Sitemap Event", startDate=date(2021, 11, 25),
+                                                 endDate=date(2022, 1, 2), startTime=time(5, 0),
+                                                 endTime=time(6, 0), location="Test")
+
+    def get_section(self, section):
+        response = self.client.get(reverse("main:sitemap_section", kwargs={"section": section}))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode("utf-8")
+
+    def test_index_lists_sections(self):
+        response = self.client.get(reverse("main:sitemap_index"))
+        self.assertEqual(response.status_code, 200)
+        for section in ("main", "gallery", "events"):
+            self.assertIn(reverse("main:sitemap_section", kwargs={"section": section}), response.content.decode())
+
+    def test_photo_entries(self):
+        contents = self.get_section("gallery")
+        self.assertIn(f"{reverse('main:view_photo')}?id={self.photo.id}", contents)
+        self.assertIn(f"<lastmod>{self.photo.date_posted.date().isoformat()}</lastmod>", contents)
+
+    def test_event_months(self):
+        contents = self.get_section("events")
+        for month, year in ((11, 2021), (12, 2021), (1, 2022)):
+            self.assertIn(f"?month={month}&amp;year={year}", contents)
+        self.assertNotIn("?month=2&amp;year=2022", contents)
+
+    def test_main_lastmod(self):
+        self.assertIn(f"<lastmod>{self.event.last_modified.date().isoformat()}</lastmod>", self.get_section("main"))
+
+    def test_cached_until_change(self):
+        self.get_section("gallery")
+        # bulk_create doesn't send signals, so the cached sitemap is kept until we invalidate it
+        new_photo = models.GalleryPhoto.objects.bulk_create([models.GalleryPhoto(caption="New", width=1, height=1)])[0]
+        self.assertNotIn(str(new_photo.id), self.get_section("gallery"))
+        invalidate_pages(models.GalleryPhoto)
+        self.assertIn(str(new_photo.id), self.get_section("gallery"))
+
+
+class MediaUsageLedger(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.vs = views.GalleryPhotoViewSet()
+        with open(test_image_path, 'rb') as image:
+            request = self.factory.post("/admin/edit/photo/", {"picture": image, "caption": "Ledger Photo"})
+            self.vs.obj_add(request)
+        self.picture = models.GalleryPhoto.objects.get(caption="Ledger Photo")
+
+    def get_usage(self, folder):
+        usage = models.MediaUsage.objects.filter(folder=folder).first()
+        return (0, 0) if usage is None else (usage.bytes, usage.files)
+
+    def test_upload_is_recorded(self):
+        picture_size = os.path.getsize(settings.MEDIA_ROOT + self.picture.picture.name)
+        self.assertEqual(self.get_usage("galleryphoto-pictures"), (picture_size, 1))
+        derivative_files = get_derivative_files(self.picture)
+        derivative_size = sum(os.path.getsize(settings.MEDIA_ROOT + name) for name in derivative_files)
+        self.assertEqual(self.get_usage("galleryphoto-pictures/derivatives"),
+                         (derivative_size, len(derivative_files)))
+
+    def test_replacing_photo_is_recorded(self):
+        request = self.factory.post(f"/admin/edit/photo/?id={self.picture.id}",
+                                    {'caption': self.picture.caption,
+                                     'picture': utils.gen_jpeg_upload(200, 200)})
+        self.vs.obj_edit(request)
+        old_name = self.picture.picture.name
+        self.picture = models.GalleryPhoto.objects.get(id=self.picture.id)
+        self.assertFalse(os.path.exists(settings.MEDIA_ROOT + old_name))
+        picture_size = os.path.getsize(settings.MEDIA_ROOT + self.picture.picture.name)
+        self.assertEqual(self.get_usage("galleryphoto-pictures"), (picture_size, 1))
+
+    def test_delete_is_recorded(self):
+        request = self.factory.post(f"/admin/delete/photo/?id={self.picture.id}")
+        self.vs.obj_delete_view(request)
+        self.assertEqual(self.get_usage("galleryphoto-pictures"), (0, 0))
+        self.assertEqual(self.get_usage("galleryphoto-pictures/derivatives"), (0, 0))
+
+    def test_quota_check(self):
+        self.assertTrue(forms.check_media_quota())
+        self.assertFalse(forms.check_media_quota(forms.MAX_BYTES))
+
+    def test_reconcile(self):
+        models.MediaUsage.objects.all().delete()
+        call_command("reconcile_media_usage", stdout=StringIO())
+        self.assertEqual(models.MediaUsage.total_bytes(), forms.get_size_of_folder(settings.MEDIA_ROOT))
+
+    def tearDown(self):
+        utils.delete_image(self.picture)
@@ -1,11 +1,17 @@
-import os
 from datetime import date, time
+from io import BytesIO
 from json import dumps
 
 from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
 
 from edit import views, forms
+from edit.images import get_derivative_files
+from main.querycheck import find_repeated_queries
 
 test_url = "https://example.org"
 test_email = "bwc9876@gmail.com"
@@ -13,9 +19,16 @@ test_image_path = f"{settings.BASE_DIR}/static/tests/test.png"
 
 
 def delete_image(image):
-    img_path = settings.MEDIA_ROOT + image.picture.name
-    if os.path.exists(img_path):
-        os.remove(img_path)
+    views.GalleryPhotoViewSet.remove_media_files([image.picture.name] + get_derivative_files(image))
+
+
+def gen_jpeg_upload(width, height, orientation=1):
+    image = Image.new("RGB", (width, height), (200, 30, 30))
+    exif = image.getexif()
+    exif[0x0112] = orientation
+    output = BytesIO()
+    image.save(output, "JPEG", quality=100, exif=exif)
+    return SimpleUploadedFile("upload.jpeg", output.getvalue(), content_type="image/jpeg")
 
 
 def gen_post_data_for_user_edit(user, perm_type="None"):
@@ -78,3 +91,21 @@ def gen_form_for_order_validation_check(post_data, obj_list):
     form = forms.OrderForm(post_data)
     form.fields["new_order"].set_objects(obj_list)
     return form
+
+
+def assert_query_budget(test_case, budget, seed, run, sizes=(2, 12)):
+    """
+    Checks that a view stays within its query budget, and that the number of queries doesn't grow with the data
+    For each size, seed is called to grow the data to that many rows, then the queries run() makes are counted
+    """
+
+    counts = []
+    for size in sizes:
+        seed(size)
+        with CaptureQueriesContext(connection) as queries:
+            run()
+        sql_list = [query["sql"] for query in queries.captured_queries]
+        test_case.assertLessEqual(len(sql_list), budget, f"Over budget with {size} rows:\n" + "\n".join(sql_list))
+        test_case.assertEqual(find_repeated_queries(sql_list), {}, f"Repeated queries with {size} rows")
+        counts.append(len(sql_list))
+    test_case.assertEqual(len(set(counts)), 1, f"The number of queries grows with the number of rows: {counts}")
@@ -5,7 +5,7 @@
 # It first sets up environment variables from a .env file
 # It then pulls changes off github
 # Then, it installs any new packages
-# Next, it updates static files (CSS/JS) and the database
+# Next, it updates static files (CSS/JS), the database, and the media usage ledger
 # Finally, it reloads the webapp
 
 # shellcheck disable=SC2034
@@ -21,6 +21,8 @@ echo Updating Static Files
 python manage.py collectstatic --noinput
 echo Updating Database
 python manage.py migrate
+echo Recalculating Media Usage
+python manage.py reconcile_media_usage
 echo Reloading Webapp
 touch WSGI_FILE
 echo Update Complete, please wait a bit for the webapp to reload